@@ -0,0 +1,98 @@
+# Copyright (c) Microsoft Corporation.
+# Copyright (c) University of Florida Research Foundation, Inc.
+# Licensed under the MIT License.
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in 
+# the Software without restriction, including without limitation the rights to 
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies 
+# of the Software, and to permit persons to whom the Software is furnished to do 
+# so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR 
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, 
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER 
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING 
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS 
+# IN THE SOFTWARE.
+#
+# bench_arch.py
+# Benchmark parameter count, multiply-adds and inference latency of
+# VisibNet -> CoarseNet -> RefineNet for different width multipliers &
+# depthwise-separable convs
+# Author: Francesco Pittaluga
+
+import os
+import time
+import numpy as np
+import tensorflow as tf
+import utils as ut
+from models import VisibNet
+from models import CoarseNet
+from models import RefineNet
+
+################################################################################
+
+parser = ut.MyParser(description='Configure')
+parser.add_argument("--configs", type=lambda s: [(float(c.split(':')[0]),c.split(':')[1]=='1') for c in s.split(',')],
+                    default='1:0,0.5:0,0.5:1,0.25:1',
+                    help="WIDTH:SEP,...: Width multipliers & depthwise-separable flags (0/1) to benchmark (default: %(default)s)")
+parser.add_argument("--input_attr", type=str, default='depth_sift_rgb',
+                    choices=['depth','depth_sift','depth_rgb','depth_sift_rgb'],
+                    help="%(type)s: Per-point attributes to inlcude in input tensor (default: %(default)s)")
+parser.add_argument("--crop_size", type=int, default=256,
+                    help="%(type)s: Size of input projections (default: %(default)s)")
+parser.add_argument("--batch_size", type=int, default=1,
+                    help="%(type)s: Number of samples per batch (default: %(default)s)")
+parser.add_argument("--num_iter", type=int, default=20,
+                    help="%(type)s: Number of timed batches per config (default: %(default)s)")
+parser.add_argument("-gpu", action='store_true', default=False,
+                    help="%(type)s: Allow running on GPU (default: %(default)s)")
+prm = parser.parse_args()
+
+prm_str = 'Arguments:\n'+'\n'.join(['{} {}'.format(k.upper(),v) for k,v in vars(prm).items()])
+print(prm_str+'\n')
+
+################################################################################
+
+nch = {'depth':1,'depth_rgb':4,'depth_sift':129,'depth_sift_rgb':132}[prm.input_attr]
+inp = np.random.RandomState(0).rand(prm.batch_size,prm.crop_size,prm.crop_size,nch).astype(np.float32)
+
+config = tf.ConfigProto() if prm.gpu else tf.ConfigProto(device_count={'GPU':0})
+nthr = os.getenv('OMP_NUM_THREADS')
+if nthr is not None: config.intra_op_parallelism_threads = int(nthr)
+
+rows = []
+for width,sep in prm.configs:
+    graph = tf.Graph()
+    with graph.as_default():
+        # Random weights, test-mode batchnorm & no dropout as in inference
+        inp_p = tf.placeholder(tf.float32,shape=[None,prm.crop_size,prm.crop_size,nch])
+        V = VisibNet(inp_p,bn='test',width=width,sep=sep)
+        C = CoarseNet(inp_p*tf.to_float(V.pred>.5),bn='test',width=width,sep=sep)
+        R = RefineNet(tf.concat((C.pred,inp_p),axis=3),bn='test',width=width,sep=sep)
+        npar = sum(int(np.prod(v.get_shape().as_list())) for N in [V,C,R]
+                   for k,v in N.weights.items() if not k.endswith(('_mn','_vr')))
+        convs = [op for op in graph.get_operations() if op.type in ['Conv2D','DepthwiseConv2dNative']]
+        sess = tf.Session(config=config)
+        sess.run(tf.global_variables_initializer())
+
+        # Warm up (reading off conv output sizes for the multiply-adds), then time
+        shp = sess.run([tf.shape(op.outputs[0]) for op in convs],feed_dict={inp_p:inp})
+        nmac = 0
+        for op,s in zip(convs,shp):
+            k = op.inputs[1].get_shape().as_list()
+            nmac += int(np.prod(s[1:]))*k[0]*k[1]*(k[2] if op.type=='Conv2D' else 1)
+        t0 = time.time()
+        for i in range(prm.num_iter):
+            sess.run(R.pred,feed_dict={inp_p:inp})
+        rows.append((width,sep,npar,nmac,(time.time()-t0)/prm.num_iter/prm.batch_size))
+        sess.close()
+
+print('{:>6s} {:>4s} {:>12s} {:>12s} {:>10s}'.format('width','sep','params(M)','GMAC/sample','ms/sample'))
+for width,sep,npar,nmac,t in rows:
+    print('{:6.2f} {:>4s} {:12.2f} {:12.1f} {:10.1f}'.format(width,'y' if sep else 'n',npar/1e6,nmac/1e9,t*1000.))
@@ -0,0 +1,131 @@
+# Copyright (c) Microsoft Corporation.
+# Copyright (c) University of Florida Research Foundation, Inc.
+# Licensed under the MIT License.
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in 
+# the Software without restriction, including without limitation the rights to 
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies 
+# of the Software, and to permit persons to whom the Software is furnished to do 
+# so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR 
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, 
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER 
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING 
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS 
+# IN THE SOFTWARE.
+#
+# calib_bn.py
+# Calibrate RefineNet batchnorm running statistics on training samples so it
+# can be run with bn='test'
+# Author: Francesco Pittaluga
+
+import os
+import json
+import numpy as np
+import utils as ut
+import load_data as ld
+from models import save_blob
+from pipeline import InvSFM
+
+################################################################################
+
+parser = ut.MyParser(description='Configure')
+parser.add_argument("--input_attr", type=str, default='depth_sift_rgb',
+                    choices=['depth','depth_sift','depth_rgb','depth_sift_rgb'],
+                    help="%(type)s: Per-point attributes to inlcude in input tensor (default: %(default)s)")
+parser.add_argument("--wts_dir", type=str, default='wts/pretrained',
+                    help="%(type)s: Directory of pre-trained weights (default: %(default)s)")
+parser.add_argument("--anns", type=str, default='data/anns/demo_5k/train.txt',
+                    help="%(type)s: Path to annotation file of samples to calibrate on (default: %(default)s)")
+parser.add_argument("--num_samples", type=int, default=512,
+                    help="%(type)s: Number of samples to calibrate on (default: %(default)s)")
+parser.add_argument("--batch_size", type=int, default=8,
+                    help="%(type)s: Number of samples per batch (default: %(default)s)")
+parser.add_argument("--pct_3D_points", type=float, default=100.,
+                    help="%(type)s: Percent of available 3D points to include in input tensor (default: %(default)s)")
+parser.add_argument("--crop_size", type=int, default=512, choices=[256,512],
+                    help="%(type)s: Size to crop images to (default: %(default)s)")
+parser.add_argument("--scale_size", type=int, default=512,
+                    help="%(type)s: Size to scale images to before crop (default: %(default)s)")
+parser.add_argument("--seed", type=int, default=1111,
+                    help="%(type)s: Seed for random selection of samples (default: %(default)s)")
+parser.add_argument("--out_model", type=str, default=None,
+                    help="%(type)s: Path (without .npz) to write calibrated RefineNet wts to "+\
+                    "(default: WTS_DIR/INPUT_ATTR/refinenet_bn.model, read by refine_bn='test')")
+prm = parser.parse_args()
+
+if prm.scale_size < prm.crop_size: parser.error("SCALE_SIZE must be >= CROP_SIZE")
+if prm.num_samples <= 0: parser.error("NUM_SAMPLES must be > 0")
+if prm.batch_size <= 0: parser.error("BATCH_SIZE must be > 0")
+
+if prm.out_model == None:
+    prm.out_model = '{}/{}/refinenet_bn.model'.format(prm.wts_dir,prm.input_attr)
+
+prm_str = 'Arguments:\n'+'\n'.join(['{} {}'.format(k.upper(),v) for k,v in vars(prm).items()])
+print(prm_str+'\n')
+
+################################################################################
+
+# Project the point cloud of one annotated sample
+def load_sample(ann,seed):
+    pcl_xyz = ld.load_points_xyz('data/'+ann[0])
+    pcl_rgb = ld.load_points_rgb('data/'+ann[1])
+    pcl_sift = ld.load_points_sift('data/'+ann[2])
+    K,R,T,h,w = ld.load_camera('data/'+ann[3])
+    proj_mat = K.dot(np.hstack((R,T)))
+    return ld.project_points(pcl_xyz, pcl_rgb, pcl_sift,
+                             proj_mat, h, w, prm.scale_size, prm.crop_size,
+                             pct_pts=prm.pct_3D_points, seed=seed)
+
+# Build graph with RefineNet exposing per-layer batch statistics
+net = InvSFM(prm.input_attr,prm.crop_size,batch_size=prm.batch_size,
+             wts_dir=prm.wts_dir,warmup=False,refine_bn='set')
+
+anns = ut.annotations(prm.anns)
+perm = np.random.RandomState(seed=prm.seed).permutation(len(anns))[:prm.num_samples]
+
+# Accumulate per-layer mean and mean of squares, weighted by batch size
+acc = {k:0. for k in net.rnet.bn_outs}
+n = 0
+for i in range(0,len(perm),prm.batch_size):
+    bch = [load_sample(anns[j],(prm.seed,j)) for j in perm[i:i+prm.batch_size]]
+    pdepth, prgb, psift = [np.stack(x) for x in zip(*bch)]
+    fd = {net.proj_depth_p:pdepth, net.proj_rgb_p:prgb, net.proj_sift_p:psift}
+    stats = net.sess.run(net.rnet.bn_outs,feed_dict=fd)
+    for k in acc:
+        if k.endswith('_mn'):
+            acc[k] = acc[k] + len(bch)*stats[k]
+        else:
+            acc[k] = acc[k] + len(bch)*(stats[k]+np.square(stats[k[:-3]+'_mn']))
+    n += len(bch)
+    ut.mprint('Calibrated on {} / {} samples'.format(n,len(perm)))
+net.close()
+
+# Pooled mean & variance
+stats = {}
+for k in acc:
+    if k.endswith('_mn'):
+        stats[k] = (acc[k]/n).astype(np.float32)
+        stats[k[:-3]+'_vr'] = np.maximum(acc[k[:-3]+'_vr']/n-np.square(stats[k]),0.).astype(np.float32)
+
+# Write RefineNet wts with statistics to OUT_MODEL (npz, and blob if the
+# pre-trained wts were converted); the pre-trained wts are left as they are
+fp = '{}/{}/refinenet.model'.format(prm.wts_dir,prm.input_attr)
+wts = np.load(fp+'.npz')
+wts = {k:wts[k] for k in wts.files}
+wts.update(stats)
+op = prm.out_model
+np.savez(op+'.tmp.npz',**wts)
+os.replace(op+'.tmp.npz',op+'.npz')
+print('\nWrote RefineNet wts with {} batchnorm statistics to {}.npz'.format(len(stats),op))
+if os.path.isfile(fp+'.json'):
+    with open(fp+'.json') as f:
+        dtype = np.dtype(list(json.load(f).values())[0]['dtype'])
+    save_blob(op,wts,dtype)
+    print('Wrote {}.bin / {}.json'.format(op,op))
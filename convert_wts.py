@@ -0,0 +1,98 @@
+# Copyright (c) Microsoft Corporation.
+# Copyright (c) University of Florida Research Foundation, Inc.
+# Licensed under the MIT License.
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in 
+# the Software without restriction, including without limitation the rights to 
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies 
+# of the Software, and to permit persons to whom the Software is furnished to do 
+# so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR 
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, 
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER 
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING 
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS 
+# IN THE SOFTWARE.
+#
+# convert_wts.py
+# Convert .model.npz weight files to raw blob + JSON index files (see
+# models.save_blob) and optionally time loading both formats
+# Author: Francesco Pittaluga
+
+import os
+import time
+import glob
+import re
+import sys
+import argparse
+import subprocess
+import numpy as np
+import utils as ut
+from models import save_blob, load_wts
+
+################################################################################
+
+parser = ut.MyParser(description='Configure')
+parser.add_argument("--wts_dir", type=str, default='wts/pretrained',
+                    help="%(type)s: Directory searched (recursively) for .model.npz files (default: %(default)s)")
+parser.add_argument("-float16", action='store_true', default=False,
+                    help="%(type)s: Store weights as float16 (default: %(default)s)")
+parser.add_argument("-bench", action='store_true', default=False,
+                    help="%(type)s: Time loading each file in both formats (default: %(default)s)")
+parser.add_argument("--time_load", type=str, default=None, help=argparse.SUPPRESS)
+prm = parser.parse_args()
+
+if prm.time_load is None:
+    prm_str = 'Arguments:\n'+'\n'.join(['{} {}'.format(k.upper(),v) for k,v in vars(prm).items()])
+    print(prm_str+'\n')
+
+################################################################################
+
+# Resident set size (or its peak with KEY='VmHWM') of this process in MB
+def rss(key='VmRSS'):
+    with open('/proc/self/status') as f:
+        return int(re.search(key+r':\s+(\d+)',f.read()).group(1))/1024.
+
+# Read every tensor as float32 and hold all of them (as Net.load does);
+# return wall time and peak RSS growth
+def time_load(fname):
+    r0 = rss()
+    with open('/proc/self/clear_refs','w') as f:
+        f.write('5') # reset peak RSS
+    t0 = time.time()
+    wts = load_wts(fname)
+    arrs = {k:wts[k].astype(np.float32,copy=False) for k in wts.keys()}
+    tot = sum(float(np.sum(a)) for a in arrs.values())
+    return time.time()-t0, rss('VmHWM')-r0
+
+# Run time_load in a fresh process (this script with --time_load), so memory
+# left over from the conversion does not skew it
+def bench(fname):
+    out = subprocess.check_output([sys.executable,sys.argv[0],'--time_load',fname])
+    return [float(v) for v in out.split()]
+
+if prm.time_load is not None:
+    print('{} {}'.format(*time_load(prm.time_load)))
+    sys.exit(0)
+
+npz_fps = sorted(glob.glob(os.path.join(prm.wts_dir,'**','*.model.npz'),recursive=True))
+if len(npz_fps) == 0:
+    print('No .model.npz files found in {}'.format(prm.wts_dir))
+
+for npz_fp in npz_fps:
+    fp = npz_fp[:-len('.npz')]
+    wts = np.load(npz_fp)
+    save_blob(fp,{k:wts[k] for k in wts.files},np.float16 if prm.float16 else np.float32)
+    print('Wrote {}.bin / {}.json'.format(fp,fp))
+    del wts
+
+    if prm.bench:
+        for fn in [npz_fp,fp+'.json']:
+            t,mb = bench(fn)
+            print('  {}: {:.3f} s, peak RSS +{:.0f} MB'.format(os.path.basename(fn),t,mb))
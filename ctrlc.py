@@ -21,17 +21,18 @@
 # IN THE SOFTWARE.
 #
 # ctrlc.py
-# Script for graceful handling of SIGINT
+# Script for graceful handling of SIGINT & SIGTERM
 # Author: Francesco Pittaluga
 
 import signal
 
 stop = False
-_orig = None
+_orig = {}
 
 def handler(a,b):
     global stop
     stop = True
-    signal.signal(signal.SIGINT,_orig)
+    signal.signal(a,_orig[a])
 
-_orig = signal.signal(signal.SIGINT,handler)
+for sig in [signal.SIGINT,signal.SIGTERM]:
+    _orig[sig] = signal.signal(sig,handler)
@@ -26,14 +26,11 @@
 
 import os
 import sys
-import tensorflow as tf
 import numpy as np
 from PIL import Image, ImageFont, ImageDraw
 import utils as ut
 import load_data as ld
-from models import VisibNet
-from models import CoarseNet
-from models import RefineNet
+from pipeline import InvSFM
 
 ################################################################################
 
@@ -51,19 +48,23 @@ parser.add_argument("--scale_size", type=int, default=512, choices=[256,394,512]
                     help="%(type)s: Size to scale images to before crop (default: %(default)s)")
 parser.add_argument("--num_samples", type=int, default=32,
                     help="%(type)s: Number of samples to process/visualize (default: %(default)s)")
+parser.add_argument("--batch_size", type=int, default=8,
+                    help="%(type)s: Number of samples per inference batch (default: %(default)s)")
+parser.add_argument("--stages", type=str, default='refine', choices=['visib','coarse','refine'],
+                    help="%(type)s: Last network to run; later networks are not built or loaded (default: %(default)s)")
+parser.add_argument("--frozen_graph", type=str, default=None,
+                    help="%(type)s: Graph written by export_graph.py to run instead of building one (default: %(default)s)")
+parser.add_argument("--refine_bn", type=str, default='sample', choices=['sample','test'],
+                    help="%(type)s: RefineNet batchnorm statistics; 'test' needs calib_bn.py to have been run (default: %(default)s)")
 prm = parser.parse_args()
 
 if prm.scale_size < prm.crop_size: parser.error("SCALE_SIZE must be >= CROP_SIZE")
 if prm.num_samples <= 0: parser.error("NUM_SAMPLES must be > 0")
+if prm.batch_size <= 0: parser.error("BATCH_SIZE must be > 0")
 
 prm_str = 'Parameters:\n'+'\n'.join(['{} {}'.format(k.upper(),v) for k,v in vars(prm).items()])
 print(prm_str+'\n')
 
-# set paths for model wts
-vnet_wts_fp = 'wts/pretrained/{}/visibnet.model.npz'.format(prm.input_attr)
-cnet_wts_fp = 'wts/pretrained/{}/coarsenet.model.npz'.format(prm.input_attr)
-rnet_wts_fp = 'wts/pretrained/{}/refinenet.model.npz'.format(prm.input_attr)
-
 # set paths for colmap files
 scene = 'nyu_bedroom_0041' if prm.dataset == 'nyu' else 'megadepth_0117_dense0'
 cmap_database_fp = 'data/demo_colmap_outputs/{}/database.db'.format(scene)
@@ -92,7 +93,8 @@ proj_rgb = []
 for i in range(len(K))[::(len(K)//prm.num_samples)]:
     proj_mat = K[i].dot(np.hstack((R[i],T[i])))
     pdepth, prgb, psift = ld.project_points(pcl_xyz, pcl_rgb, pcl_sift,
-                                            proj_mat, h[i], w[i], prm.scale_size, prm.crop_size)    
+                                            proj_mat, h[i], w[i], prm.scale_size, prm.crop_size,
+                                            pct_pts=prm.pct_3D_points, seed=i)
     proj_depth.append((pdepth)[None,...])
     proj_sift.append((psift)[None,...])
     proj_rgb.append((prgb)[None,...])
@@ -103,88 +105,14 @@ proj_rgb = np.vstack(proj_rgb)
 
 ################################################################################
 
-# Build Graph
-proj_depth_p = tf.placeholder(tf.float32,shape=[1,prm.crop_size,prm.crop_size,1])
-proj_rgb_p = tf.placeholder(tf.uint8,shape=[1,prm.crop_size,prm.crop_size,3])
-proj_sift_p = tf.placeholder(tf.uint8,shape=[1,prm.crop_size,prm.crop_size,128])
-
-pdepth = proj_depth_p
-prgb = tf.to_float(proj_rgb_p)
-psift = tf.to_float(proj_sift_p)
-
-keep = prm.pct_3D_points/100.
-pdepth = tf.nn.dropout(pdepth,keep,noise_shape=[1,prm.crop_size,prm.crop_size,1],seed=0)*keep
-prgb = tf.nn.dropout(prgb,keep,noise_shape=[1,prm.crop_size,prm.crop_size,1],seed=0)*keep
-psift = tf.nn.dropout(psift,keep,noise_shape=[1,prm.crop_size,prm.crop_size,1],seed=0)*keep
-valid = tf.greater(pdepth,0.)
-
-# set up visibnet
-if prm.input_attr=='depth':
-    vinp = pdepth
-elif prm.input_attr=='depth_rgb':
-    vinp = tf.concat((pdepth, prgb/127.5-1.),axis=3)
-elif prm.input_attr=='depth_sift':
-    vinp = tf.concat((pdepth, psift/127.5-1.),axis=3)
-elif prm.input_attr=='depth_sift_rgb':
-    vinp = tf.concat((pdepth, psift/127.5-1., prgb/127.5-1.),axis=3)
-vnet = VisibNet(vinp,bn='test')
-vpred = tf.logical_and(tf.greater(vnet.pred,.5),valid)
-vpredf = tf.to_float(vpred)*0.+1.
-
-# set up coarsenet 
-if prm.input_attr=='depth':
-    cinp = pdepth*vpredf
-elif prm.input_attr=='depth_rgb':
-    cinp = tf.concat((pdepth*vpredf, prgb*vpredf/127.5-1.),axis=3)
-elif prm.input_attr=='depth_sift':
-    cinp = tf.concat((pdepth*vpredf, psift*vpredf/127.5-1.),axis=3)
-elif prm.input_attr=='depth_sift_rgb':
-    cinp = tf.concat((pdepth*vpredf, psift*vpredf/127.5-1., prgb*vpredf/127.5-1.),axis=3)
-cnet = CoarseNet(cinp,bn='test')
-cpred = cnet.pred
-
-# set up refinenet
-rinp = tf.concat((cpred,cinp),axis=3)
-rnet = RefineNet(rinp,bn='train')
-rpred = rnet.pred
-
-# scale outputs
-cpred = (cpred+1.)*127.5
-rpred = (rpred+1.)*127.5
-
-################################################################################
-
-# Run Graph
-sess=tf.Session()
-try: init_all_vars = tf.global_variables_initializer()
-except: init_all_vars = tf.initialize_all_variables()
-
-# Load net wts
-vnet.load(sess,vnet_wts_fp)
-cnet.load(sess,cnet_wts_fp)
-rnet.load(sess,rnet_wts_fp)
-sess.run([vnet.unset_ifdo,
-          cnet.unset_ifdo,
-          rnet.unset_ifdo])
-
-# Run cnet
-vpred_img = []
-cpred_img = []
-rpred_img = []
-valid_img = []
-for i in range(prm.num_samples):
-    fd = {proj_depth_p:proj_depth[i:i+1],
-          proj_rgb_p:proj_rgb[i:i+1],
-          proj_sift_p:proj_sift[i:i+1]}
-    out = sess.run([vpred,cpred,rpred,valid],feed_dict=fd)
-    vpred_img.append(out[0])
-    cpred_img.append(out[1])
-    rpred_img.append(out[2])
-    valid_img.append(out[3])
-vpred_img = np.vstack(vpred_img)
-cpred_img = np.vstack(cpred_img)
-rpred_img = np.vstack(rpred_img)
-valid_img = np.vstack(valid_img)
+# Build graph, load net wts & run networks
+net = InvSFM(prm.input_attr,prm.crop_size,batch_size=prm.batch_size,frozen_fp=prm.frozen_graph,
+             refine_bn=prm.refine_bn,stages=prm.stages)
+out = net.infer(proj_depth[:prm.num_samples],proj_rgb[:prm.num_samples],proj_sift[:prm.num_samples])
+vpred_img = out['visib']
+valid_img = out['valid']
+for i in range(len(out['visib_ratio'])):
+    print('Sample {}: {:.1f}% of valid points predicted visible'.format(i,out['visib_ratio'][i]*100.))
         
 ################################################################################
 
@@ -199,18 +127,18 @@ vpred_img[np.dstack((zero,zero,np.logical_and(valid,vpred)))] = 255.
 
 # Build results montage
 header_size = 60
-mntg = np.hstack((vpred_img.astype(np.uint8),
-                  np.vstack(cpred_img).astype(np.uint8),
-                  np.vstack(rpred_img).astype(np.uint8)))
-header_bot = np.ones((header_size,prm.crop_size*3,3))*127.
-header_top = np.zeros((header_size,prm.crop_size*3,3))
+mntg = [vpred_img.astype(np.uint8)]
+mntg += [np.vstack(out[k]).astype(np.uint8) for k in ['coarse','refine'] if k in out]
+mntg = np.hstack(mntg)
+header_bot = np.ones((header_size,mntg.shape[1],3))*127.
+header_top = np.zeros((header_size,mntg.shape[1],3))
 mntg = np.vstack((header_top,header_bot,mntg))
 
 # Add titles to montage header
 mntg = Image.fromarray(mntg.astype(np.uint8))
 im_draw = ImageDraw.Draw(mntg)
 font = ImageFont.truetype("FreeMonoBold.ttf", 36)
-column_titles = ['VisibNet Prediction','CoarseNet Prediction','RefineNet Prediction']
+column_titles = ['VisibNet Prediction','CoarseNet Prediction','RefineNet Prediction'][:header_top.shape[1]//prm.crop_size]
 figure_title = 'Input Attributes: ' + prm.input_attr.replace('_',', ')
 for i in range(len(column_titles)):
     xpos = prm.crop_size*i + prm.crop_size/2 - font.getsize(column_titles[i])[0]/2
@@ -0,0 +1,106 @@
+# Copyright (c) Microsoft Corporation.
+# Copyright (c) University of Florida Research Foundation, Inc.
+# Licensed under the MIT License.
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in 
+# the Software without restriction, including without limitation the rights to 
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies 
+# of the Software, and to permit persons to whom the Software is furnished to do 
+# so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR 
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, 
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER 
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING 
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS 
+# IN THE SOFTWARE.
+#
+# demo_fullframe.py
+# Demo script for running pre-trained models on full-frame projections of
+# colmap sparse reconstructions, either as blended tiles or padded to a
+# multiple of 64 and run whole
+# Author: Francesco Pittaluga
+
+import os
+import numpy as np
+from PIL import Image
+import utils as ut
+import load_data as ld
+from pipeline import InvSFM
+
+################################################################################
+
+parser = ut.MyParser(description='Configure')
+parser.add_argument("--input_attr", type=str, default='depth_sift_rgb',
+                    choices=['depth','depth_sift','depth_rgb','depth_sift_rgb'],
+                    help="%(type)s: Per-point attributes to inlcude in input tensor (default: %(default)s)")
+parser.add_argument("--pct_3D_points", type=float, default=100., choices=[20,60,100],
+                    help="%(type)s: Percent of available 3D points to include in input tensor (default: %(default)s)")
+parser.add_argument("--dataset", type=str, default='nyu', choices=['nyu','medadepth'],
+                    help="%(type)s: Dataset to use for demo (default: %(default)s)")
+parser.add_argument("--mode", type=str, default='tiled', choices=['tiled','padded'],
+                    help="%(type)s: Run overlapping tiles or the whole padded frame (default: %(default)s)")
+parser.add_argument("--tile_size", type=int, default=512, choices=[256,512],
+                    help="%(type)s: Size of tiles run through the networks (default: %(default)s)")
+parser.add_argument("--tile_overlap", type=int, default=64,
+                    help="%(type)s: Overlap between neighbouring tiles (default: %(default)s)")
+parser.add_argument("--scale_size", type=int, default=None,
+                    help="%(type)s: Size to scale shorter image side to (default: native resolution)")
+parser.add_argument("--num_samples", type=int, default=4,
+                    help="%(type)s: Number of views to reconstruct (default: %(default)s)")
+parser.add_argument("--batch_size", type=int, default=8,
+                    help="%(type)s: Number of tiles per inference batch (default: %(default)s)")
+parser.add_argument("--refine_bn", type=str, default='sample', choices=['sample','test'],
+                    help="%(type)s: RefineNet batchnorm statistics; 'test' needs calib_bn.py to have been run (default: %(default)s)")
+prm = parser.parse_args()
+
+if prm.tile_overlap < 0 or prm.tile_overlap >= prm.tile_size: parser.error("TILE_OVERLAP must be in [0,TILE_SIZE)")
+if prm.num_samples <= 0: parser.error("NUM_SAMPLES must be > 0")
+if prm.batch_size <= 0: parser.error("BATCH_SIZE must be > 0")
+
+prm_str = 'Parameters:\n'+'\n'.join(['{} {}'.format(k.upper(),v) for k,v in vars(prm).items()])
+print(prm_str+'\n')
+
+# set paths for colmap files
+scene = 'nyu_bedroom_0041' if prm.dataset == 'nyu' else 'megadepth_0117_dense0'
+cmap_database_fp = 'data/demo_colmap_outputs/{}/database.db'.format(scene)
+cmap_points3D_fp = 'data/demo_colmap_outputs/{}/points3D.bin'.format(scene)
+cmap_cameras_fp = 'data/demo_colmap_outputs/{}/cameras.bin'.format(scene)
+cmap_images_fp = 'data/demo_colmap_outputs/{}/images.bin'.format(scene)
+
+################################################################################
+
+print('Loading point cloud...')
+pcl_xyz, pcl_rgb, pcl_sift = ld.load_points_colmap(cmap_database_fp,cmap_points3D_fp)
+print('Done!')
+
+print('Loading cameras...')
+K,R,T,h,w,_ = ld.load_cameras_colmap(cmap_images_fp,cmap_cameras_fp)
+print('Done!')
+
+# Build graph & load net wts
+net = InvSFM(prm.input_attr,prm.tile_size if prm.mode=='tiled' else None,
+             batch_size=prm.batch_size,refine_bn=prm.refine_bn)
+
+# Project, reconstruct & save one view at a time
+out_dir = 'viz/demo_fullframe'
+if not os.path.isdir(out_dir): os.makedirs(out_dir)
+for i in range(len(K))[::max(len(K)//prm.num_samples,1)][:prm.num_samples]:
+    proj_mat = K[i].dot(np.hstack((R[i],T[i])))
+    pdepth, prgb, psift = ld.project_points_full(pcl_xyz, pcl_rgb, pcl_sift,
+                                                 proj_mat, h[i], w[i], prm.scale_size,
+                                                 pct_pts=prm.pct_3D_points, seed=i)
+    if prm.mode=='tiled':
+        out = net.infer_tiled(pdepth,prgb,psift,overlap=prm.tile_overlap)
+    else:
+        out = net.infer_full([pdepth],[prgb],[psift])[0]
+    fp = '{}/{}_{:04d}.png'.format(out_dir,prm.input_attr,i)
+    print('Saving {}x{} reconstruction to {}...'.format(pdepth.shape[1],pdepth.shape[0],fp))
+    Image.fromarray(np.hstack((out['coarse'],out['refine'])).astype(np.uint8)).save(fp)
+net.close()
+print('Done!')
@@ -0,0 +1,136 @@
+# Copyright (c) Microsoft Corporation.
+# Copyright (c) University of Florida Research Foundation, Inc.
+# Licensed under the MIT License.
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in 
+# the Software without restriction, including without limitation the rights to 
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies 
+# of the Software, and to permit persons to whom the Software is furnished to do 
+# so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR 
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, 
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER 
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING 
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS 
+# IN THE SOFTWARE.
+#
+# dist.py
+# Communication between the processes of data-parallel training: rank 0
+# accepts a TCP connection from every other rank and sums their arrays
+# Author: Francesco Pittaluga
+
+import time
+import socket
+import numpy as np
+
+# Fill numpy array BUF from socket S
+def _recv(s,buf):
+    mv = memoryview(buf).cast('B')
+    n = 0
+    while n < len(mv):
+        k = s.recv_into(mv[n:])
+        if k == 0:
+            raise ConnectionError('Connection closed by peer')
+        n += k
+
+# Star-connected group of SIZE processes, rank 0 listening at ADDR
+# (host:port). With SIZE = 1 every operation returns its input.
+class comm:
+    def __init__(self,rank=0,size=1,addr='localhost:29500',timeout=600):
+        self.rank = rank
+        self.size = size
+        self.socks = []
+        if size == 1:
+            return
+        host,port = addr.rsplit(':',1)
+
+        if rank == 0:
+            srv = socket.socket(socket.AF_INET,socket.SOCK_STREAM)
+            srv.setsockopt(socket.SOL_SOCKET,socket.SO_REUSEADDR,1)
+            srv.bind(('',int(port)))
+            srv.listen(size-1)
+            srv.settimeout(timeout)
+            self.socks = [None]*(size-1)
+            for i in range(size-1):
+                s,_ = srv.accept()
+                r = np.zeros(1,dtype=np.int32)
+                _recv(s,r)
+                self.socks[r[0]-1] = s
+            srv.close()
+        else:
+            tend = time.time()+timeout
+            while True:
+                try:
+                    s = socket.create_connection((host,int(port)))
+                    break
+                except OSError:
+                    if time.time() > tend: raise
+                    time.sleep(1)
+            s.sendall(np.int32([rank]).tobytes())
+            self.socks = [s]
+
+        for s in self.socks:
+            s.settimeout(None)
+            s.setsockopt(socket.IPPROTO_TCP,socket.TCP_NODELAY,1)
+
+    # Element-wise sum of list of arrays ARRS over all ranks
+    def allreduce(self,arrs):
+        if self.size == 1:
+            return arrs
+        buf = np.concatenate([np.ravel(a) for a in arrs]).astype(np.float32)
+        if self.rank == 0:
+            tmp = np.empty_like(buf)
+            for s in self.socks:
+                _recv(s,tmp)
+                buf += tmp
+            for s in self.socks:
+                s.sendall(buf)
+        else:
+            self.socks[0].sendall(buf)
+            _recv(self.socks[0],buf)
+
+        out = []; i = 0
+        for a in arrs:
+            out.append(buf[i:i+np.size(a)].reshape(np.shape(a)).astype(np.asarray(a).dtype))
+            i += np.size(a)
+        return out
+
+    # True on all ranks if FLAG is True on any rank
+    def any(self,flag):
+        return bool(self.allreduce([np.float32([flag])])[0][0] > 0)
+
+    # Copy list of arrays ARRS from rank 0 to all ranks
+    def bcast(self,arrs):
+        if self.size == 1:
+            return arrs
+        out = []
+        for a in arrs:
+            a = np.ascontiguousarray(a)
+            if self.rank == 0:
+                for s in self.socks:
+                    s.sendall(a)
+            else:
+                a = np.empty_like(a)
+                _recv(self.socks[0],a)
+            out.append(a)
+        return out
+
+    # Set variables VAR_LIST on all ranks to their values on rank 0
+    def bcast_vars(self,sess,var_list):
+        if self.size == 1:
+            return
+        vals = self.bcast(sess.run(var_list))
+        if self.rank > 0:
+            for v,val in zip(var_list,vals):
+                v.load(val,sess)
+
+    def close(self):
+        for s in self.socks:
+            s.close()
+        self.socks = []
@@ -0,0 +1,69 @@
+# Copyright (c) Microsoft Corporation.
+# Copyright (c) University of Florida Research Foundation, Inc.
+# Licensed under the MIT License.
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in 
+# the Software without restriction, including without limitation the rights to 
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies 
+# of the Software, and to permit persons to whom the Software is furnished to do 
+# so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR 
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, 
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER 
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING 
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS 
+# IN THE SOFTWARE.
+#
+# export_graph.py
+# Export VisibNet -> CoarseNet -> RefineNet as a single serialized GraphDef
+# with constant weights, batchnorm folded into convs and dropout removed
+# Author: Francesco Pittaluga
+
+import os
+import tensorflow as tf
+import utils as ut
+from pipeline import InvSFM
+
+################################################################################
+
+parser = ut.MyParser(description='Configure')
+parser.add_argument("--input_attr", type=str, default='depth_sift_rgb',
+                    choices=['depth','depth_sift','depth_rgb','depth_sift_rgb'],
+                    help="%(type)s: Per-point attributes to inlcude in input tensor (default: %(default)s)")
+parser.add_argument("--crop_size", type=int, default=512, choices=[256,512],
+                    help="%(type)s: Size of input projections (default: %(default)s)")
+parser.add_argument("--wts_dir", type=str, default='wts/pretrained',
+                    help="%(type)s: Directory of pre-trained weights (default: %(default)s)")
+parser.add_argument("--stages", type=str, default='refine', choices=['visib','coarse','refine'],
+                    help="%(type)s: Last network to include in the graph (default: %(default)s)")
+parser.add_argument("--refine_bn", type=str, default='sample', choices=['sample','test'],
+                    help="%(type)s: RefineNet batchnorm statistics; 'test' needs calib_bn.py to have been run (default: %(default)s)")
+parser.add_argument("--out_fp", type=str, default=None,
+                    help="%(type)s: Output file (default: WTS_DIR/INPUT_ATTR/invsfm_STAGES_CROP_SIZE.pb)")
+prm = parser.parse_args()
+
+if prm.out_fp is None:
+    prm.out_fp = '{}/{}/invsfm_{}_{}.pb'.format(prm.wts_dir,prm.input_attr,prm.stages,prm.crop_size)
+
+prm_str = 'Arguments:\n'+'\n'.join(['{} {}'.format(k.upper(),v) for k,v in vars(prm).items()])
+print(prm_str+'\n')
+
+################################################################################
+
+# Build constant-folded graph
+net = InvSFM(prm.input_attr,prm.crop_size,wts_dir=prm.wts_dir,warmup=False,fold=True,
+             refine_bn=prm.refine_bn,stages=prm.stages)
+
+# Strip unused nodes & write
+gd = tf.graph_util.extract_sub_graph(net.graph.as_graph_def(),list(net.outs.keys()))
+gd = tf.graph_util.remove_training_nodes(gd,protected_nodes=list(net.outs.keys()))
+tf.train.write_graph(gd,os.path.dirname(prm.out_fp),os.path.basename(prm.out_fp),as_text=False)
+net.close()
+
+print('Wrote frozen graph to {} ({} nodes)'.format(prm.out_fp,len(gd.node)))
@@ -0,0 +1,77 @@
+# Copyright (c) Microsoft Corporation.
+# Copyright (c) University of Florida Research Foundation, Inc.
+# Licensed under the MIT License.
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in 
+# the Software without restriction, including without limitation the rights to 
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies 
+# of the Software, and to permit persons to whom the Software is furnished to do 
+# so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR 
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, 
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER 
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING 
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS 
+# IN THE SOFTWARE.
+#
+# launch.py
+# Start the data-parallel processes of a training script on this node, e.g.
+#   python launch.py --nproc 8 train_coarse.py --batch_size 4
+# For several nodes, run it on each with --nnodes, --node_rank and the
+# address of node 0 in --dist_addr
+# Author: Francesco Pittaluga
+
+import os
+import sys
+import time
+import argparse
+import subprocess
+import utils as ut
+
+################################################################################
+
+parser = ut.MyParser(description='Configure')
+parser.add_argument("--nproc", type=int, default=2, help="%(type)s: Number of training processes on this node (default: %(default)s)")
+parser.add_argument("--nnodes", type=int, default=1, help="%(type)s: Number of nodes (default: %(default)s)")
+parser.add_argument("--node_rank", type=int, default=0, help="%(type)s: Rank of this node; node 0 runs rank 0 (default: %(default)s)")
+parser.add_argument("--dist_addr", type=str, default='localhost:29500', help="%(type)s: host:port of node 0 reachable from all nodes (default: %(default)s)")
+parser.add_argument("script", type=str, help="%(type)s: Training script, e.g. train_visib.py")
+parser.add_argument("args", nargs=argparse.REMAINDER, help="Arguments passed on to SCRIPT")
+prm = parser.parse_args()
+
+if prm.nproc <= 0: parser.error("NPROC must be > 0")
+if prm.node_rank < 0 or prm.node_rank >= prm.nnodes: parser.error("NODE_RANK must be in [0,NNODES)")
+
+################################################################################
+
+# Split the cores of this node between its processes
+env = dict(os.environ)
+if 'OMP_NUM_THREADS' not in env:
+    env['OMP_NUM_THREADS'] = str(max(os.cpu_count()//prm.nproc,1))
+
+procs = []
+for i in range(prm.nproc):
+    cmd = [sys.executable,prm.script]+prm.args+['--world_size',str(prm.nnodes*prm.nproc),
+                                                 '--rank',str(prm.node_rank*prm.nproc+i),
+                                                 '--dist_addr',prm.dist_addr]
+    procs.append(subprocess.Popen(cmd,env=env))
+ut.mprint("Started ranks {}-{} of {} with OMP_NUM_THREADS {}".format(prm.node_rank*prm.nproc,(prm.node_rank+1)*prm.nproc-1,
+                                                                    prm.nnodes*prm.nproc,env['OMP_NUM_THREADS']))
+
+# Wait for all processes; if one fails the others would block, so stop them
+try:
+    while any(p.poll() is None for p in procs):
+        if any(p.poll() not in (None,0) for p in procs):
+            for p in procs:
+                if p.poll() is None: p.terminate()
+        time.sleep(1)
+except KeyboardInterrupt:
+    for p in procs: p.wait()
+rc = max(abs(p.returncode) for p in procs)
+sys.exit(rc)
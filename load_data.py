@@ -163,10 +163,42 @@ def compute_visib_map(gt_depth,proj_depth,pct_diff_thresh=5.):
 # Compute 2D projection of point cloud
 ################################################################################
 
-# Compute 2D projection of point cloud
-def project_points(pcl_xyz, pcl_rgb, pcl_sift, proj_mat, src_img_h, src_img_w, scale_size, crop_size):
+# Count z-buffered points that land in the scaled & cropped view
+def count_points(pcl_xyz, proj_mat, src_img_h, src_img_w, scale_size, crop_size):
+    sc, cc, h, w = get_scale_and_crop_corners(src_img_h,src_img_w,scale_size,crop_size)
+    x0, x1, y0, y1 = cc
+    proj_xyz = proj_mat[:,:3].dot(pcl_xyz.T).T + proj_mat[:,3]
+    with np.errstate(divide='ignore',invalid='ignore'):
+        x = np.rint(proj_xyz[:,0]/proj_xyz[:,2]*sc)
+        y = np.rint(proj_xyz[:,1]/proj_xyz[:,2]*sc)
+    z = proj_xyz[:,2]
+    mask = logical_and([x>=x0, x<x1, y>=y0, y<y1, z>0., np.logical_not(np.isnan(z))])
+    return len(np.unique(np.ravel_multi_index((y[mask].astype(int),x[mask].astype(int)),(h,w))))
+
+# Compute 2D projection of point cloud, keeping a random pct_pts% of points
+def project_points(pcl_xyz, pcl_rgb, pcl_sift, proj_mat, src_img_h, src_img_w, scale_size, crop_size,
+                   pct_pts=100., seed=None):
     sc, cc, h, w = get_scale_and_crop_corners(src_img_h,src_img_w,scale_size,crop_size)
+    return project_points_window(pcl_xyz, pcl_rgb, pcl_sift, proj_mat, sc, cc, h, w, pct_pts, seed)
+
+# Compute 2D projection of point cloud over the whole src image, optionally
+# scaled so that its shorter side is scale_size
+def project_points_full(pcl_xyz, pcl_rgb, pcl_sift, proj_mat, src_img_h, src_img_w, scale_size=None,
+                        pct_pts=100., seed=None):
+    sc = 1. if scale_size is None else float(scale_size)/float(min(src_img_h,src_img_w))
+    h = int(np.ceil(src_img_h*sc))
+    w = int(np.ceil(src_img_w*sc))
+    return project_points_window(pcl_xyz, pcl_rgb, pcl_sift, proj_mat, sc, [0,w,0,h], h, w, pct_pts, seed)
+
+# Compute 2D projection of point cloud scaled by sc into the [x0,x1,y0,y1]
+# window of an h x w image
+def project_points_window(pcl_xyz, pcl_rgb, pcl_sift, proj_mat, sc, cc, h, w, pct_pts=100., seed=None):
     x0, x1, y0, y1 = cc
+
+    # Subsample point cloud
+    if pct_pts < 100.:
+        keep = np.random.RandomState(seed).rand(len(pcl_xyz)) < pct_pts/100.
+        pcl_xyz = pcl_xyz[keep]; pcl_rgb = pcl_rgb[keep]; pcl_sift = pcl_sift[keep]
     
     # Project point cloud to camera view & scale
     world_xyz = np.hstack((pcl_xyz,np.ones((len(pcl_xyz),1))))
@@ -189,9 +221,9 @@ def project_points(pcl_xyz, pcl_rgb, pcl_sift, proj_mat, src_img_h, src_img_w, s
     y = y[idx]-y0
     
     # get projected point cloud scaled & cropped
-    proj_depth = np.zeros((crop_size,crop_size,1)).astype(np.float32)
-    proj_rgb = np.zeros((crop_size,crop_size,3)).astype(np.uint8)
-    proj_sift = np.zeros((crop_size,crop_size,128)).astype(np.uint8)
+    proj_depth = np.zeros((y1-y0,x1-x0,1)).astype(np.float32)
+    proj_rgb = np.zeros((y1-y0,x1-x0,3)).astype(np.uint8)
+    proj_sift = np.zeros((y1-y0,x1-x0,128)).astype(np.uint8)
     proj_depth[y,x] = z[idx,None]
     proj_rgb[y,x] = pcl_rgb[mask][idx]
     proj_sift[y,x] = pcl_sift[mask][idx]
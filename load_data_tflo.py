@@ -72,8 +72,14 @@ def load_camera(fp):
     w = cam[22]
     return K,R,T,h,w
 
+# Random augmentation of n crops: crop y & x offsets and scale index (as
+# fractions of their ranges) and left-right flip (if < .5)
+def rand_aug(n,niter=0):
+    return tf.random_uniform([n,4],minval=0.,maxval=1.,seed=niter)
+
 # set scale and crop for data augmentation
-def scale_crop(h,w,crxy,crsz,scsz,isval,niter=0):
+def scale_crop(h,w,aug,crsz,scsz,isval):
+    nsc = len(scsz)
     scsz = tf.constant(np.float32(scsz),dtype=tf.float32)
     hw = tf.stack([h,w])
     if isval:
@@ -82,41 +88,54 @@ def scale_crop(h,w,crxy,crsz,scsz,isval,niter=0):
         cry = (new_sz[0]-crsz)//2
         crx = (new_sz[1]-crsz)//2
     else:
-        sc = tf.random_shuffle(scsz,seed=niter)[0]/tf.reduce_min(hw)
+        sc = scsz[tf.minimum(tf.to_int32(aug[2]*nsc),nsc-1)]/tf.reduce_min(hw)
         new_sz = tf.to_int32(tf.ceil(sc*hw))
-        cry = tf.cast(tf.floor(crxy[0]*tf.to_float(new_sz[0]-crsz)),tf.int32)
-        crx = tf.cast(tf.floor(crxy[1]*tf.to_float(new_sz[1]-crsz)),tf.int32)
+        cry = tf.cast(tf.floor(aug[0]*tf.to_float(new_sz[0]-crsz)),tf.int32)
+        crx = tf.cast(tf.floor(aug[1]*tf.to_float(new_sz[1]-crsz)),tf.int32)
     return sc,new_sz,cry,crx
 
-# load and augment (random scale & crop) image batch 
-def load_img_bch(img_paths,crsz,scsz,niter=0,isval=False,binary=False):
+# load and augment (random scale & crop) image batch. Each image yields
+# ncrops crops, augmented by consecutive rows of aug (see rand_aug)
+def load_img_bch(img_paths,crsz,scsz,niter=0,isval=False,binary=False,aug=None,ncrops=1):
     img_batch = []
-    crxy = tf.random_uniform([len(img_paths),2],minval=0.,maxval=1.,seed=niter)
+    if aug is None:
+        aug = rand_aug(len(img_paths)*ncrops,niter)
     for i in range(len(img_paths)):
         img = load_img(img_paths[i],binary=binary)
         h = tf.to_float(tf.shape(img)[0])
         w = tf.to_float(tf.shape(img)[1])
         nch = tf.shape(img)[2]
-        _,dep_sz,dep_cry,dep_crx = scale_crop(h,w,crxy[i],crsz,scsz,isval,niter)
-        img = tf.image.resize_images(img,dep_sz)
-        img = img[dep_cry:dep_cry+crsz,dep_crx:dep_crx+crsz,:]
-        if not isval:
-            img = tf.image.random_flip_left_right(img,seed=niter)
-        img_batch.append(tf.reshape(img,[1,crsz,crsz,nch]))
+        for k in range(ncrops):
+            a = aug[i*ncrops+k]
+            _,dep_sz,dep_cry,dep_crx = scale_crop(h,w,a,crsz,scsz,isval)
+            crop = tf.image.resize_images(img,dep_sz)
+            crop = crop[dep_cry:dep_cry+crsz,dep_crx:dep_crx+crsz,:]
+            if not isval:
+                crop = tf.cond(tf.less(a[3],.5),lambda: tf.reverse(crop,[1]),lambda: crop)
+            img_batch.append(tf.reshape(crop,[1,crsz,crsz,nch]))
     return tf.concat(img_batch,axis=0)
 
 # load batch of sfm projections (xyz, color, depth, sift descriptor)
+# if sparse, return per-point [y,x] crop coordinates and attributes instead
+# of dense projections. Each sample keeps a random pct_pts[0]-pct_pts[1]%
+# of its points, drawn from its own seeded stream, before projection (or,
+# if pts_seed is given, from a stateless stream seeded by pts_seed[i]).
+# Each sample yields ncrops crops (see load_img_bch) from one file load and
+# world-to-camera transform.
 def load_proj_bch(camera_paths,pcl_xyz_paths,pcl_sift_paths,pcl_rgb_paths,
-                  crsz,scsz,isval=False,niter=0):
+                  crsz,scsz,isval=False,niter=0,sparse=False,pct_pts=[100.,100.],
+                  aug=None,ncrops=1,pts_seed=None):
 
     bsz = len(camera_paths)
+    proj_yx_batch = []
     proj_depth_batch = []
     proj_sift_batch = []
     proj_rgb_batch = []
 
     INT32_MAX = 2147483647
     INT32_MIN = -2147483648
-    crxy = tf.random_uniform([bsz,2],minval=0.,maxval=1.,seed=niter)
+    if aug is None:
+        aug = rand_aug(bsz*ncrops,niter)
 
     for i in range(bsz):
         # load data from files
@@ -124,7 +143,17 @@ def load_proj_bch(camera_paths,pcl_xyz_paths,pcl_sift_paths,pcl_rgb_paths,
         pcl_xyz = load_bin_file(pcl_xyz_paths[i],tf.float32,[-1,3])
         pcl_sift = tf.cast(load_bin_file(pcl_sift_paths[i],tf.uint8,[-1,128]),tf.float32)
         pcl_rgb = tf.cast(load_bin_file(pcl_rgb_paths[i],tf.uint8,[-1,3]),tf.float32)
-        sc,_,cry,crx = scale_crop(h,w,crxy[i],crsz,scsz,isval,niter)
+
+        # randomly subsample pcl
+        if pct_pts[0] < 100.:
+            if pts_seed is None:
+                rnd = tf.random_uniform([tf.shape(pcl_xyz)[0]+1],seed=niter*bsz+i)
+            else:
+                rnd = tf.random.stateless_uniform([tf.shape(pcl_xyz)[0]+1],tf.stack([pts_seed[i],0]))
+            keep = tf.less(rnd[1:],(pct_pts[0]+rnd[0]*(pct_pts[1]-pct_pts[0]))/100.)
+            pcl_xyz = tf.boolean_mask(pcl_xyz,keep)
+            pcl_sift = tf.boolean_mask(pcl_sift,keep)
+            pcl_rgb = tf.boolean_mask(pcl_rgb,keep)
 
         # project pcl
         P = tf.matmul(K,tf.concat((R,T),axis=1))
@@ -143,55 +172,83 @@ def load_proj_bch(camera_paths,pcl_xyz_paths,pcl_sift_paths,pcl_rgb_paths,
         proj_y = tf.boolean_mask(y,mask)
         proj_z = tf.boolean_mask(z,mask)
 
-        proj_depth = tf.expand_dims(proj_z,axis=1)
-        proj_sift = tf.boolean_mask(pcl_sift,mask,axis=0)
-        proj_rgb = tf.boolean_mask(pcl_rgb,mask,axis=0)
-
-        # scale pcl
-        proj_x = tf.round(proj_x*sc)
-        proj_y = tf.round(proj_y*sc)
-        h *= sc
-        w *= sc
-
-        #################
         # sort proj tensor by depth (descending order)
         _,inds_global_sort = tf.nn.top_k(-1.*proj_z,k=tf.shape(proj_z)[0])
         proj_x = tf.gather(proj_x,inds_global_sort)
         proj_y = tf.gather(proj_y,inds_global_sort)
-
-        # per pixel depth buffer
-        seg_ids = tf.cast(proj_x*tf.cast(w,tf.float32) + proj_y, tf.int32)
-        data = tf.range(tf.shape(seg_ids)[0])
-        inds_pix_sort = tf.unsorted_segment_min(data,seg_ids,tf.reduce_max(seg_ids))
-        inds_pix_sort = tf.boolean_mask(inds_pix_sort,tf.less(inds_pix_sort,INT32_MAX))
-
-        proj_depth = tf.gather(tf.gather(proj_depth,inds_global_sort),inds_pix_sort)
-        proj_sift = tf.gather(tf.gather(proj_sift,inds_global_sort),inds_pix_sort)
-        proj_rgb = tf.gather(tf.gather(proj_rgb,inds_global_sort),inds_pix_sort)
-
-        h = tf.cast(h,tf.int32)
-        w = tf.cast(w,tf.int32) 
-        proj_yx = tf.cast(tf.concat((proj_y[:,None],proj_x[:,None]),axis=1),tf.int32)
-        proj_yx = tf.gather(proj_yx,inds_pix_sort)
-
-        proj_depth = tf.scatter_nd(proj_yx,proj_depth,[h,w,1])
-        proj_sift = tf.scatter_nd(proj_yx,proj_sift,[h,w,128])
-        proj_rgb = tf.scatter_nd(proj_yx,proj_rgb,[h,w,3])
-        ################
-
-        # crop proj
-        proj_depth = proj_depth[cry:cry+crsz,crx:crx+crsz,:]
-        proj_sift = proj_sift[cry:cry+crsz,crx:crx+crsz,:]
-        proj_rgb = proj_rgb[cry:cry+crsz,crx:crx+crsz,:]
-
-        # randomly flip proj
-        if not isval:
-            proj_depth = tf.image.random_flip_left_right(proj_depth,seed=niter)
-            proj_sift = tf.image.random_flip_left_right(proj_sift,seed=niter)
-            proj_rgb = tf.image.random_flip_left_right(proj_rgb,seed=niter)
-
-        proj_depth_batch.append(proj_depth)
-        proj_rgb_batch.append(proj_rgb)
-        proj_sift_batch.append(proj_sift)
-    
+        pcl_depth = tf.gather(tf.expand_dims(proj_z,axis=1),inds_global_sort)
+        pcl_sift = tf.gather(tf.boolean_mask(pcl_sift,mask,axis=0),inds_global_sort)
+        pcl_rgb = tf.gather(tf.boolean_mask(pcl_rgb,mask,axis=0),inds_global_sort)
+
+        for k in range(ncrops):
+            a = aug[i*ncrops+k]
+            sc,_,cry,crx = scale_crop(h,w,a,crsz,scsz,isval)
+
+            # scale pcl
+            sc_x = tf.round(proj_x*sc)
+            sc_y = tf.round(proj_y*sc)
+
+            #################
+            # per pixel depth buffer
+            seg_ids = tf.cast(sc_x*tf.cast(w*sc,tf.float32) + sc_y, tf.int32)
+            data = tf.range(tf.shape(seg_ids)[0])
+            inds_pix_sort = tf.unsorted_segment_min(data,seg_ids,tf.reduce_max(seg_ids))
+            inds_pix_sort = tf.boolean_mask(inds_pix_sort,tf.less(inds_pix_sort,INT32_MAX))
+
+            proj_depth = tf.gather(pcl_depth,inds_pix_sort)
+            proj_sift = tf.gather(pcl_sift,inds_pix_sort)
+            proj_rgb = tf.gather(pcl_rgb,inds_pix_sort)
+            proj_yx = tf.cast(tf.concat((sc_y[:,None],sc_x[:,None]),axis=1),tf.int32)
+            proj_yx = tf.gather(proj_yx,inds_pix_sort)
+
+            # crop & randomly flip proj
+            proj_yx = proj_yx - tf.stack([cry,crx])
+            in_crop = tf.reduce_all(tf.logical_and(tf.greater_equal(proj_yx,0),tf.less(proj_yx,crsz)),axis=1)
+            proj_yx = tf.boolean_mask(proj_yx,in_crop)
+            proj_depth = tf.boolean_mask(proj_depth,in_crop)
+            proj_sift = tf.boolean_mask(proj_sift,in_crop)
+            proj_rgb = tf.boolean_mask(proj_rgb,in_crop)
+            if not isval:
+                flip = tf.less(a[3],.5)
+                proj_yx = tf.where(flip,tf.stack((proj_yx[:,0],crsz-1-proj_yx[:,1]),axis=1),proj_yx)
+
+            if sparse:
+                proj_yx_batch.append(proj_yx)
+            else:
+                proj_depth = tf.scatter_nd(proj_yx,proj_depth,[crsz,crsz,1])
+                proj_sift = tf.scatter_nd(proj_yx,proj_sift,[crsz,crsz,128])
+                proj_rgb = tf.scatter_nd(proj_yx,proj_rgb,[crsz,crsz,3])
+            ################
+
+            proj_depth_batch.append(proj_depth)
+            proj_rgb_batch.append(proj_rgb)
+            proj_sift_batch.append(proj_sift)
+
+    if sparse:
+        return proj_yx_batch, proj_depth_batch, proj_sift_batch, proj_rgb_batch
     return proj_depth_batch, proj_sift_batch, proj_rgb_batch
+
+
+# Shuffle buffer that mixes the ncrops crops of each loaded sample across
+# training batches. Validation batches go through a separate FIFO queue
+# holding only the first crop of each sample (feed {isval: True}).
+class crop_queue:
+    def __init__(self,crops,shapes,bsz,ncrops,nbuf=4,seed=0):
+        self.bsz = bsz
+        self.min = nbuf*bsz*ncrops
+        dtypes = [c.dtype for c in crops]
+        self.tq = tf.RandomShuffleQueue(self.min+2*bsz*ncrops,self.min,dtypes,shapes,seed=seed)
+        self.vq = tf.FIFOQueue(2*bsz,dtypes,shapes)
+        self.tenq = self.tq.enqueue_many(crops)
+        self.venq = self.vq.enqueue_many([c[::ncrops] for c in crops])
+        self.size = self.tq.size()
+        self.isval = tf.placeholder_with_default(False,[])
+        self.out = tf.cond(self.isval,lambda: self.vq.dequeue_many(bsz),lambda: self.tq.dequeue_many(bsz))
+
+    # Load samples (feeds from getfeed()) until a batch can be dequeued
+    def fill(self,sess,getfeed):
+        while sess.run(self.size) < self.min+self.bsz:
+            try: # prevent occasional failure when no pts in projection
+                sess.run(self.tenq,feed_dict=getfeed())
+            except tf.errors.InvalidArgumentError:
+                pass
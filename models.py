@@ -24,35 +24,104 @@
 # Contains all model definitions
 # Author: Francesco Pittaluga
 
+import json
 import tensorflow as tf
 import numpy as np
 
+# Write weights as one raw tensor blob (FNAME.bin) plus a JSON index
+# (FNAME.json) of per-tensor offset, shape & dtype
+def save_blob(fname,wts,dtype=np.float32):
+    idx = {}; off = 0
+    with open(fname+'.bin','wb') as f:
+        for k in sorted(wts.keys()):
+            a = np.ascontiguousarray(wts[k],dtype=dtype)
+            pad = -off % 64
+            f.write(b'\0'*pad); off += pad
+            idx[k] = {'offset':off,'shape':list(a.shape),'dtype':a.dtype.str}
+            a.tofile(f); off += a.nbytes
+    with open(fname+'.json','w') as f:
+        json.dump(idx,f,indent=1)
+
+# Read weights from an npz file, from part PART of a checkpoint bundle given
+# as FILE.npz:PART (see utils.bundle_ckpter) or from a blob's JSON index
+# (memory-mapped, tensors are read lazily from the page cache)
+def load_wts(fname):
+    if '.npz:' in fname:
+        fname,part = fname.rsplit(':',1)
+        wts = np.load(fname)
+        return {k[len(part)+1:]:wts[k] for k in wts.files if k.startswith(part+':')}
+    if not fname.endswith('.json'):
+        return np.load(fname)
+    with open(fname) as f:
+        idx = json.load(f)
+    buf = np.memmap(fname[:-len('.json')]+'.bin',dtype=np.uint8,mode='r')
+    return {k:np.ndarray(v['shape'],np.dtype(v['dtype']),buf,v['offset'])
+            for k,v in idx.items()}
+
 # Base Model
 class Net(object):
 
     def __init__(self):
         self.weights = {}
+        self.load_ops = {}
     
     # Save weights to an npz file
     def save(self,sess,fname):
-        wts = {k:sess.run(v) for k,v in self.weights.items()}
+        wts = self.snapshot(sess)
         np.savez(fname,**wts)
         return wts
+
+    # Current values of all weights, fetched in one run
+    def snapshot(self,sess):
+        return sess.run(self.weights)
     
-    # Load weights from an npz file
+    # Load weights from an npz file or a blob index (see save_blob). Values
+    # are fed to placeholder-backed assign ops that are built once per
+    # variable, so repeated loads do not grow the graph.
     def load(self,sess,fname=None):
-        wts = np.load(fname)
-        ops = [v.assign(wts[k].astype(np.float32)).op
-               for k,v in self.weights.items() if k in wts]
-        if len(ops) > 0:
-            sess.run(ops)
+        wts = load_wts(fname)
+        keys = [k for k in self.weights.keys() if k in wts]
+        if len(keys) == 0:
+            return
+        with sess.graph.as_default():
+            for k in keys:
+                if k not in self.load_ops:
+                    v = self.weights[k]
+                    ph = tf.placeholder(v.dtype.base_dtype,v.get_shape())
+                    self.load_ops[k] = (ph,v.assign(ph).op)
+        sess.run([self.load_ops[k][1] for k in keys],
+                 feed_dict={self.load_ops[k][0]:wts[k].astype(np.float32,copy=False) for k in keys})
 
     # Get all trainable weights
     def trainable_variables(self):  
         return {v:k for k,v in self.weights.items() if v in tf.trainable_variables()}
 
+
+# Sparse projection tensor: per-point [b,y,x] indices, per-point features,
+# per-channel value of empty pixels and [b,h,w,c] shape of the dense tensor
+class SparseInp(object):
+
+    def __init__(self,inds,vals,bg,shape):
+        self.inds = inds
+        self.vals = vals
+        self.bg = tf.convert_to_tensor(bg,dtype=tf.float32)
+        self.shape = shape
+
+    def get_shape(self):
+        return tf.TensorShape([s if isinstance(s,int) else None for s in self.shape])
+
+    # Equivalent dense tensor
+    def to_dense(self):
+        dense = tf.scatter_nd(self.inds,self.vals-self.bg,tf.stack(self.shape))
+        return dense + self.bg
+
             
-# Base Model for VisibNet, CaarseNet and RefineNet
+# Base Model for VisibNet, CaarseNet and RefineNet. WIDTH scales the number
+# of channels of all but the output layer; SEP replaces all but the first
+# conv by a depthwise conv followed by a 1x1 conv. RECOMPUTE keeps only the
+# outputs of each encoder layer and of each group of ~sqrt(depth) decoder
+# layers for backprop, and rebuilds the activations in between on the
+# backward pass.
 class InvNet(Net):
     def __init__(self, inp,
                  bn='train',
@@ -60,69 +129,154 @@ class InvNet(Net):
                  dch = [512,512,512,256,256,256,128,64,32,3],
                  skip_conn = 6,
                  conv_act = 'relu',
-                 outp_act = 'tanh'):
+                 outp_act = 'tanh',
+                 wts = None,
+                 width = 1.,
+                 sep = False,
+                 recompute = False):
 
         super().__init__()
+        ech = [max(int(round(c*width)),1) for c in ech]
+        dch = [max(int(round(c*width)),1) for c in dch[:-1]]+dch[-1:]
         self.bn = bn
+        self.sep = sep
+        self.recompute = recompute and wts is None and bn != 'set'
+        self.bn_outs = {}
         self.weights = {}
-        self.ifdo = tf.Variable(False,dtype=tf.bool)
-        self.set_ifdo = self.ifdo.assign(True).op
-        self.unset_ifdo = self.ifdo.assign(False).op
+        self.wts = wts
+        if wts is None:
+            self.ifdo = tf.Variable(False,dtype=tf.bool)
+            self.set_ifdo = self.ifdo.assign(True).op
+            self.unset_ifdo = self.ifdo.assign(False).op
         
         #Encoder
         out = inp; skip = [out]
         for i in range(len(ech)):
-            out = self.conv(out,4,ech[i],2,True,1.,conv_act,'ec%d'%i)
+            out = self.block(out,[('ec%d'%i,4,ech[i],2,True,1.,conv_act,False,None)])
             skip.append(out)
         skip = list(reversed(skip))[1:]
                 
         # Decoder
-        for i in range(len(dch)-1):
-            if i<len(ech): out = tf.image.resize_images(out,tf.shape(out)[1:3]*2,method=1)
-            out = self.conv(out,3,dch[i],1,True,.5 if i<3 else 1.,conv_act,'dc%d'%i)
-            if i<skip_conn: out = tf.concat((skip[i],out),axis=3) 
+        lyrs = [('dc%d'%i,3,dch[i],1,True,.5 if i<3 else 1.,conv_act,i<len(ech),skip[i] if i<skip_conn else None)
+                for i in range(len(dch)-1)]
+        nseg = int(np.ceil(np.sqrt(len(lyrs)))) if self.recompute else len(lyrs)
+        for i in range(0,len(lyrs),nseg):
+            out = self.block(out,lyrs[i:i+nseg])
         self.pred = self.conv(out,3,dch[-1],1,False,1.,outp_act,'dc%d'%(len(dch)-1))
 
+    # Apply layers LYRS, each (nm,ksz,nch,stride,bn,rate,act,up,skip) with UP
+    # a 2x upsampling before the conv and SKIP a tensor concatenated after it.
+    # In recompute mode only the input & output of the block are kept.
+    def block(self,out,lyrs):
+        if not self.recompute or isinstance(out,SparseInp):
+            for nm,ksz,nch,stride,bn,rate,act,up,skip in lyrs:
+                if up: out = tf.image.resize_images(out,tf.shape(out)[1:3]*2,method=1)
+                out = self.conv(out,ksz,nch,stride,bn,rate,act,nm)
+                if skip is not None: out = tf.concat((skip,out),axis=3)
+            return out
+
+        # Everything the block reads is an explicit input: variables, skip
+        # tensors, and the dropout seeds that make recomputation reproducible
+        ins = {'ifdo': self.ifdo}
+        cin = out.get_shape().as_list()[-1]
+        for nm,ksz,nch,stride,bn,rate,act,up,skip in lyrs:
+            ins.update(self.conv_wts(cin,ksz,nch,bn,nm))
+            cin = nch
+            if rate < 1:
+                ins['%s_seed'%nm] = tf.random_uniform([2],maxval=2**31-1,dtype=tf.int32)
+            if skip is not None:
+                ins['%s_skip'%nm] = skip
+                cin += skip.get_shape().as_list()[-1]
+        keys = sorted(ins)
+
+        def fwd(x,*vals):
+            W = dict(zip(keys,vals))
+            for nm,ksz,nch,stride,bn,rate,act,up,skip in lyrs:
+                if up: x = tf.image.resize_images(x,tf.shape(x)[1:3]*2,method=1)
+                x = self.conv_apply(x,W,stride,bn,rate,act,nm)
+                if skip is not None: x = tf.concat((W['%s_skip'%nm],x),axis=3)
+            return x
+
+        @tf.custom_gradient
+        def recomp(x,*vals):
+            def grad(dy):
+                with tf.control_dependencies([dy]):
+                    xs = [tf.identity(v) for v in (x,)+vals]
+                return tf.gradients(fwd(*xs),xs,grad_ys=dy)
+            return fwd(x,*vals), grad
+
+        return recomp(*[tf.identity(t) for t in [out]+[ins[k] for k in keys]])
         
     # Covolutional layer with Batchnorm, Bias, Dropout  & Activation
     def conv(self,inp,ksz,nch,stride,bn,rate,act,nm):
+        if self.wts is not None:
+            return self.frozen_conv(inp,stride,bn,act,nm)
+        self.conv_wts(inp.get_shape().as_list()[-1],ksz,nch,bn,nm)
+        return self.conv_apply(inp,self.weights,stride,bn,rate,act,nm)
+
+    # Create the variables of conv layer NM, returned by name
+    def conv_wts(self,cin,ksz,nch,bn,nm):
+        ksz = [ksz,ksz,cin,nch]
+        if self.sep and nm != 'ec0':
+            sq = np.sqrt(3.0 / np.float32(ksz[0]*ksz[1]))
+            self.weights['%s_dw'%nm] = tf.Variable(tf.random_uniform(ksz[:3]+[1],minval=-sq,maxval=sq,dtype=tf.float32))
+            sq = np.sqrt(3.0 / np.float32(ksz[2]))
+            self.weights['%s_w'%nm] = tf.Variable(tf.random_uniform([1,1]+ksz[2:],minval=-sq,maxval=sq,dtype=tf.float32))
+        else:
+            sq = np.sqrt(3.0 / np.float32(ksz[0]*ksz[1]*ksz[2]))
+            self.weights['%s_w'%nm] = tf.Variable(tf.random_uniform(ksz,minval=-sq,maxval=sq,dtype=tf.float32))
+        if bn and (self.bn=='set' or self.bn=='test'):
+            self.weights['%s_mn'%nm] = tf.Variable(tf.zeros([nch],dtype=tf.float32))
+            self.weights['%s_vr'%nm] = tf.Variable(tf.ones([nch],dtype=tf.float32))
+        self.weights['%s_b'%nm] = tf.Variable(tf.zeros([nch],dtype=tf.float32))
+        return {k:v for k,v in self.weights.items() if k.startswith(nm+'_')}
+
+    # Conv layer NM computed from the weight tensors in W
+    def conv_apply(self,inp,W,stride,bn,rate,act,nm):
 
         # Conv
-        ksz = [ksz,ksz,inp.get_shape().as_list()[-1],nch]
-        sq = np.sqrt(3.0 / np.float32(ksz[0]*ksz[1]*ksz[2]))
-        self.weights['%s_w'%nm] = tf.Variable(tf.random_uniform(ksz,minval=-sq,maxval=sq,dtype=tf.float32))
-        out = tf.pad(inp,[[0,0],[1,1],[1,1],[0,0]],'REFLECT')
-        out = tf.nn.conv2d(out,self.weights['%s_w'%nm],[1,stride,stride,1],'VALID')
+        if '%s_dw'%nm in W:
+            out = tf.pad(inp,[[0,0],[1,1],[1,1],[0,0]],'REFLECT')
+            out = tf.nn.separable_conv2d(out,W['%s_dw'%nm],W['%s_w'%nm],
+                                         [1,stride,stride,1],'VALID')
+        elif isinstance(inp,SparseInp):
+            out = self.sparse_conv(inp,W['%s_w'%nm],stride)
+        else:
+            out = tf.pad(inp,[[0,0],[1,1],[1,1],[0,0]],'REFLECT')
+            out = tf.nn.conv2d(out,W['%s_w'%nm],[1,stride,stride,1],'VALID')
 
-        # Batchnorm
+        # Batchnorm ('sample' uses per-sample statistics, i.e. 'train' at batch size 1)
         if bn:
-            if self.bn=='train' or self.bn=='set':
+            if self.bn=='train' or self.bn=='set' or self.bn=='sample':
                 axis = list(range(len(out.get_shape().as_list())-1))
-                wmn = tf.reduce_mean(out,axis)
-                wvr = tf.reduce_mean(tf.squared_difference(out,wmn),axis)
+                if self.bn=='sample': axis = axis[1:]
+                wmn = tf.reduce_mean(out,axis,keepdims=self.bn=='sample')
+                wvr = tf.reduce_mean(tf.squared_difference(out,wmn),axis,keepdims=self.bn=='sample')
                 out = tf.nn.batch_normalization(out,wmn,wvr,None,None,1e-3)
 
                 if self.bn=='set':
-                    self.weights['%s_mn'%nm] = tf.Variable(tf.zeros([nch],dtype=tf.float32))
-                    self.weights['%s_vr'%nm] = tf.Variable(tf.ones([nch],dtype=tf.float32))
                     self.bn_outs['%s_mn'%nm] = wmn
                     self.bn_outs['%s_vr'%nm] = wvr
                     
             if self.bn=='test':
-                self.weights['%s_mn'%nm] = tf.Variable(tf.zeros([nch],dtype=tf.float32))
-                self.weights['%s_vr'%nm] = tf.Variable(tf.ones([nch],dtype=tf.float32))
-                out = tf.nn.batch_normalization(out,self.weights['%s_mn'%nm],
-                                                self.weights['%s_vr'%nm],None,None,1e-3)
+                out = tf.nn.batch_normalization(out,W['%s_mn'%nm],
+                                                W['%s_vr'%nm],None,None,1e-3)
                 
         # Bias
-        self.weights['%s_b'%nm] = tf.Variable(tf.zeros([nch],dtype=tf.float32))
-        out = out + self.weights['%s_b'%nm]
+        out = out + W['%s_b'%nm]
 
-        # Dropout
+        # Dropout (stateless when seeded, so that recomputation draws the same mask)
         if rate < 1:
-            out = tf.cond(self.ifdo, lambda: tf.nn.dropout(out,rate), lambda: out)
+            if '%s_seed'%nm in W:
+                keep = tf.to_float(tf.random.stateless_uniform(tf.shape(out),W['%s_seed'%nm]) < rate)
+                out = tf.cond(W['ifdo'], lambda: out*keep/rate, lambda: out)
+            else:
+                out = tf.cond(self.ifdo, lambda: tf.nn.dropout(out,rate), lambda: out)
         
-        # Activation
+        return self.activ(out,act)
+
+    # Activation
+    def activ(self,out,act):
         if act=='relu':
             out = tf.nn.relu(out)
         elif act=='lrelu':
@@ -134,11 +288,78 @@ class InvNet(Net):
             
         return out
 
+    # Covolutional layer with constant weights from self.wts, test-mode
+    # batchnorm folded into weights & bias, and no dropout
+    def frozen_conv(self,inp,stride,bn,act,nm):
+        w = self.wts['%s_w'%nm].astype(np.float32)
+        b = self.wts['%s_b'%nm].astype(np.float32)
+        if bn and self.bn=='test':
+            sd = 1./np.sqrt(self.wts['%s_vr'%nm].astype(np.float32)+1e-3)
+            w = w*sd
+            b = b-self.wts['%s_mn'%nm].astype(np.float32)*sd
+
+        # Conv
+        if '%s_dw'%nm in self.wts:
+            out = tf.pad(inp,[[0,0],[1,1],[1,1],[0,0]],'REFLECT')
+            out = tf.nn.separable_conv2d(out,tf.constant(self.wts['%s_dw'%nm].astype(np.float32)),
+                                         tf.constant(w),[1,stride,stride,1],'VALID')
+        elif isinstance(inp,SparseInp):
+            out = self.sparse_conv(inp,tf.constant(w),stride)
+        else:
+            out = tf.pad(inp,[[0,0],[1,1],[1,1],[0,0]],'REFLECT')
+            out = tf.nn.conv2d(out,tf.constant(w),[1,stride,stride,1],'VALID')
+
+        # Batchnorm (batch statistics)
+        if bn and self.bn!='test':
+            axis = [1,2] if self.bn=='sample' else [0,1,2]
+            wmn = tf.reduce_mean(out,axis,keepdims=True)
+            wvr = tf.reduce_mean(tf.squared_difference(out,wmn),axis,keepdims=True)
+            out = tf.nn.batch_normalization(out,wmn,wvr,None,None,1e-3)
+
+        return self.activ(out+tf.constant(b),act)
+
+    # Reflect-padded convolution of a SparseInp. Empty pixels hold the constant
+    # bg, so their response is the same at every output. Each point (plus its
+    # mirrored copies in the padded border) adds its response to the outputs
+    # its kernel taps land on. Equivalent to the dense path for unique pixels.
+    def sparse_conv(self,inp,w,stride):
+        ksz = w.get_shape().as_list()
+        bsz,h,wd = inp.shape[:3]
+        ho = (h+2-ksz[0])//stride+1
+        wo = (wd+2-ksz[1])//stride+1
+        b,y,x = tf.unstack(inp.inds,axis=1)
+        vals = inp.vals - inp.bg
+
+        # padded coordinate & mask of each copy of a point along one axis
+        def refl(c,n):
+            return [(c+1,tf.ones_like(c,dtype=tf.bool)),
+                    (tf.zeros_like(c),tf.equal(c,1)),
+                    (tf.ones_like(c)*(n+1),tf.equal(c,n-2))]
+
+        inds = []; outs = []
+        for py,my in refl(y,h):
+            for px,mx in refl(x,wd):
+                m = tf.logical_and(my,mx)
+                for i in range(ksz[0]):
+                    for j in range(ksz[1]):
+                        oy = py-i; ox = px-j
+                        sel = tf.logical_and(tf.logical_and(m,tf.equal(oy%stride,0)),tf.equal(ox%stride,0))
+                        oy = oy//stride; ox = ox//stride
+                        sel = tf.logical_and(sel,tf.logical_and(tf.logical_and(oy>=0,oy<ho),
+                                                                tf.logical_and(ox>=0,ox<wo)))
+                        inds.append(tf.boolean_mask(tf.stack((b,oy,ox),axis=1),sel))
+                        outs.append(tf.matmul(tf.boolean_mask(vals,sel),w[i,j]))
+
+        out = tf.scatter_nd(tf.concat(inds,axis=0),tf.concat(outs,axis=0),tf.stack([bsz,ho,wo,ksz[3]]))
+        out = out + tf.tensordot(inp.bg,tf.reduce_sum(w,[0,1]),1)
+        out.set_shape([s if isinstance(s,int) else None for s in [bsz,ho,wo]]+[ksz[3]])
+        return out
+
     
 # VisibNet 
 class VisibNet(InvNet):
     
-    def __init__(self,inp,bn='train',outp_act=True):
+    def __init__(self,inp,bn='train',outp_act=True,wts=None,width=1.,sep=False,recompute=False):
 
         if inp.get_shape().as_list()[-1] < 5:
             ech = [64,128,256,512,512,512]
@@ -150,31 +371,43 @@ class VisibNet(InvNet):
                          dch = [512,512,512,256,256,256,128,64,32,1],
                          skip_conn = 6,
                          conv_act = 'relu',
-                         outp_act = 'sigm' if outp_act else None)
+                         outp_act = 'sigm' if outp_act else None,
+                         wts = wts,
+                         width = width,
+                         sep = sep,
+                         recompute = recompute)
 
 # CoarseNet 
 class CoarseNet(InvNet):
     
-    def __init__(self,inp,bn='train',outp_act=True):
+    def __init__(self,inp,bn='train',outp_act=True,wts=None,width=1.,sep=False,recompute=False):
 
         super().__init__(inp,bn=bn,
                          ech = [256,256,256,512,512,512],
                          dch = [512,512,512,256,256,256,128,64,32,3],
                          skip_conn = 6,
                          conv_act = 'relu',
-                         outp_act = 'tanh' if outp_act else None)
+                         outp_act = 'tanh' if outp_act else None,
+                         wts = wts,
+                         width = width,
+                         sep = sep,
+                         recompute = recompute)
 
 # RefineNet 
 class RefineNet(InvNet):
     
-    def __init__(self,inp,bn='train',outp_act=True):
+    def __init__(self,inp,bn='train',outp_act=True,wts=None,width=1.,sep=False,recompute=False):
 
         super().__init__(inp,bn=bn,
                          ech = [256,256,256,512,512,512],
                          dch = [512,512,512,256,256,256,128,64,32,3],
                          skip_conn = 4,
                          conv_act = 'lrelu',
-                         outp_act = 'tanh' if outp_act else None)
+                         outp_act = 'tanh' if outp_act else None,
+                         wts = wts,
+                         width = width,
+                         sep = sep,
+                         recompute = recompute)
 
 
 # Convolutional layers of VGG16
@@ -0,0 +1,276 @@
+# Copyright (c) Microsoft Corporation.
+# Copyright (c) University of Florida Research Foundation, Inc.
+# Licensed under the MIT License.
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in 
+# the Software without restriction, including without limitation the rights to 
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies 
+# of the Software, and to permit persons to whom the Software is furnished to do 
+# so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR 
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, 
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER 
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING 
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS 
+# IN THE SOFTWARE.
+#
+# pipeline.py
+# Reusable inference pipeline for pre-trained VisibNet, CoarseNet & RefineNet
+# Author: Francesco Pittaluga
+
+import os
+import numpy as np
+import tensorflow as tf
+from models import VisibNet
+from models import CoarseNet
+from models import RefineNet
+from models import load_wts
+
+# Builds the graph, loads weights and warms up once, then runs any number
+# of batches of projections (proj_depth, proj_rgb, proj_sift) as produced by
+# load_data.project_points. Outputs are VisibNet masks, CoarseNet and
+# RefineNet predictions in [0,255] and the valid-point masks.
+#
+# With fold=True the weights are baked into the graph as constants, with
+# test-mode batchnorm folded into the conv weights and dropout removed.
+# With frozen_fp the graph is instead imported from a GraphDef written by
+# export_graph.py (wts_dir, input_attr and crop_size are then ignored).
+#
+# WIDTH & SEP select the architecture variant of the nets (see InvNet).
+#
+# With crop_size=None the graph takes inputs of any spatial size that is a
+# multiple of 64 (see infer_full).
+#
+# STAGES selects how far to run the chain: 'visib' (VisibNet only), 'coarse'
+# (VisibNet -> CoarseNet) or 'refine' (all three). Later nets are then neither
+# built nor loaded. Every stage also returns per-view visib_ratio, the
+# fraction of valid points predicted visible.
+#
+# RefineNet normalizes with per-sample statistics by default; refine_bn='test'
+# uses the running statistics calib_bn.py writes to refinenet_bn.model
+# instead, which makes outputs independent of the rest of the batch.
+class InvSFM(object):
+
+    def __init__(self,input_attr='depth_sift_rgb',crop_size=512,batch_size=8,
+                 wts_dir='wts/pretrained',warmup=True,fold=False,frozen_fp=None,
+                 refine_bn='sample',width=1.,sep=False,stages='refine'):
+        self.input_attr = input_attr
+        self.nets = ['visibnet','coarsenet','refinenet'][:['visib','coarse','refine'].index(stages)+1]
+        self.arch = {'width':width,'sep':sep}
+        self.refine_bn = refine_bn
+        self.crop_size = crop_size
+        self.batch_size = batch_size
+
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            if frozen_fp is not None:
+                self.import_frozen(frozen_fp)
+            elif fold:
+                self.build(self.read_wts(wts_dir))
+            else:
+                self.build()
+
+            # Start TF session (respecting OMP_NUM_THREADS)
+            nthr = os.getenv('OMP_NUM_THREADS')
+            if nthr is None: self.sess = tf.Session()
+            else: self.sess = tf.Session(config=tf.ConfigProto(intra_op_parallelism_threads=int(nthr)))
+            if frozen_fp is None and not fold:
+                self.load(wts_dir)
+
+        if warmup:
+            crop_size = self.crop_size or 64
+            z = np.zeros([1,crop_size,crop_size,1],dtype=np.float32)
+            self.infer(z,np.zeros(z.shape[:3]+(3,),np.uint8),np.zeros(z.shape[:3]+(128,),np.uint8))
+
+    # Build VisibNet -> CoarseNet -> RefineNet (with constant weights if
+    # WTS, a dict of numpy weight dicts per net, is given)
+    def build(self,wts=None):
+        if wts is None: wts = {k:None for k in self.nets}
+        self.cnet = self.rnet = None
+        crsz = self.crop_size
+        self.proj_depth_p = tf.placeholder(tf.float32,shape=[None,crsz,crsz,1],name='proj_depth')
+        self.proj_rgb_p = tf.placeholder(tf.uint8,shape=[None,crsz,crsz,3],name='proj_rgb')
+        self.proj_sift_p = tf.placeholder(tf.uint8,shape=[None,crsz,crsz,128],name='proj_sift')
+
+        pdepth = self.proj_depth_p
+        prgb = tf.to_float(self.proj_rgb_p)
+        psift = tf.to_float(self.proj_sift_p)
+        valid = tf.greater(pdepth,0.)
+
+        # set up visibnet
+        if self.input_attr=='depth':
+            vinp = pdepth
+        elif self.input_attr=='depth_rgb':
+            vinp = tf.concat((pdepth, prgb/127.5-1.),axis=3)
+        elif self.input_attr=='depth_sift':
+            vinp = tf.concat((pdepth, psift/127.5-1.),axis=3)
+        elif self.input_attr=='depth_sift_rgb':
+            vinp = tf.concat((pdepth, psift/127.5-1., prgb/127.5-1.),axis=3)
+        self.vnet = VisibNet(vinp,bn='test',wts=wts['visibnet'],**self.arch)
+        vpred = tf.logical_and(tf.greater(self.vnet.pred,.5),valid)
+        vpredf = tf.to_float(vpred)*0.+1.
+
+        # scale outputs (named for lookup in exported graphs)
+        nvalid = tf.reduce_sum(tf.to_float(valid),[1,2,3])
+        self.outs = {'visib': tf.identity(vpred,name='visib'),
+                     'valid': tf.identity(valid,name='valid'),
+                     'visib_ratio': tf.identity(tf.reduce_sum(tf.to_float(vpred),[1,2,3])/
+                                                tf.maximum(nvalid,1.),name='visib_ratio')}
+        if 'coarsenet' not in self.nets: return
+
+        # set up coarsenet
+        if self.input_attr=='depth':
+            cinp = pdepth*vpredf
+        elif self.input_attr=='depth_rgb':
+            cinp = tf.concat((pdepth*vpredf, prgb*vpredf/127.5-1.),axis=3)
+        elif self.input_attr=='depth_sift':
+            cinp = tf.concat((pdepth*vpredf, psift*vpredf/127.5-1.),axis=3)
+        elif self.input_attr=='depth_sift_rgb':
+            cinp = tf.concat((pdepth*vpredf, psift*vpredf/127.5-1., prgb*vpredf/127.5-1.),axis=3)
+        self.cnet = CoarseNet(cinp,bn='test',wts=wts['coarsenet'],**self.arch)
+        cpred = self.cnet.pred
+        self.outs['coarse'] = tf.identity((cpred+1.)*127.5,name='coarse')
+        if 'refinenet' not in self.nets: return
+
+        # set up refinenet (by default per-sample batchnorm statistics, as at batch size 1)
+        rinp = tf.concat((cpred,cinp),axis=3)
+        self.rnet = RefineNet(rinp,bn=self.refine_bn,wts=wts['refinenet'],**self.arch)
+        rpred = self.rnet.pred
+        self.outs['refine'] = tf.identity((rpred+1.)*127.5,name='refine')
+
+    # Import a serialized GraphDef written by export_graph.py
+    def import_frozen(self,frozen_fp):
+        gd = tf.GraphDef()
+        with open(frozen_fp,'rb') as f:
+            gd.ParseFromString(f.read())
+        tf.import_graph_def(gd,name='')
+        self.proj_depth_p = self.graph.get_tensor_by_name('proj_depth:0')
+        self.proj_rgb_p = self.graph.get_tensor_by_name('proj_rgb:0')
+        self.proj_sift_p = self.graph.get_tensor_by_name('proj_sift:0')
+        self.crop_size = self.proj_depth_p.get_shape().as_list()[1]
+        names = [op.name for op in self.graph.get_operations()]
+        self.outs = {k:self.graph.get_tensor_by_name(k+':0')
+                     for k in ['visib','coarse','refine','valid','visib_ratio'] if k in names}
+
+    # Read net wts from WTS_DIR/INPUT_ATTR into numpy dicts
+    def read_wts(self,wts_dir):
+        wts = {}
+        for k in self.nets:
+            f = load_wts(self.wts_path(wts_dir,k))
+            wts[k] = {n:f[n] for n in f.keys()}
+        return wts
+
+    # Path of net wts in WTS_DIR/INPUT_ATTR (blob index if converted, else npz).
+    # With refine_bn='test', RefineNet wts are read from the calibrated copy.
+    def wts_path(self,wts_dir,net):
+        if net == 'refinenet' and self.refine_bn == 'test':
+            net = 'refinenet_bn'
+        fp = '{}/{}/{}.model'.format(wts_dir,self.input_attr,net)
+        fp = fp+'.json' if os.path.isfile(fp+'.json') else fp+'.npz'
+        if net == 'refinenet_bn':
+            if not os.path.isfile(fp) or not any(k.endswith('_mn') for k in load_wts(fp).keys()):
+                raise ValueError("{} has no batchnorm statistics, run calib_bn.py --input_attr {} "
+                                 "before using refine_bn='test'".format(fp,self.input_attr))
+        return fp
+
+    # Load net wts from WTS_DIR/INPUT_ATTR
+    def load(self,wts_dir):
+        nets = dict(zip(['visibnet','coarsenet','refinenet'],[self.vnet,self.cnet,self.rnet]))
+        for k in self.nets:
+            nets[k].load(self.sess,self.wts_path(wts_dir,k))
+        self.sess.run([nets[k].unset_ifdo for k in self.nets])
+
+    # Run a batch of projections through the networks (in chunks of batch_size)
+    def infer(self,proj_depth,proj_rgb,proj_sift):
+        out = {k:[] for k in self.outs}
+        for i in range(0,len(proj_depth),self.batch_size):
+            j = i+self.batch_size
+            fd = {self.proj_depth_p:proj_depth[i:j],
+                  self.proj_rgb_p:proj_rgb[i:j],
+                  self.proj_sift_p:proj_sift[i:j]}
+            for k,v in self.sess.run(self.outs,feed_dict=fd).items():
+                out[k].append(v)
+        return {k:np.concatenate(v) for k,v in out.items()}
+
+    # Run an iterator of single projections (proj_depth, proj_rgb, proj_sift),
+    # batching them internally; yields one output dict per projection
+    def infer_stream(self,it):
+        bch = []
+        for x in it:
+            bch.append(x)
+            if len(bch) == self.batch_size:
+                for y in self._infer_list(bch): yield y
+                bch = []
+        if len(bch) > 0:
+            for y in self._infer_list(bch): yield y
+
+    # Run one projection of any size (proj_depth HxWx1, proj_rgb HxWx3,
+    # proj_sift HxWx128) as overlapping crop_size tiles, batch_size tiles at a
+    # time. Tile outputs are blended with weights that taper linearly over
+    # the overlap. Use refine_bn='test' to avoid per-tile RefineNet statistics.
+    def infer_tiled(self,proj_depth,proj_rgb,proj_sift,overlap=64):
+        tsz = self.crop_size
+        h, w = proj_depth.shape[:2]
+
+        # Pad with empty pixels up to at least one tile
+        ph, pw = max(h,tsz), max(w,tsz)
+        pad = [[0,ph-h],[0,pw-w],[0,0]]
+        inps = [np.pad(x,pad,'constant') for x in [proj_depth,proj_rgb,proj_sift]]
+
+        # Tile corners & blending weights
+        stride = max(tsz-overlap,1)
+        ys = sorted(set(list(range(0,ph-tsz,stride))+[ph-tsz]))
+        xs = sorted(set(list(range(0,pw-tsz,stride))+[pw-tsz]))
+        tiles = [(y,x) for y in ys for x in xs]
+        r = np.arange(tsz,dtype=np.float32)+.5
+        r = np.minimum(1.,np.minimum(r,tsz-r)/max(overlap,1))
+        wt = (r[:,None]*r[None,:])[...,None]
+
+        # Run tiles in batches & accumulate weighted outputs
+        acc = {k:np.zeros((ph,pw,1 if k=='visib' else 3),np.float32)
+               for k in ['visib','coarse','refine'] if k in self.outs}
+        wsum = np.zeros((ph,pw,1),np.float32)
+        for i in range(0,len(tiles),self.batch_size):
+            bch = tiles[i:i+self.batch_size]
+            out = self.infer(*[np.stack([a[y:y+tsz,x:x+tsz] for y,x in bch]) for a in inps])
+            for j,(y,x) in enumerate(bch):
+                for k in acc:
+                    acc[k][y:y+tsz,x:x+tsz] += wt*out[k][j]
+                wsum[y:y+tsz,x:x+tsz] += wt
+
+        out = {k:(v/wsum)[:h,:w] for k,v in acc.items()}
+        out['visib'] = out['visib'] > .5
+        out['valid'] = proj_depth > 0.
+        out['visib_ratio'] = np.sum(out['visib'] & out['valid'])/max(np.sum(out['valid']),1.)
+        return out
+
+    # Run lists of projections of any size (HxWx1, HxWx3, HxWx128 arrays)
+    # through a graph built with crop_size=None. Each is padded with empty
+    # pixels to a multiple of MULT, projections with the same padded shape are
+    # batched together and outputs are unpadded; returns one dict per input.
+    def infer_full(self,proj_depth,proj_rgb,proj_sift,mult=64):
+        bkts = {}
+        for i,x in enumerate(proj_depth):
+            bkts.setdefault(tuple(-(-s//mult)*mult for s in x.shape[:2]),[]).append(i)
+
+        outs = [None]*len(proj_depth)
+        for (ph,pw),inds in bkts.items():
+            pad = lambda x: np.pad(x,[[0,ph-x.shape[0]],[0,pw-x.shape[1]],[0,0]],'constant')
+            out = self.infer(*[np.stack([pad(a[i]) for i in inds]) for a in [proj_depth,proj_rgb,proj_sift]])
+            for j,i in enumerate(inds):
+                h, w = proj_depth[i].shape[:2]
+                outs[i] = {k:v[j,:h,:w] if v.ndim > 1 else v[j] for k,v in out.items()}
+        return outs
+
+    def _infer_list(self,bch):
+        out = self.infer(*[np.stack(x) for x in zip(*bch)])
+        return [{k:v[i] for k,v in out.items()} for i in range(len(bch))]
+
+    def close(self):
+        self.sess.close()
@@ -0,0 +1,198 @@
+# Copyright (c) Microsoft Corporation.
+# Copyright (c) University of Florida Research Foundation, Inc.
+# Licensed under the MIT License.
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in 
+# the Software without restriction, including without limitation the rights to 
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies 
+# of the Software, and to permit persons to whom the Software is furnished to do 
+# so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR 
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, 
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER 
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING 
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS 
+# IN THE SOFTWARE.
+#
+# precompute_coarse.py
+# Precompute VisibNet masks & CoarseNet predictions for a fixed set of
+# augmentations of each training/validation sample, for train_refine.py
+# Author: Francesco Pittaluga
+
+import os
+import json
+import tensorflow as tf
+import numpy as np
+import utils as ut
+import load_data_tflo as ld
+from models import VisibNet
+from models import CoarseNet
+
+#########################################################################
+
+parser = ut.MyParser(description='Configure')
+parser.add_argument("--input_attr", type=str, default='depth_sift_rgb', choices=['depth','depth_sift','depth_rgb','depth_sift_rgb'],
+                    help="%(type)s: Per-point attributes to inlcude in input tensor (default: %(default)s)")
+parser.add_argument("--trn_anns", type=str, default='data/anns/demo_5k/train.txt',
+                    help="%(type)s: Path to annotation file for training samples (default: %(default)s)")
+parser.add_argument("--val_anns", type=str, default='data/anns/demo_5k/val.txt',
+                    help="%(type)s: Path to annotation file for validation samples (default: %(default)s)")
+parser.add_argument("--vnet_model", type=str, default=None, help="%(type)s: Path to pre-trained VisibNet model")
+parser.add_argument("--cnet_model", type=str, default=None, help="%(type)s: Path to pre-trained CoarseNet model")
+parser.add_argument("--cache_dir", type=str, default=None,
+                    help="%(type)s: Output directory (default: wts/INPUT_ATTR/refinenet/coarse_cache)")
+parser.add_argument("--min_pts", type=int, default=1, help="%(type)s: Skip samples with fewer 3D points in a crop, per the index "+\
+                    "written by scan_data.py (default: %(default)s)")
+parser.add_argument("--num_augs", type=int, default=4, help="%(type)s: Number of fixed augmentations per training sample; "+\
+                    "epoch e reads augmentation e % NUM_AUGS (default: %(default)s)")
+parser.add_argument("--batch_size", type=int, default=4, help="%(type)s: Number of images in batch (default: %(default)s)")
+parser.add_argument("--crop_size", type=int, default=256, help="%(type)s: Size to crop images to (default: %(default)s)")
+parser.add_argument("--scale_size", type=lambda s: [int(i) for i in s.split(',')], default=[296,394,512],
+                    help="%(type)s: Sizes to randomly scale images to before cropping them (default: 296,394,512)")
+parser.add_argument("--pct_3D_points", type=lambda s: [float(i) for i in s.split(',')][:2], default=[5.,100.],
+                    help="%(type)s: Min and max percent of 3D points to keep when performing random subsampling for data "+\
+                    "augmentation (default: 5.,100.)")
+parser.add_argument("--frozen_width_mult", type=float, default=1., help="%(type)s: Channel width multiplier of the pre-trained VisibNet & CoarseNet "+\
+                    "(default: %(default)s)")
+parser.add_argument("-frozen_sep_conv", default=False, action='store_true', help="%(type)s: The pre-trained VisibNet & CoarseNet "+\
+                    "use depthwise-separable convs (default: %(default)s)")
+parser.add_argument("--seed", type=int, default=0, help="%(type)s: Seed for augmentation params (default: %(default)s)")
+prm = parser.parse_args()
+
+if prm.num_augs <= 0: parser.error("NUM_AUGS must be > 0")
+if prm.frozen_width_mult <= 0: parser.error("FROZEN_WIDTH_MULT must be > 0")
+
+if prm.vnet_model == None:
+    prm.vnet_model = 'wts/pretrained/{}/visibnet.model.npz'.format(prm.input_attr)
+if prm.cnet_model == None:
+    prm.cnet_model = 'wts/pretrained/{}/coarsenet.model.npz'.format(prm.input_attr)
+if prm.cache_dir == None:
+    prm.cache_dir = 'wts/{}/refinenet/coarse_cache'.format(prm.input_attr)
+os.system('mkdir -p {}'.format(prm.cache_dir))
+
+prm_str = 'Arguments:\n'+'\n'.join(['{} {}'.format(k.upper(),v) for k,v in vars(prm).items()])
+print(prm_str+'\n')
+
+#########################################################################
+
+# Set up data fetch with fed augmentation params & subsampling seeds
+# (same preprocessing as train_refine.py)
+camera_fps = [tf.placeholder(tf.string) for i in range(prm.batch_size)]
+pts_xyz_fps = [tf.placeholder(tf.string) for i in range(prm.batch_size)]
+pts_rgb_fps = [tf.placeholder(tf.string) for i in range(prm.batch_size)]
+pts_sift_fps = [tf.placeholder(tf.string) for i in range(prm.batch_size)]
+getfeed = lambda fps: \
+          dict([(ph,'data/'+fps[i,3]) for i,ph in enumerate(camera_fps)]+\
+               [(ph,'data/'+fps[i,0]) for i,ph in enumerate(pts_xyz_fps)]+\
+               [(ph,'data/'+fps[i,2]) for i,ph in enumerate(pts_sift_fps)]+\
+               [(ph,'data/'+fps[i,1]) for i,ph in enumerate(pts_rgb_fps)])
+aug = tf.placeholder(tf.float32,shape=[prm.batch_size,4])
+pts_seed = tf.placeholder(tf.int32,shape=[prm.batch_size])
+proj_depth,proj_sift,proj_rgb = ld.load_proj_bch(camera_fps,pts_xyz_fps,pts_sift_fps,pts_rgb_fps,
+                                                 prm.crop_size,prm.scale_size,isval=False,pct_pts=prm.pct_3D_points,
+                                                 aug=aug,pts_seed=pts_seed)
+
+pd_b=[]; ps_b=[]; pr_b=[]
+for i in range(prm.batch_size):
+    is_val = tf.to_float(tf.greater(proj_depth[i], 0.))
+    pd_b.append(tf.reshape(proj_depth[i]*is_val,[1,prm.crop_size,prm.crop_size,1]))
+    ps_b.append(tf.reshape(proj_sift[i]*is_val,[1,prm.crop_size,prm.crop_size,128]))
+    pr_b.append(tf.reshape(proj_rgb[i]*is_val,[1,prm.crop_size,prm.crop_size,3]))
+proj_depth = tf.concat(pd_b,axis=0)
+proj_sift = tf.concat(ps_b,axis=0) / 127.5 - 1.
+proj_rgb = tf.concat(pr_b,axis=0) / 127.5 - 1.
+
+# Init visibnet
+if prm.input_attr=='depth':
+    vinp = proj_depth
+elif prm.input_attr=='depth_sift':
+    vinp = tf.concat((proj_depth,proj_sift/127.5-1.),axis=3)
+elif prm.input_attr=='depth_rgb':
+    vinp = tf.concat((proj_depth,proj_rgb/127.5-1.),axis=3)
+elif prm.input_attr=='depth_sift_rgb':
+    vinp = tf.concat((proj_depth,proj_rgb/127.5-1.,proj_sift/127.5-1.),axis=3)
+V = VisibNet(vinp,bn='test',outp_act=True,
+             width=prm.frozen_width_mult,sep=prm.frozen_sep_conv)
+vpred = tf.cast(tf.greater(V.pred,0.5),tf.float32)
+
+# Init CoarseNet
+if prm.input_attr=='depth':
+    cinp = proj_depth*vpred
+elif prm.input_attr=='depth_sift':
+    cinp = tf.concat((proj_depth*vpred, proj_sift*vpred/127.5-1.),axis=3)
+elif prm.input_attr=='depth_rgb':
+    cinp = tf.concat((proj_depth*vpred, proj_rgb*vpred/127.5-1.),axis=3)
+elif prm.input_attr=='depth_sift_rgb':
+    cinp = tf.concat((proj_depth*vpred, proj_sift*vpred/127.5-1., proj_rgb*vpred/127.5-1.),axis=3)
+C = CoarseNet(cinp,bn='test',outp_act=True,
+              width=prm.frozen_width_mult,sep=prm.frozen_sep_conv)
+outs = [tf.cast(tf.round((C.pred+1.)*127.5),tf.uint8), tf.cast(vpred,tf.uint8)]
+
+#########################################################################
+
+# Start TF session (respecting OMP_NUM_THREADS)
+nthr = os.getenv('OMP_NUM_THREADS')
+if nthr is None: sess=tf.Session()
+else: sess=tf.Session(config=tf.ConfigProto(intra_op_parallelism_threads=int(nthr)))
+sess.run(tf.global_variables_initializer())
+
+ut.mprint("Restoring VisibNet from " + prm.vnet_model)
+V.load(sess,prm.vnet_model)
+ut.mprint("Restoring CoarseNet from " + prm.cnet_model)
+C.load(sess,prm.cnet_model)
+sess.run([V.unset_ifdo,C.unset_ifdo])
+
+#########################################################################
+
+# Fill caches (validation samples get a single augmentation)
+for split,anns,naug in [('trn',prm.trn_anns,prm.num_augs),('val',prm.val_anns,1)]:
+    bchr = ut.batcher(anns,prm.batch_size,min_pts=prm.min_pts,
+                      crsz=prm.crop_size,scsz=prm.scale_size)
+    cache = ut.coarse_cache('{}/{}'.format(prm.cache_dir,split),len(bchr.data),naug,prm.crop_size)
+    for j in bchr.keep:
+        cache.aug[j] = np.random.RandomState([prm.seed,j]).rand(naug,4)
+    cache.valid[bchr.keep] = True
+
+    # Run a batch of samples BIDX with augmentation K; False if it failed
+    def run(bidx,k,n):
+        _,a,s = cache.augs(bidx,k)
+        fd = getfeed(bchr.data[bidx])
+        fd.update({aug:a, pts_seed:s})
+        try: # prevent occasional failure when no pts in projection
+            cpred,vis = sess.run(outs,feed_dict=fd)
+        except:
+            return False
+        cache.coarse[bidx[:n],k] = cpred[:n]
+        cache.visib[bidx[:n],k] = vis[:n]
+        return True
+
+    for k in range(naug):
+        for i in range(0,len(bchr.keep),prm.batch_size):
+            bidx = bchr.keep[i:i+prm.batch_size]
+            n = len(bidx)
+            bidx = np.resize(bidx,prm.batch_size)
+            if not run(bidx,k,n):
+                # retry samples one at a time, marking those that fail invalid
+                for j in bidx[:n]:
+                    if not run(np.full(prm.batch_size,j),k,1):
+                        cache.valid[j] = False
+        ut.mprint("{}: augmentation {} / {} done".format(split,k+1,naug))
+    cache.flush()
+    nfail = len(bchr.keep)-int(cache.valid.sum())
+    if nfail > 0:
+        ut.mprint("{}: {} sample projections failed, samples are marked invalid".format(split,nfail))
+
+# Record settings the cache depends on
+meta = {k:vars(prm)[k] for k in ['input_attr','trn_anns','val_anns','vnet_model','cnet_model','num_augs','min_pts',
+                                 'crop_size','scale_size','pct_3D_points','frozen_width_mult','frozen_sep_conv']}
+meta.update(trn_scan=ut.scan_mtime(prm.trn_anns),val_scan=ut.scan_mtime(prm.val_anns),
+            vnet_mtime=ut.model_mtime(prm.vnet_model),cnet_mtime=ut.model_mtime(prm.cnet_model))
+with open(prm.cache_dir+'/cache.json','w') as f:
+    json.dump(meta,f,indent=1)
+ut.mprint("Wrote cache to " + prm.cache_dir)
@@ -0,0 +1,75 @@
+# Copyright (c) Microsoft Corporation.
+# Copyright (c) University of Florida Research Foundation, Inc.
+# Licensed under the MIT License.
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in 
+# the Software without restriction, including without limitation the rights to 
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies 
+# of the Software, and to permit persons to whom the Software is furnished to do 
+# so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR 
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, 
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER 
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING 
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS 
+# IN THE SOFTWARE.
+#
+# scan_data.py
+# Pre-scan an annotation file and record per-sample point counts, image size
+# and validity to ANNS.scan.npz (used by utils.batcher to skip bad samples)
+# Author: Francesco Pittaluga
+
+import os
+import numpy as np
+from multiprocessing import Pool
+import utils as ut
+import load_data as ld
+
+################################################################################
+
+parser = ut.MyParser(description='Configure')
+parser.add_argument("--anns", type=str, default='data/anns/demo_5k/train.txt',
+                    help="%(type)s: Path to annotation file to scan (default: %(default)s)")
+parser.add_argument("--crop_size", type=int, default=256, help="%(type)s: Size images are cropped to (default: %(default)s)")
+parser.add_argument("--scale_size", type=lambda s: [int(i) for i in s.split(',')], default=[296,394,512],
+                    help="int,int,int: Sizes images are scaled to before cropping them (default: 296,394,512)")
+parser.add_argument("--num_proc", type=int, default=os.cpu_count(), help="%(type)s: Number of worker processes (default: %(default)s)")
+prm = parser.parse_args()
+
+prm_str = 'Arguments:\n'+'\n'.join(['{} {}'.format(k.upper(),v) for k,v in vars(prm).items()])
+print(prm_str+'\n')
+
+################################################################################
+
+# Image size & points in center crop at each scale (-1 if sample unreadable)
+def scan(ann):
+    npts = -np.ones(len(prm.scale_size),dtype=np.int64)
+    try:
+        K,R,T,h,w = ld.load_camera('data/'+ann[3])
+        pcl_xyz = ld.load_points_xyz('data/'+ann[0])
+        for f in [ann[1],ann[2],ann[4],ann[5]]:
+            if not os.path.isfile('data/'+f):
+                return h, w, npts
+        proj_mat = K.dot(np.hstack((R,T)))
+        for i,sc in enumerate(prm.scale_size):
+            npts[i] = ld.count_points(pcl_xyz,proj_mat,h,w,sc,prm.crop_size)
+    except Exception:
+        return 0., 0., npts
+    return h, w, npts
+
+anns = ut.annotations(prm.anns)
+ut.mprint("Scanning %d samples"%len(anns))
+with Pool(prm.num_proc) as pool:
+    out = pool.map(scan,(anns[i] for i in range(len(anns))),chunksize=64)
+h,w,npts = [np.array(x) for x in zip(*out)]
+valid = np.logical_and(np.all(npts > 0,axis=1),np.minimum(h,w) > 0)
+
+fp = prm.anns+'.scan.npz'
+np.savez(fp,h=h,w=w,npts=npts,valid=valid,scale_size=prm.scale_size,crop_size=prm.crop_size)
+ut.mprint("{} of {} samples valid, saved index to {}".format(valid.sum(),len(valid),fp))
@@ -26,9 +26,13 @@
 
 import os
 import sys
+import time
+import re
+import json
 import tensorflow as tf
 import numpy as np
 import ctrlc
+import dist
 import utils as ut
 import load_data_tflo as ld
 from models import VisibNet
@@ -49,11 +53,17 @@ parser.add_argument("--val_anns", type=str, default='data/anns/demo_5k/val.txt',
                     help="%(type)s: Path to annotation file for validation samples (default: %(default)s)")
 parser.add_argument("--vnet_model", type=str, default=None, help="%(type)s: Path to pre-trained VisibNet model")
 parser.add_argument("--cnet_model", type=str, default=None, help="%(type)s: Path to pre-trained CoarseNet model")
+parser.add_argument("--coarse_cache", type=str, default=None, help="%(type)s: Directory written by precompute_coarse.py; read "+\
+                    "VisibNet masks & CoarseNet predictions from it instead of running both nets (default: %(default)s)")
 parser.add_argument("--vgg16_model", type=str, default='wts/vgg16.model.npz', help="%(type)s: Path to pre-trained vgg16 model (default: %(default)s)")
+parser.add_argument("--min_pts", type=int, default=1, help="%(type)s: Skip samples with fewer 3D points in a crop, per the index "+\
+                    "written by scan_data.py (default: %(default)s)")
 parser.add_argument("--batch_size", type=int, default=4, help="%(type)s: Number of images in batch (default: %(default)s)")
 parser.add_argument("--crop_size", type=int, default=256, help="%(type)s: Size to crop images to (default: %(default)s)")
 parser.add_argument("--scale_size", type=lambda s: [int(i) for i in s.split(',')], default=[296,394,512],
                     help="int,int,int: Sizes to randomly scale images to before cropping them (default: 296,394,512)")
+parser.add_argument("--crops_per_sample", type=int, default=1, help="%(type)s: Number of random crops taken from each loaded sample. "+\
+                    "Crops are mixed across batches through a shuffle buffer (default: %(default)s)")
 parser.add_argument("--pct_3D_points", type=lambda s: [float(i) for i in s.split(',')][:2], default=[5.,100.],
                     help="float,float: Min and max percent of 3D points to keep when performing random subsampling for data augmentation "+\
                     "(default: 5.,100.)")
@@ -61,19 +71,58 @@ parser.add_argument("--per_loss_wt", type=float, default=1., help="%(type)s: Per
 parser.add_argument("--pix_loss_wt", type=float, default=1., help="%(type)s: Pixel loss weight (default: %(default)s)")
 parser.add_argument("--adv_loss_wt", type=float, default=1e3, help="%(type)s: Adversarial loss weight (default: %(default)s)")
 parser.add_argument("--disc_loss_thresh", type=float, default=.1, help="%(type)s: Only Update discriminator when loss above threshold (default: %(default)s)")
+parser.add_argument("--width_mult", type=float, default=1., help="%(type)s: Channel width multiplier of RefineNet (default: %(default)s)")
+parser.add_argument("-sep_conv", default=False, action='store_true', help="%(type)s: Use depthwise-separable convs in RefineNet (default: %(default)s)")
+parser.add_argument("--frozen_width_mult", type=float, default=1., help="%(type)s: Channel width multiplier of the pre-trained VisibNet & CoarseNet "+\
+                    "(default: %(default)s)")
+parser.add_argument("-frozen_sep_conv", default=False, action='store_true', help="%(type)s: The pre-trained VisibNet & CoarseNet "+\
+                    "use depthwise-separable convs (default: %(default)s)")
+parser.add_argument("-recompute", default=False, action='store_true', help="%(type)s: Recompute RefineNet activations during backprop instead of storing them, "+\
+                    "to train larger crops in less memory (default: %(default)s)")
+parser.add_argument("--accum_steps", type=int, default=1, help="%(type)s: Average gradients over ACCUM_STEPS batches per optimizer "+\
+                    "update; iterations count updates (default: %(default)s)")
+parser.add_argument("--world_size", type=int, default=1, help="%(type)s: Number of data-parallel training processes, each loading BATCH_SIZE "+\
+                    "samples per batch. Start them with launch.py (default: %(default)s)")
+parser.add_argument("--rank", type=int, default=0, help="%(type)s: Rank of this process. Rank 0 logs validation & saves checkpoints (default: %(default)s)")
+parser.add_argument("--dist_addr", type=str, default='localhost:29500', help="%(type)s: host:port at which rank 0 accepts the other "+\
+                    "processes (default: %(default)s)")
+parser.add_argument("--schedule", type=str, default=None, help="CROP:BATCH:ITER,...: Progressive-resolution schedule. Train with crops "+\
+                    "of CROP, batches of BATCH and SCALE_SIZE scaled by CROP/CROP_SIZE until iteration ITER, then restart with the next "+\
+                    "stage. ITER of the last stage is ignored, e.g. 128:16:200000,256:4:0 (default: CROP_SIZE:BATCH_SIZE:0)")
+parser.add_argument("-imp_sample", default=False, action='store_true', help="%(type)s: Draw training samples with probability skewed toward "+\
+                    "samples with high running training loss (default: %(default)s)")
+parser.add_argument("--imp_floor", type=float, default=.5, help="%(type)s: Share of uniform sampling mixed into -imp_sample (default: %(default)s)")
+parser.add_argument("--imp_refresh", type=int, default=100, help="%(type)s: Recompute -imp_sample probabilities every IMP_REFRESH batches "+\
+                    "(default: %(default)s)")
 parser.add_argument("--max_iter", type=int, default=1e6, help="%(type)s: Stop training after MAX_ITER iterations (default: %(default)s)")
 parser.add_argument("--log_freq", type=int, default=25, help="%(type)s: Log training stats every LOG_FREQ iterations (default: %(default)s)")
 parser.add_argument("--chkpt_freq", type=int, default=1e4, help="%(type)s: Save model state every CHKPT_FREQ iterations. Previous model state "+\
                     "is deleted after each new save (default: %(default)s)")
+parser.add_argument("--chkpt_secs", type=int, default=0, help="%(type)s: Also save model state when CHKPT_SECS seconds have passed "+\
+                    "since the last save, 0 to disable (default: %(default)s)")
+parser.add_argument("-opt_fp16", default=False, action='store_true', help="%(type)s: Store Adam moments in checkpoints as float16 (default: %(default)s)")
 parser.add_argument("--save_freq", type=int, default=5e4, help="%(type)s: Permanently save model state every SAVE_FREQ iterations "+\
                     "(default: %(default)s)")
-parser.add_argument("--val_freq", type=int, default=5e3, help="%(type)s: Run validation loop every VAL_FREQ iterations (default: %(default)s)")
+parser.add_argument("--val_freq", type=int, default=5e3, help="%(type)s: Run validation loop every VAL_FREQ iterations, 0 to disable "+\
+                    "(e.g. when validate.py runs alongside) (default: %(default)s)")
 parser.add_argument("--val_iter", type=int, default=128, help="%(type)s: Number of validation samples per validation loop (default: %(default)s)")
 parser.add_argument("--adam_eps", type=float, default=1e-8, help="%(type)s: Epsilon parameter for adam optimizer (default: %(default)s)")
 parser.add_argument("--adam_mom", type=float, default=.9, help="%(type)s: Momentum parameter for adam optimizer (default: %(default)s)")
 parser.add_argument("--adam_lr", type=float, default=1e-4, help="%(type)s: Learning rate parameter for adam optmizer (default: %(default)s)")
 prm = parser.parse_args()
 
+if prm.width_mult <= 0 or prm.frozen_width_mult <= 0: parser.error("WIDTH_MULT and FROZEN_WIDTH_MULT must be > 0")
+if prm.accum_steps <= 0: parser.error("ACCUM_STEPS must be > 0")
+if prm.world_size <= 0: parser.error("WORLD_SIZE must be > 0")
+if prm.rank < 0 or prm.rank >= prm.world_size: parser.error("RANK must be in [0,WORLD_SIZE)")
+if prm.schedule is not None and not re.match(r'^\d+:\d+:\d+(,\d+:\d+:\d+)*$',prm.schedule):
+    parser.error("SCHEDULE must be CROP:BATCH:ITER,...")
+if prm.imp_sample and prm.crops_per_sample > 1: parser.error("-imp_sample does not support CROPS_PER_SAMPLE > 1")
+if prm.imp_floor < 0 or prm.imp_floor > 1: parser.error("IMP_FLOOR must be in [0,1]")
+if prm.imp_refresh <= 0: parser.error("IMP_REFRESH must be > 0")
+if prm.coarse_cache is not None and prm.crops_per_sample > 1: parser.error("--coarse_cache does not support CROPS_PER_SAMPLE > 1")
+if prm.coarse_cache is not None and prm.schedule is not None: parser.error("--coarse_cache does not support --schedule")
+
 prm_str = 'Arguments:\n'+'\n'.join(['{} {}'.format(k.upper(),v) for k,v in vars(prm).items()])
 print(prm_str+'\n')
 
@@ -91,22 +140,62 @@ if prm.cnet_model == None:
 
 # redirect stdout and stderr to log files
 if prm.log_file:
-    sys.stdout = open(exp_dir+'/train.log', 'a')
-    sys.stderr = open(exp_dir+'/info.log', 'a')
-
-# Check for saved weights & find iter
-rsave = ut.ckpter(exp_dir+'/iter_*.rmodel.npz')
-dsave = ut.ckpter(exp_dir+'/iter_*.dmodel.npz')
-osave = ut.ckpter(exp_dir+'/iter_*.opt.npz')
-rpath = lambda itr: '%s/iter_%07d.rmodel.npz'%(exp_dir,itr)
-dpath = lambda itr: '%s/iter_%07d.dmodel.npz'%(exp_dir,itr)
-opath = lambda itr: '%s/iter_%07d.opt.npz'%(exp_dir,itr)
-niter = rsave.iter
+    sfx = '' if prm.rank == 0 else '.rank%d'%prm.rank
+    sys.stdout = open(exp_dir+'/train%s.log'%sfx, 'a')
+    sys.stderr = open(exp_dir+'/info%s.log'%sfx, 'a')
+
+# Connect data-parallel processes
+comm = dist.comm(prm.rank,prm.world_size,prm.dist_addr)
+
+# Find latest checkpoint bundle, or the separate per-network files of
+# older versions, & iter
+ckpt = ut.bundle_ckpter(exp_dir,['rmodel','dmodel','opt'])
+if ckpt.latest is not None:
+    rlatest, dlatest, olatest = ckpt.latest+':rmodel', ckpt.latest+':dmodel', ckpt.latest
+else:
+    rsave = ut.ckpter(exp_dir+'/iter_*.rmodel.npz')
+    dsave = ut.ckpter(exp_dir+'/iter_*.dmodel.npz')
+    osave = ut.ckpter(exp_dir+'/iter_*.opt.npz')
+    rlatest, dlatest, olatest, ckpt.iter = rsave.latest, dsave.latest, osave.latest, rsave.iter
+niter = int(comm.bcast([np.int64(ckpt.iter)])[0])
+
+# Crop & batch size of the current stage of the schedule
+sched = ut.schedule(prm.schedule or '{}:{}:0'.format(prm.crop_size,prm.batch_size))
+crop_size, prm.batch_size, stage_end = sched.stage(niter)
+prm.scale_size = [int(round(s*crop_size/prm.crop_size)) for s in prm.scale_size]
+crop_tgt, prm.crop_size = prm.crop_size, crop_size
+if prm.schedule is not None:
+    ut.mprint("Training with CROP_SIZE {} BATCH_SIZE {} SCALE_SIZE {}".format(prm.crop_size,prm.batch_size,prm.scale_size))
+
+# Open precomputed VisibNet/CoarseNet outputs & check they match this run.
+# Samples the cache has no outputs for are skipped by the batchers.
+tmask = vmask = None
+if prm.coarse_cache is not None:
+    with open(prm.coarse_cache+'/cache.json') as f:
+        cmeta = json.load(f)
+    cur = dict(vars(prm),trn_scan=ut.scan_mtime(prm.trn_anns),val_scan=ut.scan_mtime(prm.val_anns),
+               vnet_mtime=ut.model_mtime(prm.vnet_model),cnet_mtime=ut.model_mtime(prm.cnet_model))
+    for k in ['input_attr','trn_anns','val_anns','min_pts','trn_scan','val_scan','vnet_model','cnet_model',
+              'vnet_mtime','cnet_mtime','frozen_width_mult','frozen_sep_conv','crop_size','scale_size','pct_3D_points']:
+        if cmeta.get(k) != cur[k]:
+            parser.error("--coarse_cache was computed with {} {} (this run: {}), rerun precompute_coarse.py".format(
+                k.upper(),cmeta.get(k),cur[k]))
+    tcache = ut.coarse_cache(prm.coarse_cache+'/trn')
+    vcache = ut.coarse_cache(prm.coarse_cache+'/val')
+    tmask, vmask = tcache.valid, vcache.valid
 
 # Load annotations
 ut.mprint("Loading annotations")
-tbchr = ut.batcher(prm.trn_anns,prm.batch_size,niter)
-vbchr = ut.batcher(prm.val_anns,prm.batch_size,niter)
+if prm.imp_sample:
+    tbchr = ut.imp_batcher(prm.trn_anns,prm.batch_size,min_pts=prm.min_pts,rank=prm.rank,size=prm.world_size,
+                           crsz=prm.crop_size,scsz=prm.scale_size,mask=tmask,
+                           floor=prm.imp_floor,refresh=prm.imp_refresh,comm=comm)
+else:
+    tbchr = ut.batcher(prm.trn_anns,prm.batch_size,min_pts=prm.min_pts,rank=prm.rank,size=prm.world_size,
+                       crsz=prm.crop_size,scsz=prm.scale_size,mask=tmask)
+tbchr.seek(sched.samples(niter)*prm.accum_steps*prm.world_size)
+vbchr = ut.batcher(prm.val_anns,prm.batch_size,niter,min_pts=prm.min_pts,
+                   crsz=prm.crop_size,scsz=prm.scale_size,mask=vmask)
 ut.mprint("Done!")
 
 #########################################################################
@@ -123,13 +212,45 @@ getfeed = lambda fps: \
                [(ph,'data/'+fps[i,2]) for i,ph in enumerate(pts_sift_fps)]+\
                [(ph,'data/'+fps[i,1]) for i,ph in enumerate(pts_rgb_fps)]+\
                [(ph,'data/'+fps[i,4]) for i,ph in enumerate(gt_rgb_fps)])
-gt_rgb = ld.load_img_bch(gt_rgb_fps,prm.crop_size,prm.scale_size,isval=False,binary=False)
+if prm.coarse_cache is None:
+    aug = ld.rand_aug(prm.batch_size*prm.crops_per_sample,niter*prm.world_size+prm.rank)
+    pts_seed = None
+else:
+    # augmentation params, subsampling seeds & net outputs are fed from the cache
+    aug = tf.placeholder(tf.float32,shape=[prm.batch_size,4])
+    pts_seed = tf.placeholder(tf.int32,shape=[prm.batch_size])
+    cpred_c = tf.placeholder(tf.uint8,shape=[prm.batch_size,prm.crop_size,prm.crop_size,3])
+    vpred_c = tf.placeholder(tf.uint8,shape=[prm.batch_size,prm.crop_size,prm.crop_size,1])
+gt_rgb = ld.load_img_bch(gt_rgb_fps,prm.crop_size,prm.scale_size,isval=False,binary=False,
+                         aug=aug,ncrops=prm.crops_per_sample)
 proj_depth,proj_sift,proj_rgb = ld.load_proj_bch(camera_fps,pts_xyz_fps,pts_sift_fps,pts_rgb_fps,
-                                                 prm.crop_size,prm.scale_size,isval=False)
+                                                 prm.crop_size,prm.scale_size,isval=False,pct_pts=prm.pct_3D_points,
+                                                 aug=aug,ncrops=prm.crops_per_sample,pts_seed=pts_seed)
+
+# Mix crops of loaded samples across batches
+if prm.crops_per_sample > 1:
+    cq = ld.crop_queue([gt_rgb,tf.stack(proj_depth),tf.stack(proj_sift),tf.stack(proj_rgb)],
+                       [[prm.crop_size,prm.crop_size,c] for c in [3,1,128,3]],
+                       prm.batch_size,prm.crops_per_sample,seed=niter)
+    gt_rgb,proj_depth,proj_sift,proj_rgb = cq.out
+
+# Feed for next data fetch (multi-crop mode first loads samples into the queue)
+def nxt_feed(bchr,isval=False):
+    if prm.crops_per_sample == 1:
+        fd = getfeed(bchr.get_batch())
+        if prm.coarse_cache is not None:
+            cache = vcache if isval else tcache
+            _,a,s = cache.augs(bchr.bidx,bchr.epoch)
+            c,v = cache.get(bchr.bidx,bchr.epoch)
+            fd.update({aug:a, pts_seed:s, cpred_c:c, vpred_c:v})
+        return fd
+    if isval:
+        sess.run(cq.venq,feed_dict=getfeed(bchr.get_batch()))
+        return {cq.isval: True}
+    cq.fill(sess,lambda: getfeed(bchr.get_batch()))
+    return {}
 
 pd_b=[]; ps_b=[]; pr_b=[]; is_visible=[]; is_valid=[]
-keep_prob = tf.random_uniform([prm.batch_size],minval=prm.pct_3D_points[0]/100.,
-                              maxval=prm.pct_3D_points[1]/100.,dtype=tf.float32,seed=niter)
 
 for i in range(prm.batch_size):
     # Get valid points
@@ -138,11 +259,6 @@ for i in range(prm.batch_size):
     ps = proj_sift[i]*is_val
     pr = proj_rgb[i]*is_val
 
-    # dropout (1-keep)% of projected pts
-    pd = tf.nn.dropout(pd,keep_prob[i],noise_shape=[prm.crop_size,prm.crop_size,1],seed=niter)*keep_prob[i]
-    ps = tf.nn.dropout(ps,keep_prob[i],noise_shape=[prm.crop_size,prm.crop_size,1],seed=niter)*keep_prob[i]
-    pr = tf.nn.dropout(pr,keep_prob[i],noise_shape=[prm.crop_size,prm.crop_size,1],seed=niter)*keep_prob[i]
-
     pd_b.append(tf.reshape(pd,[1,prm.crop_size,prm.crop_size,1]))
     ps_b.append(tf.reshape(ps,[1,prm.crop_size,prm.crop_size,128]))
     pr_b.append(tf.reshape(pr,[1,prm.crop_size,prm.crop_size,3]))
@@ -153,17 +269,21 @@ proj_rgb = tf.concat(pr_b,axis=0) / 127.5 - 1.
 
 #########################################################################
 
-# Init visibnet
-if prm.input_attr=='depth':
-    vinp = proj_depth
-elif prm.input_attr=='depth_sift':
-    vinp = tf.concat((proj_depth,proj_sift/127.5-1.),axis=3)
-elif prm.input_attr=='depth_rgb':
-    vinp = tf.concat((proj_depth,proj_rgb/127.5-1.),axis=3)
-elif prm.input_attr=='depth_sift_rgb':
-    vinp = tf.concat((proj_depth,proj_rgb/127.5-1.,proj_sift/127.5-1.),axis=3)
-V = VisibNet(vinp,bn='test',outp_act=True)
-vpred = tf.cast(tf.greater(V.pred,0.5),tf.float32)
+# Init visibnet (or read its predictions from the cache)
+if prm.coarse_cache is None:
+    if prm.input_attr=='depth':
+        vinp = proj_depth
+    elif prm.input_attr=='depth_sift':
+        vinp = tf.concat((proj_depth,proj_sift/127.5-1.),axis=3)
+    elif prm.input_attr=='depth_rgb':
+        vinp = tf.concat((proj_depth,proj_rgb/127.5-1.),axis=3)
+    elif prm.input_attr=='depth_sift_rgb':
+        vinp = tf.concat((proj_depth,proj_rgb/127.5-1.,proj_sift/127.5-1.),axis=3)
+    V = VisibNet(vinp,bn='test',outp_act=True,
+                 width=prm.frozen_width_mult,sep=prm.frozen_sep_conv)
+    vpred = tf.cast(tf.greater(V.pred,0.5),tf.float32)
+else:
+    vpred = tf.to_float(vpred_c)
 
 # Init CoarseNet
 if prm.input_attr=='depth':
@@ -178,8 +298,12 @@ elif prm.input_attr=='depth_rgb':
 elif prm.input_attr=='depth_sift_rgb':
     cinp = tf.concat((proj_depth*vpred, proj_sift*vpred/127.5-1., proj_rgb*vpred/127.5-1.),axis=3)
     rinp_sz = [prm.batch_size,prm.crop_size,prm.crop_size,135]
-C = CoarseNet(cinp,bn='test',outp_act=True)
-cpred = (C.pred+1.)*127.5
+if prm.coarse_cache is None:
+    C = CoarseNet(cinp,bn='test',outp_act=True,
+                  width=prm.frozen_width_mult,sep=prm.frozen_sep_conv)
+    cpred = (C.pred+1.)*127.5
+else:
+    cpred = tf.to_float(cpred_c)
     
 # Set up pre-fetching for RefineNet
 rinp = tf.concat((cpred,cinp),axis=3)
@@ -196,7 +320,9 @@ vldr_fetchOp = [rinp_b1.assign(rinp).op, rgt_b1.assign(rgt).op]
 tldr_swapOp = [rinp_b1.assign(rinp_b0).op, rgt_b1.assign(rgt_b0).op]
 
 # Init RefineNet
-R = RefineNet(rinp_b1,bn='train',outp_act=False)
+R = RefineNet(rinp_b1,bn='train',outp_act=False,
+              width=prm.width_mult,sep=prm.sep_conv,
+              recompute=prm.recompute)
 rpred = (R.pred+1.)*127.5
 
 # Init perceptual network
@@ -215,6 +341,12 @@ dinp_real = [ppred[layer][:prm.batch_size] for layer in layers]
 dinp_fake[0] = tf.concat((rinp_b1,rpred,dinp_fake[0]),axis=3)
 dinp_real[0] = tf.concat((rinp_b1,rgt_b1,dinp_real[0]),axis=3)
 
+# Discriminator fc layer shapes depend on the crop size, so it always sees
+# CROP_SIZE inputs during a progressive-resolution schedule
+if prm.crop_size != crop_tgt:
+    dinp_fake = [tf.image.resize_images(x,[crop_tgt>>i]*2) for i,x in enumerate(dinp_fake)]
+    dinp_real = [tf.image.resize_images(x,[crop_tgt>>i]*2) for i,x in enumerate(dinp_real)]
+
 D = Discriminator()
 dpred_fake = D.pred(dinp_fake)
 dpred_real = D.pred(dinp_real)
@@ -231,7 +363,7 @@ optD = tf.train.AdamOptimizer(prm.adam_lr,prm.adam_mom,epsilon=prm.adam_eps)
 # Set discriminator loss
 dloss = tf.reduce_mean(tf.nn.sparse_softmax_cross_entropy_with_logits(logits=dpred,labels=dgt))
 dacc = tf.reduce_mean(tf.cast(tf.equal(tf.argmax(dpred,1),dgt),tf.float32))
-dStep = optD.minimize(dloss,var_list=list(dvars.keys()))
+dAcc = ut.grad_accum(optD,dloss,list(dvars.keys()),prm.accum_steps,comm)
 
 # Set RefineNet loss
 radvloss = tf.reduce_mean(tf.nn.sparse_softmax_cross_entropy_with_logits(logits=dpred_fake,labels=dgt1))
@@ -240,7 +372,13 @@ rperloss = (tf.reduce_mean(tf.squared_difference(ppred['conv1_1'][:prm.batch_siz
             tf.reduce_mean(tf.squared_difference(ppred['conv2_2'][:prm.batch_size],ppred['conv2_2'][prm.batch_size:])) + \
             tf.reduce_mean(tf.squared_difference(ppred['conv3_3'][:prm.batch_size],ppred['conv3_3'][prm.batch_size:]))) / 3 
 rloss = prm.pix_loss_wt*rpixloss + prm.per_loss_wt*rperloss + prm.adv_loss_wt*radvloss
-rStep = optR.minimize(rloss,var_list=list(rvars.keys()))
+rAcc = ut.grad_accum(optR,rloss,list(rvars.keys()),prm.accum_steps,comm)
+
+# Per-sample R loss, for -imp_sample
+rloss_smp = prm.pix_loss_wt*tf.reduce_mean(tf.abs(rgt_b1-rpred),[1,2,3]) + \
+            prm.per_loss_wt*tf.add_n([tf.reduce_mean(tf.squared_difference(ppred[l][:prm.batch_size],ppred[l][prm.batch_size:]),[1,2,3])
+                                      for l in layers])/3 + \
+            prm.adv_loss_wt*tf.nn.sparse_softmax_cross_entropy_with_logits(logits=dpred_fake,labels=dgt1)
 
 #########################################################################
 
@@ -260,31 +398,47 @@ ut.mprint("Restoring VGG16 from " + prm.vgg16_model)
 P.load(sess,prm.vgg16_model)
 ut.mprint("Done!")
 
-# Load VisibNet wts
-ut.mprint("Restoring VisibNet from " + prm.vnet_model)
-V.load(sess,prm.vnet_model)
-ut.mprint("Done!")
-sess.run(V.unset_ifdo)
-            
-# Load CoarseNet wts
-ut.mprint("Restoring CoarseNet from " + prm.cnet_model)
-C.load(sess,prm.cnet_model)
-ut.mprint("Done!")
-sess.run(C.unset_ifdo)
+if prm.coarse_cache is None:
+    # Load VisibNet wts
+    ut.mprint("Restoring VisibNet from " + prm.vnet_model)
+    V.load(sess,prm.vnet_model)
+    ut.mprint("Done!")
+    sess.run(V.unset_ifdo)
+
+    # Load CoarseNet wts
+    ut.mprint("Restoring CoarseNet from " + prm.cnet_model)
+    C.load(sess,prm.cnet_model)
+    ut.mprint("Done!")
+    sess.run(C.unset_ifdo)
 
 # Load RefineNet wts
-if rsave.latest != None:
-    ut.mprint("Restoring RefineNet from " + rsave.latest)
-    R.load(sess,rsave.latest)
+if rlatest != None:
+    ut.mprint("Restoring RefineNet from " + rlatest)
+    R.load(sess,rlatest)
+    ut.mprint("Done!")
+
+# Load Discriminator wts
+if dlatest != None:
+    ut.mprint("Restoring Discriminator from " + dlatest)
+    D.load(sess,dlatest)
     ut.mprint("Done!")
     
 # Load optimizers
 optlist = [[optR,rvars],[optD,dvars]]
-if osave.latest is not None:
-    ut.mprint("Restoring optimizers from " + osave.latest)
-    ut.loadopts(osave.latest,optlist,[],sess)
+if olatest is not None:
+    ut.mprint("Restoring optimizers from " + olatest)
+    accum_steps, world_size, smp_loss = ut.loadopts(olatest,optlist,['accum_steps','world_size','smp_loss'],sess)
+    if accum_steps is not None and accum_steps != prm.accum_steps:
+        ut.mprint("Warning: checkpoint was trained with ACCUM_STEPS {}, sample stream position assumes {}".format(accum_steps,prm.accum_steps))
+    if world_size is not None and world_size != prm.world_size:
+        ut.mprint("Warning: checkpoint was trained with WORLD_SIZE {}, sample stream position assumes {}".format(world_size,prm.world_size))
+    if prm.imp_sample and smp_loss is not None and len(smp_loss) == len(tbchr.loss):
+        tbchr.loss = np.float32(smp_loss)
     ut.mprint("Done!")
 
+# Start all processes from the weights & optimizer state of rank 0
+comm.bcast_vars(sess,list(rvars.keys())+list(dvars.keys())+optR.variables()+optD.variables())
+
 #########################################################################
 
 # Main Training loop
@@ -295,21 +449,27 @@ dloss_prev=1e6
 tLossAcc=[]
 vlog=''
 
-fd=getfeed(tbchr.get_batch())
+fd=nxt_feed(tbchr)
 sess.run(tldr_fetchOp,feed_dict=fd)
 
+# Weights, optimizer & sampler state of a checkpoint bundle
+ckstate = lambda: ckpt.bundle({'rmodel':R.snapshot(sess),'dmodel':D.snapshot(sess)},
+                              ut.optstate(optlist,dict(tbchr.state(),accum_steps=prm.accum_steps,world_size=prm.world_size),
+                                          sess,prm.opt_fp16))
+ckw = ut.ckpt_writer()
+tsave = time.time()
+
 ut.mprint("Starting from Iteration %d" % niter)
-while not ctrlc.stop and niter < prm.max_iter:
+while not ctrlc.stop and niter < min(prm.max_iter,stage_end):
 
     # Val loop
-    if niter % prm.val_freq == 0:
+    if prm.val_freq > 0 and niter % prm.val_freq == 0 and prm.rank == 0:
         ut.mprint("Validating networks")
         sess.run([R.unset_ifdo,D.unset_ifdo])
         vLossAcc=[];
         for i in range(0,prm.val_iter):
             try: # prevent occasional failure when no pts in projection
-                fps=vbchr.get_batch()
-                fd=getfeed(fps)
+                fd=nxt_feed(vbchr,True)
                 sess.run(vldr_fetchOp,feed_dict=fd)
                 vLossAcc.append(sess.run([rloss,dloss,dacc]))
             except:
@@ -318,21 +478,32 @@ while not ctrlc.stop and niter < prm.max_iter:
         args = list(np.mean(vLossAcc,axis=0))
         vlog=' R.val.loss {:.6f} D.val.loss {:.6f} D.val.acc {:.6f}'.format(*args)
         
-    # Swap data buffers
-    sess.run(tldr_swapOp)
-
-    # Set up nxt data fetch op
-    fps=tbchr.get_batch()
-    fd=getfeed(fps)
-
-    try: # prevent occasional failure when no pts in projection
-        if niter%2==0 and dloss_prev>prm.disc_loss_thresh:
-            tLossAcc.append(sess.run([rloss,dloss,dacc,dStep]+tldr_fetchOp,feed_dict=fd)[:3])
-        else:
-            tLossAcc.append(sess.run([rloss,dloss,dacc,rStep]+tldr_fetchOp,feed_dict=fd)[:3])
-        dloss_prev = tLossAcc[-1][1]
-    except:
-        pass
+    # Update discriminator or rnet (gradients averaged over the ACCUM_STEPS batches that loaded)
+    acc = dAcc if niter%2==0 and dloss_prev>prm.disc_loss_thresh else rAcc
+    sess.run(acc.zero)
+    nok = 0
+    for k in range(prm.accum_steps):
+
+        # Swap data buffers
+        sess.run(tldr_swapOp)
+
+        # Set up nxt data fetch op
+        bidx=tbchr.bidx
+        fd=nxt_feed(tbchr)
+
+        try: # prevent occasional failure when no pts in projection
+            out = sess.run([rloss,dloss,dacc,rloss_smp,acc.step]+tldr_fetchOp,feed_dict=fd)
+            nok += 1
+            tLossAcc.append(out[:3]); tbchr.update(bidx,out[3])
+            dloss_prev = tLossAcc[-1][1]
+        except:
+            pass
+    acc.update(sess,nok)
+
+    # Agree on stopping & on the mean D loss across processes
+    if comm.size > 1:
+        stop, dsum = comm.allreduce([np.float32([ctrlc.stop,dloss_prev])])[0]
+        ctrlc.stop = stop > 0; dloss_prev = dsum/comm.size
         
     # Print training loss & accuracy
     niter+=1
@@ -342,38 +513,20 @@ while not ctrlc.stop and niter < prm.max_iter:
         ut.mprint(tlog+vlog)
         tLossAcc=[]; vlog='';
         
-    # Save models
-    if niter % prm.chkpt_freq == 0:
-
-        # Save RefineNet
-        R.save(sess,rpath(niter))
-        rsave.clean(every=prm.save_freq,last=1)
-        ut.mprint("Saved weights to "+rpath(niter))
-
-        # Save Discriminator
-        D.save(sess,dpath(niter))
-        dsave.clean(every=prm.save_freq,last=1)
-        ut.mprint("Saved weights to "+dpath(niter))
-
-        # Save Optimizers
-        ut.saveopts(opath(niter),optlist,{},sess)
-        osave.clean(last=1)
-        ut.mprint("Saved optimizers to "+opath(niter)) 
- 
+    # Save models & optimizers (written in the background)
+    if prm.rank == 0 and (niter % prm.chkpt_freq == 0 or (prm.chkpt_secs > 0 and time.time()-tsave >= prm.chkpt_secs)):
+        ckw.put([(ckpt.path(niter),ckstate(),ckpt,prm.save_freq)])
+        tsave = time.time()
+
 # Save models & optimizers
-if niter > rsave.iter:
-    
-    # Save RefineNet
-    R.save(sess,rpath(niter))
-    rsave.clean(every=prm.save_freq,last=1)
-    ut.mprint("Saved weights to "+rpath(niter))
-
-    # Save Discriminator
-    D.save(sess,dpath(niter))
-    dsave.clean(every=prm.save_freq,last=1)
-    ut.mprint("Saved weights to "+dpath(niter))
-        
-    # Save Optimizers
-    ut.saveopts(opath(niter),optlist,{},sess)
-    osave.clean(last=1)
-    ut.mprint("Saved optimizers to "+opath(niter)) 
+ckw.flush()
+if niter > ckpt.iter and prm.rank == 0:
+    ckw.put([(ckpt.path(niter),ckstate(),ckpt,prm.save_freq)])
+ckw.close()
+
+# Restart with the graph & data pipeline of the next stage
+if not ctrlc.stop and niter < prm.max_iter:
+    ut.mprint("Restarting for next stage of schedule at iteration %d" % niter)
+    sys.stdout.flush(); sys.stderr.flush()
+    comm.close()
+    os.execv(sys.executable,[sys.executable]+sys.argv)
@@ -26,12 +26,16 @@
 
 import os
 import sys
+import time
+import re
 import tensorflow as tf
 import numpy as np
 import ctrlc
+import dist
 import utils as ut
 import load_data_tflo as ld
 from models import VisibNet
+from models import SparseInp
 
 #########################################################################
 
@@ -43,28 +47,68 @@ parser.add_argument("--trn_anns", type=str, default='data/anns/demo_5k/train.txt
                     help="%(type)s: Path to annotation file for training samples (default: %(default)s)")
 parser.add_argument("--val_anns", type=str, default='data/anns/demo_5k/val.txt',
                     help="%(type)s: Path to annotation file for validation samples (default: %(default)s)")
+parser.add_argument("--min_pts", type=int, default=1, help="%(type)s: Skip samples with fewer 3D points in a crop, per the index "+\
+                    "written by scan_data.py (default: %(default)s)")
 parser.add_argument("--batch_size", type=int, default=4, help="%(type)s: Number of images in batch (default: %(default)s)")
 parser.add_argument("--crop_size", type=int, default=256, help="%(type)s: Size to crop images to (default: %(default)s)")
 parser.add_argument("--scale_size", type=lambda s: [int(i) for i in s.split(',')], default=[296,394,512],
                     help="int,int,int: Sizes to randomly scale images to before cropping them (default: 296,394,512)")
+parser.add_argument("--crops_per_sample", type=int, default=1, help="%(type)s: Number of random crops taken from each loaded sample. "+\
+                    "Crops are mixed across batches through a shuffle buffer (default: %(default)s)")
 parser.add_argument("--pct_3D_points", type=lambda s: [float(i) for i in s.split(',')][:2], default=[5.,100.],
                     help="float,float: Min and max percent of 3D points to keep when performing random subsampling for data augmentation "+\
                     "(default: 5.,100.)")
 parser.add_argument("--vis_thresh", type=float, default=.05, help="%(type)s: Threshold used to compute ground truth visibility mask."+\
                     "i.e., gt_visibibility_mask = ((inp_depth-gt_depth)/gt_depth) > VISIB_THRESH. (default: %(default)s)")
+parser.add_argument("-sparse_inp", default=False, action='store_true', help="%(type)s: Feed VisibNet per-point attributes instead of dense "+\
+                    "projections and compute its first layer sparsely")
+parser.add_argument("--width_mult", type=float, default=1., help="%(type)s: Channel width multiplier of all InvNets in this script (default: %(default)s)")
+parser.add_argument("-sep_conv", default=False, action='store_true', help="%(type)s: Use depthwise-separable convs in all InvNets in this script (default: %(default)s)")
+parser.add_argument("-recompute", default=False, action='store_true', help="%(type)s: Recompute VisibNet activations during backprop instead of storing them, "+\
+                    "to train larger crops in less memory (default: %(default)s)")
+parser.add_argument("--accum_steps", type=int, default=1, help="%(type)s: Average gradients over ACCUM_STEPS batches per optimizer "+\
+                    "update; iterations count updates (default: %(default)s)")
+parser.add_argument("--world_size", type=int, default=1, help="%(type)s: Number of data-parallel training processes, each loading BATCH_SIZE "+\
+                    "samples per batch. Start them with launch.py (default: %(default)s)")
+parser.add_argument("--rank", type=int, default=0, help="%(type)s: Rank of this process. Rank 0 logs validation & saves checkpoints (default: %(default)s)")
+parser.add_argument("--dist_addr", type=str, default='localhost:29500', help="%(type)s: host:port at which rank 0 accepts the other "+\
+                    "processes (default: %(default)s)")
+parser.add_argument("--schedule", type=str, default=None, help="CROP:BATCH:ITER,...: Progressive-resolution schedule. Train with crops "+\
+                    "of CROP, batches of BATCH and SCALE_SIZE scaled by CROP/CROP_SIZE until iteration ITER, then restart with the next "+\
+                    "stage. ITER of the last stage is ignored, e.g. 128:16:200000,256:4:0 (default: CROP_SIZE:BATCH_SIZE:0)")
+parser.add_argument("-imp_sample", default=False, action='store_true', help="%(type)s: Draw training samples with probability skewed toward "+\
+                    "samples with high running training loss (default: %(default)s)")
+parser.add_argument("--imp_floor", type=float, default=.5, help="%(type)s: Share of uniform sampling mixed into -imp_sample (default: %(default)s)")
+parser.add_argument("--imp_refresh", type=int, default=100, help="%(type)s: Recompute -imp_sample probabilities every IMP_REFRESH batches "+\
+                    "(default: %(default)s)")
 parser.add_argument("--max_iter", type=int, default=1e6, help="%(type)s: Stop training after MAX_ITER iterations (default: %(default)s)")
 parser.add_argument("--log_freq", type=int, default=25, help="%(type)s: Log training stats every LOG_FREQ iterations (default: %(default)s)")
 parser.add_argument("--chkpt_freq", type=int, default=1e4, help="%(type)s: Save model state every CHKPT_FREQ iterations. Previous model state "+\
                     "is deleted after each new save (default: %(default)s)")
+parser.add_argument("--chkpt_secs", type=int, default=0, help="%(type)s: Also save model state when CHKPT_SECS seconds have passed "+\
+                    "since the last save, 0 to disable (default: %(default)s)")
+parser.add_argument("-opt_fp16", default=False, action='store_true', help="%(type)s: Store Adam moments in checkpoints as float16 (default: %(default)s)")
 parser.add_argument("--save_freq", type=int, default=5e4, help="%(type)s: Permanently save model state every SAVE_FREQ iterations "+\
                     "(default: %(default)s)")
-parser.add_argument("--val_freq", type=int, default=5e3, help="%(type)s: Run validation loop every VAL_FREQ iterations (default: %(default)s)")
+parser.add_argument("--val_freq", type=int, default=5e3, help="%(type)s: Run validation loop every VAL_FREQ iterations, 0 to disable "+\
+                    "(e.g. when validate.py runs alongside) (default: %(default)s)")
 parser.add_argument("--val_iter", type=int, default=128, help="%(type)s: Number of validation samples per validation loop (default: %(default)s)")
 parser.add_argument("--adam_eps", type=float, default=1e-8, help="%(type)s: Epsilon parameter for adam optimizer (default: %(default)s)")
 parser.add_argument("--adam_mom", type=float, default=.9, help="%(type)s: Momentum parameter for adam optimizer (default: %(default)s)")
 parser.add_argument("--adam_lr", type=float, default=1e-5, help="%(type)s: Learning rate parameter for adam optmizer (default: %(default)s)")
 prm = parser.parse_args()
 
+if prm.sparse_inp and prm.crops_per_sample > 1: parser.error("-sparse_inp does not support CROPS_PER_SAMPLE > 1")
+if prm.width_mult <= 0: parser.error("WIDTH_MULT must be > 0")
+if prm.accum_steps <= 0: parser.error("ACCUM_STEPS must be > 0")
+if prm.world_size <= 0: parser.error("WORLD_SIZE must be > 0")
+if prm.rank < 0 or prm.rank >= prm.world_size: parser.error("RANK must be in [0,WORLD_SIZE)")
+if prm.schedule is not None and not re.match(r'^\d+:\d+:\d+(,\d+:\d+:\d+)*$',prm.schedule):
+    parser.error("SCHEDULE must be CROP:BATCH:ITER,...")
+if prm.imp_sample and prm.crops_per_sample > 1: parser.error("-imp_sample does not support CROPS_PER_SAMPLE > 1")
+if prm.imp_floor < 0 or prm.imp_floor > 1: parser.error("IMP_FLOOR must be in [0,1]")
+if prm.imp_refresh <= 0: parser.error("IMP_REFRESH must be > 0")
+
 prm_str = 'Arguments:\n'+'\n'.join(['{} {}'.format(k.upper(),v) for k,v in vars(prm).items()])
 print(prm_str+'\n')
 
@@ -76,20 +120,44 @@ os.system('mkdir -p {}'.format(exp_dir))
 
 # redirect stdout and stderr to log files
 if prm.log_file:
-    sys.stdout = open(exp_dir+'/train.log', 'a')
-    sys.stderr = open(exp_dir+'/info.log', 'a')
-
-# Check for saved weights & find iter
-vsave = ut.ckpter(exp_dir+'/iter_*.vmodel.npz')
-osave = ut.ckpter(exp_dir+'/iter_*.opt.npz')
-vpath = lambda itr: '%s/iter_%07d.vmodel.npz'%(exp_dir,itr)
-opath = lambda itr: '%s/iter_%07d.opt.npz'%(exp_dir,itr)
-niter = vsave.iter
+    sfx = '' if prm.rank == 0 else '.rank%d'%prm.rank
+    sys.stdout = open(exp_dir+'/train%s.log'%sfx, 'a')
+    sys.stderr = open(exp_dir+'/info%s.log'%sfx, 'a')
+
+# Connect data-parallel processes
+comm = dist.comm(prm.rank,prm.world_size,prm.dist_addr)
+
+# Find latest checkpoint bundle, or the separate per-network files of
+# older versions, & iter
+ckpt = ut.bundle_ckpter(exp_dir,['vmodel','opt'])
+if ckpt.latest is not None:
+    vlatest, olatest = ckpt.latest+':vmodel', ckpt.latest
+else:
+    vsave = ut.ckpter(exp_dir+'/iter_*.vmodel.npz')
+    osave = ut.ckpter(exp_dir+'/iter_*.opt.npz')
+    vlatest, olatest, ckpt.iter = vsave.latest, osave.latest, vsave.iter
+niter = int(comm.bcast([np.int64(ckpt.iter)])[0])
+
+# Crop & batch size of the current stage of the schedule
+sched = ut.schedule(prm.schedule or '{}:{}:0'.format(prm.crop_size,prm.batch_size))
+crop_size, prm.batch_size, stage_end = sched.stage(niter)
+prm.scale_size = [int(round(s*crop_size/prm.crop_size)) for s in prm.scale_size]
+prm.crop_size = crop_size
+if prm.schedule is not None:
+    ut.mprint("Training with CROP_SIZE {} BATCH_SIZE {} SCALE_SIZE {}".format(prm.crop_size,prm.batch_size,prm.scale_size))
 
 # Load annotations
 ut.mprint("Loading annotations")
-tbchr = ut.batcher(prm.trn_anns,prm.batch_size,niter)
-vbchr = ut.batcher(prm.val_anns,prm.batch_size,niter)
+if prm.imp_sample:
+    tbchr = ut.imp_batcher(prm.trn_anns,prm.batch_size,min_pts=prm.min_pts,rank=prm.rank,size=prm.world_size,
+                           crsz=prm.crop_size,scsz=prm.scale_size,
+                           floor=prm.imp_floor,refresh=prm.imp_refresh,comm=comm)
+else:
+    tbchr = ut.batcher(prm.trn_anns,prm.batch_size,min_pts=prm.min_pts,rank=prm.rank,size=prm.world_size,
+                       crsz=prm.crop_size,scsz=prm.scale_size)
+tbchr.seek(sched.samples(niter)*prm.accum_steps*prm.world_size)
+vbchr = ut.batcher(prm.val_anns,prm.batch_size,niter,min_pts=prm.min_pts,
+                   crsz=prm.crop_size,scsz=prm.scale_size)
 ut.mprint("Done!")
 
 #########################################################################
@@ -107,38 +175,71 @@ getfeed = lambda fps: \
                [(ph,'data/'+fps[i,2]) for i,ph in enumerate(pts_sift_fps)]+\
                [(ph,'data/'+fps[i,1]) for i,ph in enumerate(pts_rgb_fps)]+\
                [(ph,'data/'+fps[i,5]) for i,ph in enumerate(gt_depth_fps)])
-gt_depth = ld.load_img_bch(gt_depth_fps,prm.crop_size,prm.scale_size,isval=False,binary=True)
-proj_depth,proj_sift,proj_rgb = ld.load_proj_bch(camera_fps,pts_xyz_fps,pts_sift_fps,pts_rgb_fps,
-                                                 prm.crop_size,prm.scale_size,isval=False)
-
-pd_b=[]; ps_b=[]; pr_b=[]; is_visible=[]; is_valid=[]
-keep_prob = tf.random_uniform([prm.batch_size],minval=prm.pct_3D_points[0]/100.,
-                              maxval=prm.pct_3D_points[1]/100.,dtype=tf.float32,seed=niter)
-
-for i in range(prm.batch_size):
-    # Get visible points
-    proj_is_val = tf.to_float(tf.greater(proj_depth[i], 0.))
-    gt_is_val = tf.to_float(tf.greater(gt_depth[i], 0.))
-    is_val = proj_is_val*gt_is_val
-    pd = proj_depth[i]*is_val
-    ps = proj_sift[i]*is_val
-    pr = proj_rgb[i]*is_val
-    pct_diff = (pd-gt_depth[i])/(gt_depth[i]+1e-8)
-    is_vis = tf.to_float(tf.less(pct_diff,prm.vis_thresh))*is_val
-
-    # dropout (1-keep_prob)% of projected pts
-    pd = tf.nn.dropout(pd,keep_prob[i],noise_shape=[prm.crop_size,prm.crop_size,1],seed=niter)*keep_prob[i]
-    ps = tf.nn.dropout(ps,keep_prob[i],noise_shape=[prm.crop_size,prm.crop_size,1],seed=niter)*keep_prob[i]
-    pr = tf.nn.dropout(pr,keep_prob[i],noise_shape=[prm.crop_size,prm.crop_size,1],seed=niter)*keep_prob[i]
-    is_vis = tf.nn.dropout(is_vis,keep_prob[i],noise_shape=[prm.crop_size,prm.crop_size,1],seed=niter)*keep_prob[i]
-    is_val = tf.nn.dropout(is_val,keep_prob[i],noise_shape=[prm.crop_size,prm.crop_size,1],seed=niter)*keep_prob[i]
-
-    pd_b.append(tf.reshape(pd,[1,prm.crop_size,prm.crop_size,1]))
-    ps_b.append(tf.reshape(ps,[1,prm.crop_size,prm.crop_size,128]))
-    pr_b.append(tf.reshape(pr,[1,prm.crop_size,prm.crop_size,3]))
-    is_visible.append(tf.reshape(is_vis,[1,prm.crop_size,prm.crop_size,1]))
-    is_valid.append(tf.reshape(is_val,[1,prm.crop_size,prm.crop_size,1]))
-    
+aug = ld.rand_aug(prm.batch_size*prm.crops_per_sample,niter*prm.world_size+prm.rank)
+gt_depth = ld.load_img_bch(gt_depth_fps,prm.crop_size,prm.scale_size,isval=False,binary=True,
+                           aug=aug,ncrops=prm.crops_per_sample)
+if prm.sparse_inp:
+    proj_yx,proj_depth,proj_sift,proj_rgb = ld.load_proj_bch(camera_fps,pts_xyz_fps,pts_sift_fps,pts_rgb_fps,
+                                                             prm.crop_size,prm.scale_size,isval=False,sparse=True,
+                                                             pct_pts=prm.pct_3D_points,aug=aug,ncrops=prm.crops_per_sample)
+else:
+    proj_depth,proj_sift,proj_rgb = ld.load_proj_bch(camera_fps,pts_xyz_fps,pts_sift_fps,pts_rgb_fps,
+                                                     prm.crop_size,prm.scale_size,isval=False,pct_pts=prm.pct_3D_points,
+                                                     aug=aug,ncrops=prm.crops_per_sample)
+
+# Mix crops of loaded samples across batches
+if prm.crops_per_sample > 1:
+    cq = ld.crop_queue([gt_depth,tf.stack(proj_depth),tf.stack(proj_sift),tf.stack(proj_rgb)],
+                       [[prm.crop_size,prm.crop_size,c] for c in [1,1,128,3]],
+                       prm.batch_size,prm.crops_per_sample,seed=niter)
+    gt_depth,proj_depth,proj_sift,proj_rgb = cq.out
+
+# Feed for next data fetch (multi-crop mode first loads samples into the queue)
+def nxt_feed(bchr,isval=False):
+    if prm.crops_per_sample == 1:
+        return getfeed(bchr.get_batch())
+    if isval:
+        sess.run(cq.venq,feed_dict=getfeed(bchr.get_batch()))
+        return {cq.isval: True}
+    cq.fill(sess,lambda: getfeed(bchr.get_batch()))
+    return {}
+
+pd_b=[]; ps_b=[]; pr_b=[]; is_visible=[]; is_valid=[]; inds=[]
+
+if prm.sparse_inp:
+    for i in range(prm.batch_size):
+        # Get visible points
+        gt_d = tf.gather_nd(gt_depth[i],proj_yx[i])
+        sel = tf.logical_and(tf.greater(proj_depth[i],0.),tf.greater(gt_d,0.))[:,0]
+        yx = tf.boolean_mask(proj_yx[i],sel)
+        pd = tf.boolean_mask(proj_depth[i],sel)
+        gd = tf.boolean_mask(gt_d,sel)
+        is_vis = tf.to_float(tf.less((pd-gd)/(gd+1e-8),prm.vis_thresh))
+
+        inds.append(tf.concat((tf.fill([tf.shape(yx)[0],1],i),yx),axis=1))
+        pd_b.append(pd)
+        ps_b.append(tf.boolean_mask(proj_sift[i],sel))
+        pr_b.append(tf.boolean_mask(proj_rgb[i],sel))
+        is_visible.append(tf.scatter_nd(yx,is_vis,[prm.crop_size,prm.crop_size,1])[None])
+        is_valid.append(tf.scatter_nd(yx,tf.ones_like(is_vis),[prm.crop_size,prm.crop_size,1])[None])
+else:
+    for i in range(prm.batch_size):
+        # Get visible points
+        proj_is_val = tf.to_float(tf.greater(proj_depth[i], 0.))
+        gt_is_val = tf.to_float(tf.greater(gt_depth[i], 0.))
+        is_val = proj_is_val*gt_is_val
+        pd = proj_depth[i]*is_val
+        ps = proj_sift[i]*is_val
+        pr = proj_rgb[i]*is_val
+        pct_diff = (pd-gt_depth[i])/(gt_depth[i]+1e-8)
+        is_vis = tf.to_float(tf.less(pct_diff,prm.vis_thresh))*is_val
+
+        pd_b.append(tf.reshape(pd,[1,prm.crop_size,prm.crop_size,1]))
+        ps_b.append(tf.reshape(ps,[1,prm.crop_size,prm.crop_size,128]))
+        pr_b.append(tf.reshape(pr,[1,prm.crop_size,prm.crop_size,3]))
+        is_visible.append(tf.reshape(is_vis,[1,prm.crop_size,prm.crop_size,1]))
+        is_valid.append(tf.reshape(is_val,[1,prm.crop_size,prm.crop_size,1]))
+
 proj_depth = tf.concat(pd_b,axis=0)
 proj_sift = tf.concat(ps_b,axis=0) / 127.5 - 1.
 proj_rgb = tf.concat(pr_b,axis=0) / 127.5 - 1.
@@ -147,34 +248,58 @@ is_valid = tf.concat(is_valid,axis=0)
 
 #########################################################################
 
+# Empty pixels are 0 in depth and -1 in normalized sift & rgb channels
+cax = 3 if not prm.sparse_inp else 1
 if prm.input_attr=='depth':
     vinp = proj_depth
     vinp_sz = [prm.batch_size,prm.crop_size,prm.crop_size,1]
+    vinp_bg = [0.]
 elif prm.input_attr=='depth_sift':
-    vinp = tf.concat((proj_depth,proj_sift),axis=3)
+    vinp = tf.concat((proj_depth,proj_sift),axis=cax)
     vinp_sz = [prm.batch_size,prm.crop_size,prm.crop_size,129]
+    vinp_bg = [0.]+[-1.]*128
 elif prm.input_attr=='depth_rgb':
-    vinp = tf.concat((proj_depth,proj_rgb),axis=3)
+    vinp = tf.concat((proj_depth,proj_rgb),axis=cax)
     vinp_sz = [prm.batch_size,prm.crop_size,prm.crop_size,4]
+    vinp_bg = [0.]+[-1.]*3
 elif prm.input_attr=='depth_sift_rgb':
-    vinp = tf.concat((proj_depth,proj_rgb,proj_sift),axis=3)
+    vinp = tf.concat((proj_depth,proj_rgb,proj_sift),axis=cax)
     vinp_sz = [prm.batch_size,prm.crop_size,prm.crop_size,132]
+    vinp_bg = [0.]+[-1.]*131
     
-# Set up pre-fetching
-vinp_b0 = tf.Variable(tf.zeros(vinp_sz,dtype=tf.float32))
-vinp_b1 = tf.Variable(tf.zeros(vinp_sz,dtype=tf.float32))
+# Set up pre-fetching (variable length point lists when sparse)
+if prm.sparse_inp:
+    vind_b0 = tf.Variable(tf.zeros([0,3],dtype=tf.int32),validate_shape=False)
+    vind_b1 = tf.Variable(tf.zeros([0,3],dtype=tf.int32),validate_shape=False)
+    vinp_b0 = tf.Variable(tf.zeros([0,vinp_sz[-1]],dtype=tf.float32),validate_shape=False)
+    vinp_b1 = tf.Variable(tf.zeros([0,vinp_sz[-1]],dtype=tf.float32),validate_shape=False)
+    inds = tf.concat(inds,axis=0)
+else:
+    vinp_b0 = tf.Variable(tf.zeros(vinp_sz,dtype=tf.float32))
+    vinp_b1 = tf.Variable(tf.zeros(vinp_sz,dtype=tf.float32))
 
 vgt = tf.concat([is_visible,is_valid],axis=3)
 vgt_sz = [prm.batch_size,prm.crop_size,prm.crop_size,2]
 vgt_b0 = tf.Variable(tf.zeros(vgt_sz,dtype=tf.float32))
 vgt_b1 = tf.Variable(tf.zeros(vgt_sz,dtype=tf.float32))
 
-tldr_fetchOp = [vinp_b0.assign(vinp).op, vgt_b0.assign(vgt).op]
-vldr_fetchOp = [vinp_b1.assign(vinp).op, vgt_b1.assign(vgt).op]
-tldr_swapOp = [vinp_b1.assign(vinp_b0).op, vgt_b1.assign(vgt_b0).op]
+tldr_fetchOp = [tf.assign(vinp_b0,vinp,validate_shape=not prm.sparse_inp).op, vgt_b0.assign(vgt).op]
+vldr_fetchOp = [tf.assign(vinp_b1,vinp,validate_shape=not prm.sparse_inp).op, vgt_b1.assign(vgt).op]
+tldr_swapOp = [tf.assign(vinp_b1,vinp_b0,validate_shape=not prm.sparse_inp).op, vgt_b1.assign(vgt_b0).op]
+if prm.sparse_inp:
+    tldr_fetchOp.append(tf.assign(vind_b0,inds,validate_shape=False).op)
+    vldr_fetchOp.append(tf.assign(vind_b1,inds,validate_shape=False).op)
+    tldr_swapOp.append(tf.assign(vind_b1,vind_b0,validate_shape=False).op)
 
 # Init coarse inverter
-V = VisibNet(vinp_b1,bn='train',outp_act=False)
+if prm.sparse_inp:
+    V = VisibNet(SparseInp(vind_b1,vinp_b1,vinp_bg,vinp_sz),bn='train',outp_act=False,
+                 width=prm.width_mult,sep=prm.sep_conv,
+                 recompute=prm.recompute)
+else:
+    V = VisibNet(vinp_b1,bn='train',outp_act=False,
+                 width=prm.width_mult,sep=prm.sep_conv,
+                 recompute=prm.recompute)
 vpred = V.pred
 
 #########################################################################
@@ -188,7 +313,12 @@ logs = tf.boolean_mask(tf.reshape(vpred,[-1,1]),mask)
 lbls = tf.boolean_mask(tf.reshape(vgt_b1[:,:,:,0],[-1,1]),mask)
 vloss = tf.reduce_mean(tf.nn.sigmoid_cross_entropy_with_logits(labels=lbls,logits=logs))
 vacc = tf.reduce_mean(tf.to_float(tf.equal(lbls,tf.to_float(tf.greater(tf.sigmoid(logs),0.5)))))
-vStep = optV.minimize(vloss,var_list=list(vvars.keys()))
+vAcc = ut.grad_accum(optV,vloss,list(vvars.keys()),prm.accum_steps,comm)
+
+# Per-sample loss, for -imp_sample
+vmask = vgt_b1[:,:,:,1]
+vloss_smp = tf.reduce_sum(vmask*tf.nn.sigmoid_cross_entropy_with_logits(labels=vgt_b1[:,:,:,0],logits=vpred[:,:,:,0]),[1,2]) / \
+            tf.maximum(tf.reduce_sum(vmask,[1,2]),1.)
 
 #########################################################################
 
@@ -204,18 +334,27 @@ sess.run(init_all_vars)
 # Load saved models & optimizers
 
 # Load C wts
-if vsave.latest != None:
-    ut.mprint("Restoring V from " + vsave.latest )
-    V.load(sess,vsave.latest)
+if vlatest != None:
+    ut.mprint("Restoring V from " + vlatest )
+    V.load(sess,vlatest)
     ut.mprint("Done!")
     
 # Load optimizers
 optlist = [[optV,vvars]]
-if osave.latest is not None:
-    ut.mprint("Restoring optimizers from " + osave.latest )
-    ut.loadopts(osave.latest,optlist,[],sess)
+if olatest is not None:
+    ut.mprint("Restoring optimizers from " + olatest)
+    accum_steps, world_size, smp_loss = ut.loadopts(olatest,optlist,['accum_steps','world_size','smp_loss'],sess)
+    if accum_steps is not None and accum_steps != prm.accum_steps:
+        ut.mprint("Warning: checkpoint was trained with ACCUM_STEPS {}, sample stream position assumes {}".format(accum_steps,prm.accum_steps))
+    if world_size is not None and world_size != prm.world_size:
+        ut.mprint("Warning: checkpoint was trained with WORLD_SIZE {}, sample stream position assumes {}".format(world_size,prm.world_size))
+    if prm.imp_sample and smp_loss is not None and len(smp_loss) == len(tbchr.loss):
+        tbchr.loss = np.float32(smp_loss)
     ut.mprint("Done!")
 
+# Start all processes from the weights & optimizer state of rank 0
+comm.bcast_vars(sess,list(vvars.keys())+optV.variables())
+
 #########################################################################
 
 # Main Training loop
@@ -224,21 +363,27 @@ saviter = niter
 tLossAcc=[]
 vlog=''
 
-fd=getfeed(tbchr.get_batch())
+fd=nxt_feed(tbchr)
 sess.run(tldr_fetchOp,feed_dict=fd)
 
+# Weights, optimizer & sampler state of a checkpoint bundle
+ckstate = lambda: ckpt.bundle({'vmodel':V.snapshot(sess)},
+                              ut.optstate(optlist,dict(tbchr.state(),accum_steps=prm.accum_steps,world_size=prm.world_size),
+                                          sess,prm.opt_fp16))
+ckw = ut.ckpt_writer()
+tsave = time.time()
+
 ut.mprint("Starting from Iteration %d" % niter)
-while not ctrlc.stop and niter < prm.max_iter:
+while not ctrlc.stop and niter < min(prm.max_iter,stage_end):
 
     # Val loop
-    if niter % prm.val_freq == 0:
+    if prm.val_freq > 0 and niter % prm.val_freq == 0 and prm.rank == 0:
         ut.mprint("Validating networks")
         sess.run(V.unset_ifdo)
         vLossAcc=[];
         for i in range(0,prm.val_iter):
             try: # prevent occasional failure when no pts in projection
-                fps=vbchr.get_batch()
-                fd=getfeed(fps)
+                fd=nxt_feed(vbchr,True)
                 sess.run(vldr_fetchOp,feed_dict=fd)
                 vLossAcc.append(sess.run([vloss,vacc]))
             except:
@@ -247,18 +392,26 @@ while not ctrlc.stop and niter < prm.max_iter:
         args = list(np.mean(vLossAcc,axis=0))
         vlog=' val.loss {:.6f} val.acc {:.6f}'.format(*args)
 
-    # Swap data buffers
-    sess.run(tldr_swapOp)
-    
-    # Set up nxt data fetch op
-    fps=tbchr.get_batch()
-    fd=getfeed(fps)
+    # Update vnet (gradients averaged over the ACCUM_STEPS batches that loaded)
+    sess.run(vAcc.zero)
+    nok = 0
+    for k in range(prm.accum_steps):
+
+        # Swap data buffers
+        sess.run(tldr_swapOp)
 
-    # Update vnet
-    try: # prevent occasional failure when no pts in projection
-        tLossAcc.append(sess.run([vloss,vacc,vStep]+tldr_fetchOp,feed_dict=fd)[:2])
-    except:
-        pass
+        # Set up nxt data fetch op
+        bidx=tbchr.bidx
+        fd=nxt_feed(tbchr)
+
+        try: # prevent occasional failure when no pts in projection
+            out = sess.run([vloss,vacc,vloss_smp,vAcc.step]+tldr_fetchOp,feed_dict=fd)
+            nok += 1
+            tLossAcc.append(out[:2]); tbchr.update(bidx,out[2])
+        except:
+            pass
+    vAcc.update(sess,nok)
+    ctrlc.stop = comm.any(ctrlc.stop)
 
     # Print training loss & accuracy
     niter+=1     
@@ -268,28 +421,20 @@ while not ctrlc.stop and niter < prm.max_iter:
         ut.mprint(tlog+vlog)
         tLossAcc=[]; vlog='';
         
-    # Save models
-    if niter % prm.chkpt_freq == 0:
-
-        #Save VisibNet
-        V.save(sess,vpath(niter))
-        vsave.clean(every=prm.save_freq,last=1)
-        ut.mprint("Saved weights to "+vpath(niter))
-
-        # Save Optimizers
-        ut.saveopts(opath(niter),optlist,{},sess)
-        osave.clean(last=1)
-        ut.mprint("Saved optimizers to "+opath(niter)) 
- 
+    # Save models & optimizers (written in the background)
+    if prm.rank == 0 and (niter % prm.chkpt_freq == 0 or (prm.chkpt_secs > 0 and time.time()-tsave >= prm.chkpt_secs)):
+        ckw.put([(ckpt.path(niter),ckstate(),ckpt,prm.save_freq)])
+        tsave = time.time()
+
 # Save models & optimizers
-if niter > vsave.iter:
-    
-    # Save VisibNet
-    V.save(sess,vpath(niter))
-    vsave.clean(every=prm.save_freq,last=1)
-    ut.mprint("Saved weights to "+vpath(niter))
-
-    # Save Optimizers
-    ut.saveopts(opath(niter),optlist,{},sess)
-    osave.clean(last=1)
-    ut.mprint("Saved optimizers to "+opath(niter)) 
+ckw.flush()
+if niter > ckpt.iter and prm.rank == 0:
+    ckw.put([(ckpt.path(niter),ckstate(),ckpt,prm.save_freq)])
+ckw.close()
+
+# Restart with the graph & data pipeline of the next stage
+if not ctrlc.stop and niter < prm.max_iter:
+    ut.mprint("Restarting for next stage of schedule at iteration %d" % niter)
+    sys.stdout.flush(); sys.stderr.flush()
+    comm.close()
+    os.execv(sys.executable,[sys.executable]+sys.argv)
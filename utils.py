@@ -28,6 +28,9 @@ import sys
 import os
 import time
 import re
+import json
+import queue
+import threading
 from glob import glob
 import numpy as np
 import tensorflow as tf
@@ -56,42 +59,263 @@ def load_annotations(fname):
         data = [line.strip().split(' ') for line in f]
     return np.array(data)
 
-# Reading in batches (with repeatable random shuffling)
+# Memory-mapped annotations file with an index of line offsets (cached
+# next to the file as FNAME.idx.npy). Rows are parsed on demand.
+class annotations:
+    def __init__(self,fname,chunk=1<<26):
+        self.raw = np.memmap(fname,dtype=np.uint8,mode='r')
+        ifn = fname+'.idx.npy'
+        if os.path.isfile(ifn) and os.path.getmtime(ifn) >= os.path.getmtime(fname):
+            self.off = np.load(ifn,mmap_mode='r')
+            return
+
+        # find line starts chunk by chunk
+        off = [np.zeros(1,dtype=np.int64)]
+        for i in range(0,len(self.raw),chunk):
+            off.append(np.flatnonzero(self.raw[i:i+chunk] == ord('\n')).astype(np.int64)+i+1)
+        off = np.concatenate(off)
+        if off[-1] < len(self.raw):
+            off = np.append(off,len(self.raw))
+        self.off = off
+        try: np.save(ifn,off)
+        except OSError: pass
+
+    def __len__(self):
+        return len(self.off)-1
+
+    def __getitem__(self,idx):
+        rows = [bytes(self.raw[self.off[i]:self.off[i+1]]).decode().strip().split(' ')
+                for i in np.atleast_1d(idx)]
+        return np.array(rows) if np.ndim(idx) > 0 else np.array(rows[0])
+
+# Reading in batches (with repeatable random shuffling). The permutation of
+# each epoch is derived from (seed,epoch) alone, so any position in the
+# sample stream can be reached directly. If scan_data.py has indexed FNAME,
+# invalid samples and those with < MIN_PTS points in a crop are skipped; the
+# index must be newer than FNAME, cover all its samples and, if CRSZ & SCSZ
+# are given, have been made for crops of the same field of view. Samples
+# where the boolean array MASK is False are skipped as well.
+# Process RANK of SIZE data-parallel processes gets the RANK-th BSZ samples
+# of each SIZE*BSZ samples of the stream.
 class batcher:
-    def __init__(self,fname,bsz,niter=0):
+    def __init__(self,fname,bsz,niter=0,seed=0,min_pts=1,rank=0,size=1,crsz=None,scsz=None,mask=None):
 
         # Load from file
-        self.data = load_annotations(fname)
+        self.data = annotations(fname)
+        self.keep = np.arange(len(self.data))
+        sfn = fname+'.scan.npz'
+        if os.path.isfile(sfn):
+            scan = np.load(sfn)
+            if os.path.getmtime(sfn) < os.path.getmtime(fname) or len(scan['valid']) != len(self.data):
+                raise ValueError("{} is out of date with {}, rerun scan_data.py".format(sfn,fname))
+            # points in a crop depend only on SCALE_SIZE/CROP_SIZE, so the
+            # index also holds for the stages of a --schedule
+            if crsz is not None and (len(scan['scale_size']) != len(scsz) or not
+                                     np.allclose(np.float64(scan['scale_size'])/scan['crop_size'],
+                                                 np.float64(scsz)/crsz,rtol=.02)):
+                raise ValueError("{} was made for CROP_SIZE {} SCALE_SIZE {}, rerun scan_data.py".format(
+                    sfn,int(scan['crop_size']),list(scan['scale_size'])))
+            self.keep = np.flatnonzero(np.logical_and(scan['valid'],scan['npts'].min(axis=1) >= min_pts))
+        if mask is not None:
+            self.keep = self.keep[np.asarray(mask)[self.keep]]
+        if len(self.keep) == 0:
+            raise ValueError("No samples of {} pass the scan index with MIN_PTS {} and the sample mask".format(fname,min_pts))
 
         # Setup batching
-        nsamp = len(self.data)
-        self.bsz = bsz
-        
-        self.rand = np.random.RandomState(0)
-        idx = self.rand.permutation(nsamp)
-        for i in range(niter*bsz // len(idx)):
-            idx = self.rand.permutation(len(idx))
+        self.bsz = bsz*size
+        self.lbsz = bsz
+        self.rank = rank
+        self.seed = seed
+        self.epoch = -1
+        self.seek(niter*self.bsz)
+
+    # Permutation of samples in epoch
+    def perm(self,epoch):
+        return np.int32(self.keep[np.random.RandomState([self.seed,epoch]).permutation(len(self.keep))])
+
+    # Move to absolute position pos in the sample stream
+    def seek(self,pos):
+        epoch,self.pos = divmod(pos,len(self.keep))
+        if epoch != self.epoch:
+            self.epoch = epoch
+            self.idx = self.perm(epoch)
+
+    def get_batch(self):
+        nxt = self.epoch*len(self.idx)+self.pos+self.bsz
+        bidx = self.idx[self.pos:self.pos+self.bsz]
+        while len(bidx) < self.bsz:
+            self.seek((self.epoch+1)*len(self.idx))
+            bidx = np.concatenate((bidx,self.idx[:self.bsz-len(bidx)]))
+        self.seek(nxt)
+        self.bidx = bidx[self.rank*self.lbsz:(self.rank+1)*self.lbsz]
+        return self.data[self.bidx]
+
+    # Record per-sample training loss LOSS of samples BIDX (see imp_batcher)
+    def update(self,bidx,loss):
+        pass
+
+    # Sampling state to save with the optimizers
+    def state(self):
+        return {}
 
-        self.idx = np.int32(idx)
-        self.pos = niter*bsz % len(self.idx)
+# Batcher that draws samples with probability FLOOR/N plus (1-FLOOR) times
+# their share of the running (EMA) training loss, recomputed every REFRESH
+# batches. Samples without a loss yet count with the highest loss seen.
+# With a dist.comm COMM, loss tables of all processes are merged on refresh.
+class imp_batcher(batcher):
+    def __init__(self,fname,bsz,niter=0,seed=0,min_pts=1,rank=0,size=1,crsz=None,scsz=None,mask=None,
+                 floor=.5,decay=.9,refresh=100,comm=None):
+        super().__init__(fname,bsz,niter,seed,min_pts,rank,size,crsz,scsz,mask)
+        self.floor = floor
+        self.decay = decay
+        self.refresh = refresh
+        self.comm = comm
+        self.loss = np.full(len(self.data),np.nan,dtype=np.float32)
+        self.upd = np.zeros(len(self.data),dtype=bool)
+        self.nbch = 0
 
     def get_batch(self):
-        if self.pos+self.bsz >= len(self.idx):
-            bidx = self.idx[self.pos:]
+        if self.nbch % self.refresh == 0:
+            self.reweight()
+        self.nbch += 1
+        rs = np.random.RandomState([self.seed,self.epoch,self.pos])
+        bidx = self.keep[np.minimum(np.searchsorted(self.cdf,rs.random_sample(self.bsz)),len(self.keep)-1)]
+        self.seek(self.epoch*len(self.keep)+self.pos+self.bsz)
+        self.bidx = bidx[self.rank*self.lbsz:(self.rank+1)*self.lbsz]
+        return self.data[self.bidx]
+
+    def update(self,bidx,loss):
+        old = self.loss[bidx]
+        self.loss[bidx] = np.where(np.isnan(old),loss,self.decay*old+(1.-self.decay)*loss)
+        self.upd[bidx] = True
+
+    # Recompute sampling distribution from the loss table. With several
+    # processes, entries updated since the last merge are first averaged over
+    # the processes that updated them; the others are already in sync.
+    def reweight(self):
+        if self.comm is not None and self.comm.size > 1:
+            lsum,cnt = self.comm.allreduce([np.where(self.upd,self.loss,0.),np.float32(self.upd)])
+            self.loss = np.where(cnt > 0,lsum/np.maximum(cnt,1),self.loss).astype(np.float32)
+            self.upd[:] = False
+
+        l = np.float64(self.loss[self.keep])
+        seen = ~np.isnan(l)
+        prob = np.full(len(l),1./len(l))
+        if seen.any() and l[seen].max() > 0:
+            l[~seen] = l[seen].max()
+            prob = self.floor*prob + (1.-self.floor)*l/l.sum()
+        self.cdf = np.cumsum(prob)/prob.sum()
+
+    def state(self):
+        return {'smp_loss':self.loss.copy()}
+
+# Modification time of the scan_data.py index of annotation file FNAME
+# (None if not scanned)
+def scan_mtime(fname):
+    sfn = fname+'.scan.npz'
+    return os.path.getmtime(sfn) if os.path.isfile(sfn) else None
+
+# Modification time of weight file FNAME (as passed to models.load_wts,
+# None if missing)
+def model_mtime(fname):
+    if '.npz:' in fname:
+        fname = fname.rsplit(':',1)[0]
+    return os.path.getmtime(fname) if os.path.isfile(fname) else None
+
+# Progressive-resolution schedule CROP:BATCH:ITER,... Stage i trains with
+# crops of CROP and batches of BATCH until iteration ITER; the ITER of the
+# last stage is ignored.
+class schedule:
+    def __init__(self,s):
+        self.stages = [[int(float(v)) for v in st.split(':')] for st in s.split(',')]
+        self.stages[-1][2] = np.inf
+
+    # Crop size, batch size & last iteration of the stage of iteration NITER
+    def stage(self,niter):
+        for crop,bsz,end in self.stages:
+            if niter < end:
+                return crop,bsz,end
+
+    # Number of samples per process & accumulation step before iteration NITER
+    def samples(self,niter):
+        nsmp = 0; start = 0
+        for crop,bsz,end in self.stages:
+            nsmp += bsz*max(min(niter,end)-start,0)
+            start = end
+        return nsmp
+
+# Gradient accumulation for OPT: run zero, then step on each of NSTEPS
+# micro-batches, then update(sess,nok) to update VAR_LIST with the mean
+# gradient of LOSS over the NOK micro-batches whose step succeeded. The
+# update is skipped if there were none, so Adam does not move on stale
+# momentum. With NSTEPS = 1, step is a plain update and zero/update do
+# nothing. With a dist.comm COMM of several processes, accumulated
+# gradients & NOK are summed over all of them, so all skip together.
+class grad_accum:
+    def __init__(self,opt,loss,var_list,nsteps=1,comm=None):
+        self.comm = comm if comm is not None and comm.size > 1 else None
+        if nsteps == 1 and self.comm is None:
+            self.zero = tf.no_op()
+            self.step = opt.minimize(loss,var_list=var_list)
+            self.nok = None
+            return
+        gvs = [(g,v) for g,v in opt.compute_gradients(loss,var_list=var_list) if g is not None]
+        accs = [tf.Variable(tf.zeros(v.get_shape(),dtype=v.dtype.base_dtype),trainable=False) for _,v in gvs]
+        self.zero = tf.group(*[a.assign(tf.zeros_like(a)) for a in accs])
+        self.step = tf.group(*[a.assign_add(g) for a,(g,_) in zip(accs,gvs)])
+        self.nok = tf.placeholder(tf.float32,shape=[])
+        self.apply = opt.apply_gradients([(a/self.nok,v) for a,(_,v) in zip(accs,gvs)])
+        if self.comm is not None:
+            self.accs = accs
+            self.phs = [tf.placeholder(a.dtype.base_dtype,a.get_shape()) for a in accs]
+            self.load = tf.group(*[a.assign(p) for a,p in zip(accs,self.phs)])
 
-            idx = self.rand.permutation(len(self.idx))
-            self.idx = np.int32(idx)
+    # Returns False if the update was skipped
+    def update(self,sess,nok):
+        if self.nok is None:
+            return nok > 0
+        if self.comm is not None:
+            out = self.comm.allreduce(sess.run(self.accs)+[np.float32(nok)])
+            nok = out[-1]
+            if nok > 0:
+                sess.run(self.load,feed_dict=dict(zip(self.phs,out[:-1])))
+        if nok == 0:
+            return False
+        sess.run(self.apply,feed_dict={self.nok:nok})
+        return True
 
-            self.pos = 0
-            if len(bidx) < self.bsz:
-                self.pos = self.bsz-len(bidx)
-                bidx2 = self.idx[0:self.pos]
-                bidx = np.concatenate((bidx,bidx2))
+# CoarseNet predictions & VisibNet masks precomputed for a fixed set of
+# naug augmentations of each sample of an annotation file (written by
+# precompute_coarse.py). Sample j is read with augmentation epoch % naug,
+# whose scale/crop/flip params (as in load_data_tflo.rand_aug) and point
+# subsampling seed (j*naug+k) are returned alongside. valid marks the samples
+# with all augmentations computed; pass it as the batcher's mask.
+class coarse_cache:
+    def __init__(self,prefix,nsmp=None,naug=None,crsz=None):
+        fns = [prefix+'.aug.npy',prefix+'.coarse.npy',prefix+'.visib.npy',prefix+'.valid.npy']
+        if nsmp is None:
+            self.aug, self.coarse, self.visib, self.valid = [np.load(fn,mmap_mode='r') for fn in fns]
         else:
-            bidx = self.idx[self.pos:self.pos+self.bsz]
-            self.pos = self.pos+self.bsz
+            op = np.lib.format.open_memmap
+            self.aug = op(fns[0],mode='w+',dtype=np.float32,shape=(nsmp,naug,4))
+            self.coarse = op(fns[1],mode='w+',dtype=np.uint8,shape=(nsmp,naug,crsz,crsz,3))
+            self.visib = op(fns[2],mode='w+',dtype=np.uint8,shape=(nsmp,naug,crsz,crsz,1))
+            self.valid = op(fns[3],mode='w+',dtype=np.bool_,shape=(nsmp,))
+        self.naug = self.aug.shape[1]
 
-        return self.data[bidx]
+    # Augmentation index, params & subsampling seeds of samples BIDX in EPOCH
+    def augs(self,bidx,epoch):
+        k = epoch % self.naug
+        return k, self.aug[bidx,k], np.int32(bidx*self.naug+k)
+
+    # Cached CoarseNet predictions & VisibNet masks of samples BIDX in EPOCH
+    def get(self,bidx,epoch):
+        k = epoch % self.naug
+        return self.coarse[bidx,k], self.visib[bidx,k]
+
+    def flush(self):
+        for a in [self.aug,self.coarse,self.visib,self.valid]:
+            a.flush()
 
 # Manage checkpoint files, read off iteration number from filename
 # Use clean() to keep latest, and modulo n iters, delete rest
@@ -121,30 +345,154 @@ class ckpter:
             if every == 0 or j[1] % every != 0:
                 os.remove(j[0])
 
+    # Newly written checkpoint FN becomes the latest
+    def commit(self,fn,every=0):
+        self.clean(every=every,last=1)
+
+# Checkpoints of a training script as one npz bundle per iteration holding
+# the weights of every net (keys 'PART:name', read with load_wts as
+# 'FILE:PART'), the optimizer state & others. The manifest DIR/checkpoint.json
+# names the latest bundle and those kept every SAVE_FREQ iterations, so
+# resuming needs no directory scan.
+class bundle_ckpter:
+    def __init__(self,exp_dir,parts):
+        self.dir = exp_dir
+        self.parts = parts
+        self.mfn = exp_dir+"/checkpoint.json"
+        self.iter = 0
+        self.latest = None
+        self.kept = []
+        if os.path.isfile(self.mfn):
+            with open(self.mfn) as f:
+                mf = json.load(f)
+            self.iter = mf['iter']
+            self.latest = exp_dir+"/"+mf["latest"]
+            self.kept = mf['kept']
+
+    def path(self,itr):
+        return '%s/iter_%07d.ckpt.npz'%(self.dir,itr)
+
+    # Weights of nets NETS (dict of part: Net.snapshot) & optimizer state OPT
+    # (see optstate) as one dict
+    def bundle(self,nets,opt):
+        wts = {'%s:%s'%(p,k):v for p,w in nets.items() for k,v in w.items()}
+        wts.update(opt)
+        return wts
+
+    # Drop the optimizer moments from kept bundle FN, so kept bundles only
+    # hold weights & sampler state (only latest is resumed)
+    def strip(self,fn):
+        with np.load(fn) as f:
+            wts = {k:f[k] for k in f.files if not re.match(r'\d+:[mv]_',k)}
+        with open(fn+'.tmp','wb') as f:
+            np.savez(f,**wts)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(fn+'.tmp',fn)
+
+    # Newly written bundle FN becomes the latest. The manifest is replaced
+    # before the previous bundle is stripped or removed, so it never names a
+    # bundle without optimizer state as latest.
+    def commit(self,fn,every=0):
+        prev = self.latest
+        keep = prev is not None and every > 0 and self.iter % every == 0
+        if keep:
+            self.kept.append(os.path.basename(prev))
+        self.iter = int(re.match(r'.*_(\d+)\.ckpt\.npz$',fn).group(1))
+        self.latest = fn
+        with open(self.mfn+'.tmp','w') as f:
+            json.dump({'iter':self.iter,'latest':os.path.basename(fn),
+                       'parts':self.parts,'kept':self.kept},f,indent=1)
+        os.replace(self.mfn+'.tmp',self.mfn)
+        if keep and prev != fn:
+            self.strip(prev)
+        elif prev is not None and prev != fn and os.path.basename(prev) not in self.kept:
+            os.remove(prev)
+
                 
 # Save Optimizer state (Assume Adam)
 def saveopts(fn,opts,others,sess):
+    np.savez(fn,**optstate(opts,others,sess))
+
+# Optimizer state (Assume Adam) & OTHERS as one dict of arrays. With FP16,
+# Adam moments are stored as float16 scaled by their max (key+':sc'), the
+# second moment as its square root, floored to stay nonzero.
+def optstate(opts,others,sess,fp16=False):
     weights = {}
     for i in range(len(opts)):
         opt = opts[i][0]
         vdict = opts[i][1]
         if type(opt) == tf.train.AdamOptimizer:
             b1p, b2p = opt._get_beta_accumulators()
-            weights['%d:b1p'%i] = b1p.eval(sess)
-            weights['%d:b2p'%i] = b2p.eval(sess)
+            weights['%d:b1p'%i] = b1p
+            weights['%d:b2p'%i] = b2p
             for v in vdict.keys():
                 nm = vdict[v]
-                weights['%d:m_%s' % (i,nm)] = opt.get_slot(v,'m').eval(sess)
-                weights['%d:v_%s' % (i,nm)] = opt.get_slot(v,'v').eval(sess)
-            else:
-                slots = opt.get_slot_names()
-                for v in vdict.keys():
-                    nm = vdict[v]
-                    for s in slots:
-                        weights['%d:%s%s' % (i,s,nm)] = opt.get_slot(v, s).eval(sess)
+                weights['%d:m_%s' % (i,nm)] = opt.get_slot(v,'m')
+                weights['%d:v_%s' % (i,nm)] = opt.get_slot(v,'v')
+        else:
+            slots = opt.get_slot_names()
+            for v in vdict.keys():
+                nm = vdict[v]
+                for s in slots:
+                    weights['%d:%s%s' % (i,s,nm)] = opt.get_slot(v, s)
                         
+    weights = sess.run(weights)
+    if fp16:
+        for k in [k for k in weights if re.match(r'\d+:[mv]_',k)]:
+            a = np.float32(weights[k])
+            if k.split(':')[1][0] == 'v': a = np.sqrt(a)
+            sc = max(float(np.abs(a).max()),1e-30)
+            a = a/sc
+            # Floor sqrt(v) at the smallest float16 normal so it never
+            # decodes to 0 (m/(sqrt(v)+eps) would blow up on resume)
+            if k.split(':')[1][0] == 'v':
+                a = np.maximum(a,np.finfo(np.float16).tiny)
+            weights[k] = np.float16(a)
+            weights[k+':sc'] = np.float32(sc)
     weights.update(others)
-    np.savez(fn,**weights)
+    return weights
+
+# Background checkpoint writer. put() queues a list of (fname, dict of
+# arrays, ckpter, every) and only waits while a previous list is still
+# being written. Files are written to FNAME.tmp and renamed into place,
+# then committed to their ckpters (see ckpter.commit).
+class ckpt_writer:
+    def __init__(self):
+        self.q = queue.Queue(maxsize=1)
+        self.th = threading.Thread(target=self.run,daemon=True)
+        self.th.start()
+
+    def run(self):
+        while True:
+            jobs = self.q.get()
+            if jobs is None:
+                self.q.task_done()
+                return
+            try:
+                for fn,wts,_,_ in jobs:
+                    with open(fn+'.tmp','wb') as f:
+                        np.savez(f,**wts)
+                        f.flush()
+                        os.fsync(f.fileno())
+                    os.replace(fn+'.tmp',fn)
+                for fn,_,ckp,every in jobs:
+                    ckp.commit(fn,every)
+                    mprint("Saved "+fn)
+            except Exception as e:
+                eprint("Error writing checkpoint: "+str(e))
+            self.q.task_done()
+
+    def put(self,jobs):
+        self.q.put(jobs)
+
+    # Wait until all queued checkpoints are written
+    def flush(self):
+        self.q.join()
+
+    def close(self):
+        self.q.put(None)
+        self.th.join()
                         
                         
 # Load Optimizer state (Assume Adam)
@@ -152,6 +500,14 @@ def loadopts(fn,opts,others,sess):
     if not os.path.isfile(fn):
         return None
     weights = np.load(fn)
+
+    # Undo float16 storage of Adam moments (see optstate)
+    def val(k):
+        a = weights[k]
+        if a.dtype == np.float16:
+            a = np.float32(a)*weights[k+':sc']
+            if k.split(':')[1][0] == 'v': a = a**2
+        return a
     
     ph = tf.placeholder(tf.float32)
     for i in range(len(opts)):
@@ -165,16 +521,16 @@ def loadopts(fn,opts,others,sess):
             for v in vdict.keys():
                 nm = vdict[v]
                 sess.run(opt.get_slot(v,'m').assign(ph),
-                         feed_dict={ph: weights['%d:m_%s' % (i,nm)]})
+                         feed_dict={ph: val('%d:m_%s' % (i,nm))})
                 sess.run(opt.get_slot(v,'v').assign(ph),
-                         feed_dict={ph: weights['%d:v_%s' % (i,nm)]})
-            else:
-                slots = opt.get_slot_names()
-                for v in vdict.keys():
-                    nm = vdict[v]
-                    for s in slots:
-                        sess.run(opt.get_slot(v, s).assign(ph),
-                                 feed_dict={ph: weights['%d:%s%s' % (i,s,nm)]})
+                         feed_dict={ph: val('%d:v_%s' % (i,nm))})
+        else:
+            slots = opt.get_slot_names()
+            for v in vdict.keys():
+                nm = vdict[v]
+                for s in slots:
+                    sess.run(opt.get_slot(v, s).assign(ph),
+                             feed_dict={ph: weights['%d:%s%s' % (i,s,nm)]})
                         
-    oval = [weights[k] for k in others]
+    oval = [weights[k] if k in weights else None for k in others]
     return oval
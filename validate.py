@@ -0,0 +1,335 @@
+# Copyright (c) Microsoft Corporation.
+# Copyright (c) University of Florida Research Foundation, Inc.
+# Licensed under the MIT License.
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in 
+# the Software without restriction, including without limitation the rights to 
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies 
+# of the Software, and to permit persons to whom the Software is furnished to do 
+# so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR 
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, 
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER 
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING 
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS 
+# IN THE SOFTWARE.
+#
+# validate.py
+# Validate the checkpoints of a running training script out of band: each
+# new checkpoint bundle is evaluated on a fixed, precomputed validation set
+# and the result is appended to the training log
+# Author: Francesco Pittaluga
+
+import os
+import time
+import json
+import tensorflow as tf
+import numpy as np
+import utils as ut
+import load_data_tflo as ld
+from models import VisibNet
+from models import CoarseNet
+from models import RefineNet
+from models import VGG16
+from models import Discriminator
+
+#########################################################################
+
+parser = ut.MyParser(description='Configure')
+parser.add_argument("--stage", type=str, default='visib', choices=['visib','coarse','refine'],
+                    help="%(type)s: Network trained by train_STAGE.py to validate (default: %(default)s)")
+parser.add_argument("--input_attr", type=str, default='depth_sift_rgb', choices=['depth','depth_sift','depth_rgb','depth_sift_rgb'],
+                    help="%(type)s: Per-point attributes to inlcude in input tensor (default: %(default)s)")
+parser.add_argument("--val_anns", type=str, default='data/anns/demo_5k/val.txt',
+                    help="%(type)s: Path to annotation file for validation samples (default: %(default)s)")
+parser.add_argument("--vnet_model", type=str, default=None, help="%(type)s: Path to pre-trained VisibNet model, for STAGE coarse & refine")
+parser.add_argument("--cnet_model", type=str, default=None, help="%(type)s: Path to pre-trained CoarseNet model, for STAGE refine")
+parser.add_argument("--vgg16_model", type=str, default='wts/vgg16.model.npz', help="%(type)s: Path to pre-trained vgg16 model (default: %(default)s)")
+parser.add_argument("--cache_dir", type=str, default=None,
+                    help="%(type)s: Directory of the precomputed validation set (default: wts/INPUT_ATTR/STAGEnet/val_cache)")
+parser.add_argument("--min_pts", type=int, default=1, help="%(type)s: Skip samples with fewer 3D points in a crop, per the index "+\
+                    "written by scan_data.py (default: %(default)s)")
+parser.add_argument("--batch_size", type=int, default=4, help="%(type)s: Number of images in batch (default: %(default)s)")
+parser.add_argument("--crop_size", type=int, default=256, help="%(type)s: Size to crop images to (default: %(default)s)")
+parser.add_argument("--scale_size", type=lambda s: [int(i) for i in s.split(',')], default=[296,394,512],
+                    help="int,int,int: Sizes to randomly scale images to before cropping them (default: 296,394,512)")
+parser.add_argument("--pct_3D_points", type=lambda s: [float(i) for i in s.split(',')][:2], default=[5.,100.],
+                    help="float,float: Min and max percent of 3D points to keep when performing random subsampling for data augmentation "+\
+                    "(default: 5.,100.)")
+parser.add_argument("--vis_thresh", type=float, default=.05, help="%(type)s: Threshold used to compute ground truth visibility mask "+\
+                    "(see train_visib.py) (default: %(default)s)")
+parser.add_argument("--per_loss_wt", type=float, default=1., help="%(type)s: Perceptual loss weight (default: %(default)s)")
+parser.add_argument("--pix_loss_wt", type=float, default=1., help="%(type)s: Pixel loss weight (default: %(default)s)")
+parser.add_argument("--adv_loss_wt", type=float, default=1e3, help="%(type)s: Adversarial loss weight (default: %(default)s)")
+parser.add_argument("--width_mult", type=float, default=1., help="%(type)s: Channel width multiplier of the validated network (default: %(default)s)")
+parser.add_argument("-sep_conv", default=False, action='store_true', help="%(type)s: The validated network uses depthwise-separable convs (default: %(default)s)")
+parser.add_argument("--frozen_width_mult", type=float, default=1., help="%(type)s: Channel width multiplier of the pre-trained VisibNet & "+\
+                    "CoarseNet of STAGE coarse & refine (default: %(default)s)")
+parser.add_argument("-frozen_sep_conv", default=False, action='store_true', help="%(type)s: The pre-trained VisibNet & CoarseNet of STAGE "+\
+                    "coarse & refine use depthwise-separable convs (default: %(default)s)")
+parser.add_argument("--val_iter", type=int, default=32, help="%(type)s: Number of validation batches per checkpoint (default: %(default)s)")
+parser.add_argument("--seed", type=int, default=0, help="%(type)s: Seed for the choice & augmentation of validation samples (default: %(default)s)")
+parser.add_argument("--poll_secs", type=int, default=60, help="%(type)s: Check for a new checkpoint every POLL_SECS seconds (default: %(default)s)")
+parser.add_argument("-once", default=False, action='store_true', help="%(type)s: Validate the latest checkpoint and exit (default: %(default)s)")
+prm = parser.parse_args()
+
+if prm.width_mult <= 0 or prm.frozen_width_mult <= 0: parser.error("WIDTH_MULT and FROZEN_WIDTH_MULT must be > 0")
+if prm.val_iter <= 0: parser.error("VAL_ITER must be > 0")
+if prm.poll_secs <= 0: parser.error("POLL_SECS must be > 0")
+
+exp_dir = 'wts/{}/{}net'.format(prm.input_attr,prm.stage)
+if prm.vnet_model == None:
+    prm.vnet_model = 'wts/pretrained/{}/visibnet.model.npz'.format(prm.input_attr)
+if prm.cnet_model == None:
+    prm.cnet_model = 'wts/pretrained/{}/coarsenet.model.npz'.format(prm.input_attr)
+if prm.cache_dir == None:
+    prm.cache_dir = exp_dir+'/val_cache'
+os.system('mkdir -p {}'.format(prm.cache_dir))
+
+prm_str = 'Arguments:\n'+'\n'.join(['{} {}'.format(k.upper(),v) for k,v in vars(prm).items()])
+print(prm_str+'\n')
+
+#########################################################################
+
+bsz, crsz = prm.batch_size, prm.crop_size
+
+# Cached arrays: raw projections, ground truth & (for the later stages)
+# outputs of the frozen VisibNet/CoarseNet, as in precompute_coarse.py
+keys = ['depth','sift','rgb','gt']+{'visib':[],'coarse':['visib'],'refine':['visib','coarse']}[prm.stage]
+gt_nch = 1 if prm.stage=='visib' else 3
+spec = {'depth':(np.float32,1), 'sift':(np.uint8,128), 'rgb':(np.uint8,3),
+        'gt':(np.float32,gt_nch), 'visib':(np.uint8,1), 'coarse':(np.uint8,3)}
+meta_keys = ['stage','input_attr','val_anns','min_pts','batch_size','crop_size','scale_size',
+             'pct_3D_points','val_iter','seed']
+if prm.stage != 'visib': meta_keys += ['vnet_model','frozen_width_mult','frozen_sep_conv']
+if prm.stage == 'refine': meta_keys.append('cnet_model')
+meta = {k:vars(prm)[k] for k in meta_keys}
+
+# Normalize & mask inputs the way train_STAGE.py does (train_coarse.py
+# scales sift & rgb to [-1,1] only when building the CoarseNet input)
+def prep(proj_depth,proj_sift,proj_rgb,is_val):
+    pd = proj_depth*is_val
+    ps = proj_sift*is_val
+    pr = proj_rgb*is_val
+    if prm.stage != 'coarse':
+        ps = ps / 127.5 - 1.
+        pr = pr / 127.5 - 1.
+    return pd, ps, pr
+
+def visib_inp(pd,ps,pr):
+    if prm.input_attr=='depth':
+        return pd
+    elif prm.input_attr=='depth_sift':
+        return tf.concat((pd,ps),axis=3)
+    elif prm.input_attr=='depth_rgb':
+        return tf.concat((pd,pr),axis=3)
+    elif prm.input_attr=='depth_sift_rgb':
+        return tf.concat((pd,pr,ps),axis=3)
+
+def coarse_inp(pd,ps,pr,vpred):
+    if prm.input_attr=='depth':
+        return pd*vpred
+    elif prm.input_attr=='depth_sift':
+        return tf.concat((pd*vpred, ps*vpred/127.5-1.),axis=3)
+    elif prm.input_attr=='depth_rgb':
+        return tf.concat((pd*vpred, pr*vpred/127.5-1.),axis=3)
+    elif prm.input_attr=='depth_sift_rgb':
+        return tf.concat((pd*vpred, ps*vpred/127.5-1., pr*vpred/127.5-1.),axis=3)
+
+# Open the cache, or recompute it if missing or made with other settings
+cache = None
+if os.path.isfile(prm.cache_dir+'/cache.json'):
+    with open(prm.cache_dir+'/cache.json') as f:
+        cmeta = json.load(f)
+    if {k:cmeta.get(k) for k in meta_keys} == meta:
+        cache = {k:np.load('{}/{}.npy'.format(prm.cache_dir,k),mmap_mode='r') for k in keys}
+        skip = set(cmeta['skip'])
+    else:
+        ut.mprint("Validation set in {} was computed with other settings, recomputing".format(prm.cache_dir))
+
+if cache is None:
+    # Set up data fetch with fed augmentation params & subsampling seeds
+    camera_fps = [tf.placeholder(tf.string) for i in range(bsz)]
+    pts_xyz_fps = [tf.placeholder(tf.string) for i in range(bsz)]
+    pts_rgb_fps = [tf.placeholder(tf.string) for i in range(bsz)]
+    pts_sift_fps = [tf.placeholder(tf.string) for i in range(bsz)]
+    gt_fps = [tf.placeholder(tf.string) for i in range(bsz)]
+    gt_col = 5 if prm.stage=='visib' else 4
+    getfeed = lambda fps: \
+              dict([(ph,'data/'+fps[i,3]) for i,ph in enumerate(camera_fps)]+\
+                   [(ph,'data/'+fps[i,0]) for i,ph in enumerate(pts_xyz_fps)]+\
+                   [(ph,'data/'+fps[i,2]) for i,ph in enumerate(pts_sift_fps)]+\
+                   [(ph,'data/'+fps[i,1]) for i,ph in enumerate(pts_rgb_fps)]+\
+                   [(ph,'data/'+fps[i,gt_col]) for i,ph in enumerate(gt_fps)])
+    aug = tf.placeholder(tf.float32,shape=[bsz,4])
+    pts_seed = tf.placeholder(tf.int32,shape=[bsz])
+    gt = ld.load_img_bch(gt_fps,crsz,prm.scale_size,isval=False,binary=prm.stage=='visib',aug=aug)
+    proj_depth,proj_sift,proj_rgb = ld.load_proj_bch(camera_fps,pts_xyz_fps,pts_sift_fps,pts_rgb_fps,
+                                                     crsz,prm.scale_size,isval=False,pct_pts=prm.pct_3D_points,
+                                                     aug=aug,pts_seed=pts_seed)
+    proj_depth = tf.stack(proj_depth)
+    proj_sift = tf.stack(proj_sift)
+    proj_rgb = tf.stack(proj_rgb)
+    outs = {'depth':proj_depth, 'sift':tf.cast(proj_sift,tf.uint8), 'rgb':tf.cast(proj_rgb,tf.uint8), 'gt':gt}
+
+    # Frozen VisibNet & CoarseNet
+    nets = []
+    if prm.stage != 'visib':
+        pd,ps,pr = prep(proj_depth,proj_sift,proj_rgb,tf.to_float(tf.greater(proj_depth,0.)))
+        V = VisibNet(visib_inp(pd,ps/127.5-1.,pr/127.5-1.),bn='test',outp_act=True,
+                     width=prm.frozen_width_mult,sep=prm.frozen_sep_conv)
+        vpred = tf.cast(tf.greater(V.pred,0.5),tf.float32)
+        outs['visib'] = tf.cast(vpred,tf.uint8)
+        nets.append((V,prm.vnet_model,"VisibNet"))
+    if prm.stage == 'refine':
+        C = CoarseNet(coarse_inp(pd,ps,pr,vpred),bn='test',outp_act=True,
+                      width=prm.frozen_width_mult,sep=prm.frozen_sep_conv)
+        outs['coarse'] = tf.cast(tf.round((C.pred+1.)*127.5),tf.uint8)
+        nets.append((C,prm.cnet_model,"CoarseNet"))
+
+#########################################################################
+
+# Validation graph, fed from the cache (same losses as train_STAGE.py)
+inp = {k:tf.placeholder(spec[k][0],shape=[bsz,crsz,crsz,spec[k][1]]) for k in keys}
+proj_depth = inp['depth']
+gt = inp['gt']
+
+if prm.stage == 'visib':
+    is_val = tf.to_float(tf.greater(proj_depth,0.))*tf.to_float(tf.greater(gt,0.))
+    pd,ps,pr = prep(proj_depth,tf.to_float(inp['sift']),tf.to_float(inp['rgb']),is_val)
+    is_vis = tf.to_float(tf.less((pd-gt)/(gt+1e-8),prm.vis_thresh))*is_val
+    N = VisibNet(visib_inp(pd,ps,pr),bn='train',outp_act=False,
+                 width=prm.width_mult,sep=prm.sep_conv)
+    mask = tf.reshape(is_val,[-1,1])
+    logs = tf.boolean_mask(tf.reshape(N.pred,[-1,1]),mask)
+    lbls = tf.boolean_mask(tf.reshape(is_vis,[-1,1]),mask)
+    vloss = tf.reduce_mean(tf.nn.sigmoid_cross_entropy_with_logits(labels=lbls,logits=logs))
+    vacc = tf.reduce_mean(tf.to_float(tf.equal(lbls,tf.to_float(tf.greater(tf.sigmoid(logs),0.5)))))
+    fetch = [vloss,vacc]
+    fmt = ' val.loss {:.6f} val.acc {:.6f}'
+    parts = [(N,'vmodel')]
+else:
+    pd,ps,pr = prep(proj_depth,tf.to_float(inp['sift']),tf.to_float(inp['rgb']),tf.to_float(tf.greater(proj_depth,0.)))
+    cinp = coarse_inp(pd,ps,pr,tf.to_float(inp['visib']))
+    if prm.stage == 'coarse':
+        N = CoarseNet(cinp,bn='train',outp_act=False,
+                      width=prm.width_mult,sep=prm.sep_conv)
+        ninp = cinp
+    else:
+        ninp = tf.concat((tf.to_float(inp['coarse']),cinp),axis=3)
+        N = RefineNet(ninp,bn='train',outp_act=False,
+                      width=prm.width_mult,sep=prm.sep_conv)
+    pred = (N.pred+1.)*127.5
+
+    P = VGG16(tf.concat((gt,pred),axis=0),stop_layer='conv3_3')
+    ppred = P.pred
+    layers = ['conv1_1','conv2_2','conv3_3']
+    pixloss = tf.reduce_mean(tf.abs(gt-pred))
+    perloss = tf.add_n([tf.reduce_mean(tf.squared_difference(ppred[l][:bsz],ppred[l][bsz:])) for l in layers]) / 3
+    loss = prm.pix_loss_wt*pixloss + prm.per_loss_wt*perloss
+
+    if prm.stage == 'coarse':
+        fetch = [loss]
+        fmt = ' val.loss {:.6f}'
+        parts = [(N,'cmodel')]
+    else:
+        dgt1 = tf.constant(1,shape=[bsz],dtype=tf.int64)
+        dgt = tf.concat((tf.constant(0,shape=[bsz],dtype=tf.int64),dgt1),axis=0)
+        dinp_fake = [ppred[l][bsz:] for l in layers]
+        dinp_real = [ppred[l][:bsz] for l in layers]
+        dinp_fake[0] = tf.concat((ninp,pred,dinp_fake[0]),axis=3)
+        dinp_real[0] = tf.concat((ninp,gt,dinp_real[0]),axis=3)
+        D = Discriminator()
+        dpred_fake = D.pred(dinp_fake)
+        dpred = tf.concat((dpred_fake,D.pred(dinp_real)),axis=0)
+        dloss = tf.reduce_mean(tf.nn.sparse_softmax_cross_entropy_with_logits(logits=dpred,labels=dgt))
+        dacc = tf.reduce_mean(tf.cast(tf.equal(tf.argmax(dpred,1),dgt),tf.float32))
+        advloss = tf.reduce_mean(tf.nn.sparse_softmax_cross_entropy_with_logits(logits=dpred_fake,labels=dgt1))
+        fetch = [loss+prm.adv_loss_wt*advloss,dloss,dacc]
+        fmt = ' R.val.loss {:.6f} D.val.loss {:.6f} D.val.acc {:.6f}'
+        parts = [(N,'rmodel'),(D,'dmodel')]
+
+#########################################################################
+
+# Start TF session (respecting OMP_NUM_THREADS)
+nthr = os.getenv('OMP_NUM_THREADS')
+if nthr is None: sess=tf.Session()
+else: sess=tf.Session(config=tf.ConfigProto(intra_op_parallelism_threads=int(nthr)))
+sess.run(tf.global_variables_initializer())
+
+if prm.stage != 'visib':
+    ut.mprint("Restoring VGG16 from " + prm.vgg16_model)
+    P.load(sess,prm.vgg16_model)
+
+#########################################################################
+
+# Fill cache: VAL_ITER batches of validation samples, each with one fixed
+# augmentation & subsampling seed. Batches whose projection fails are skipped.
+if cache is None:
+    for net,fn,nm in nets:
+        ut.mprint("Restoring {} from {}".format(nm,fn))
+        net.load(sess,fn)
+        sess.run(net.unset_ifdo)
+
+    bchr = ut.batcher(prm.val_anns,bsz,seed=prm.seed,min_pts=prm.min_pts,
+                      crsz=prm.crop_size,scsz=prm.scale_size)
+    nsmp = prm.val_iter*bsz
+    sel = np.resize(bchr.perm(0),nsmp)
+    op = np.lib.format.open_memmap
+    cache = {k:op('{}/{}.npy'.format(prm.cache_dir,k),mode='w+',dtype=spec[k][0],shape=(nsmp,crsz,crsz,spec[k][1]))
+             for k in keys}
+    skip = set()
+    for b in range(prm.val_iter):
+        bidx = sel[b*bsz:(b+1)*bsz]
+        fd = getfeed(bchr.data[bidx])
+        fd.update({aug:np.float32([np.random.RandomState([prm.seed,j]).rand(4) for j in bidx]),
+                   pts_seed:np.int32(bidx)})
+        try: # prevent occasional failure when no pts in projection
+            out = sess.run(outs,feed_dict=fd)
+            for k in keys:
+                cache[k][b*bsz:(b+1)*bsz] = out[k]
+        except:
+            skip.add(b)
+    for k in keys:
+        cache[k].flush()
+    with open(prm.cache_dir+'/cache.json','w') as f:
+        json.dump(dict(meta,skip=sorted(skip)),f,indent=1)
+    ut.mprint("Wrote validation set of {} batches ({} skipped) to {}".format(prm.val_iter,len(skip),prm.cache_dir))
+
+#########################################################################
+
+# Evaluate each new checkpoint bundle named by the training script's
+# checkpoint.json & append the result to its log
+done = None
+while True:
+    ckpt = ut.bundle_ckpter(exp_dir,[])
+    if ckpt.latest is None:
+        if prm.once: ut.mprint("No checkpoint in " + exp_dir)
+    elif ckpt.iter != done:
+        try: # the trainer may have replaced the bundle in the meantime
+            for net,part in parts:
+                net.load(sess,ckpt.latest+':'+part)
+        except OSError:
+            ut.mprint("Could not read " + ckpt.latest)
+        else:
+            vLossAcc = []
+            for b in range(prm.val_iter):
+                if b in skip:
+                    continue
+                fd = {inp[k]:cache[k][b*bsz:(b+1)*bsz] for k in keys}
+                vLossAcc.append(sess.run(fetch,feed_dict=fd))
+            args = [ckpt.iter]+list(np.mean(vLossAcc,axis=0))
+            vlog = ('[{:09d}] .'+fmt).format(*args)
+            ut.mprint(vlog)
+            with open(exp_dir+'/train.log','a') as f:
+                f.write(time.strftime("%Y-%m-%d %H:%M:%S ")+vlog+"\n")
+            done = ckpt.iter
+    if prm.once:
+        break
+    time.sleep(prm.poll_secs)